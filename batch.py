@@ -0,0 +1,127 @@
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+from ttyplay import TtyPlay, convert, open_frame_writer
+
+# Converts many ttyrecs at once, one emulator per file on a process pool.
+# Each ttyrec gets its own output: OUT/<name>/*.csv, or OUT/<name>.fs with -store.
+# Paths inside a directory argument keep their subdirectories in <name>.
+#
+#      python3 batch.py /srv/ttyrec/2021-11-15 -o ./out -p 8
+
+TTYREC_SUFFIXES = ('.ttyrec', '.ttyrec.bz2', '.ttyrec.gz', '.ttyrec.xz')
+
+def find_ttyrecs(paths):
+    """
+    :param paths: ttyrec files and directories to search recursively.
+    :return: List of (ttyrec path, output name) tuples.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if filename.endswith(TTYREC_SUFFIXES):
+                        ttyrec = os.path.join(dirpath, filename)
+                        found.append((ttyrec, output_name(os.path.relpath(ttyrec, path))))
+        else:
+            found.append((path, output_name(os.path.basename(path))))
+    return found
+
+def output_name(path):
+    for suffix in ('.bz2', '.gz', '.xz'):
+        if path.endswith(suffix):
+            path = path[:-len(suffix)]
+    if path.endswith('.ttyrec'):
+        path = path[:-len('.ttyrec')]
+    return path
+
+def convert_file(job):
+    """
+    Convert one ttyrec headlessly, run in a pool worker.
+
+    :param job: Tuple (ttyrec path, output path, store, keyframe interval, fps, max idle, mmap).
+        The output path is a directory of CSVs, or a frame store if store is set.
+    :return: ttyplay.convert() stats dict with the paths added, or a dict with an
+        'error' message if the ttyrec could not be converted.
+    """
+    path, out, store, keyframe_interval, fps, max_idle, use_mmap = job
+    try:
+        if store:
+            frame_writer = open_frame_writer(out, keyframe_interval)
+        else:
+            os.makedirs(out, exist_ok=True)
+            frame_writer = open_frame_writer(directory=out)
+        with TtyPlay(path, use_mmap=use_mmap, frame_writer=frame_writer, headless=True) as tp:
+            stats = convert(tp, fps, max_idle)
+    except Exception as e:
+        #Unreadable or corrupt files and emulator errors only fail this ttyrec
+        return {'path': path, 'out': out, 'error': "{}: {}".format(type(e).__name__, e)}
+    stats['path'] = path
+    stats['out'] = out
+    return stats
+
+if __name__ ==  '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", help="ttyrec files or directories of ttyrecs",nargs='+')
+    parser.add_argument("-o", help="output directory",default='./out')
+    parser.add_argument("-p", help="number of worker processes (default: one per core)",type=int)
+    parser.add_argument("-store", help="write one frame store per ttyrec instead of CSV directories",action="store_true")
+    parser.add_argument("-keyframe-interval", help="write -store as keyframes every N frames + deltas",type=int,default=0)
+    parser.add_argument("-fps", help="resample to this many output frames per second",type=float,default=0)
+    parser.add_argument("-max-idle", help="with -fps, shorten pauses longer than this many seconds",type=float)
+    parser.add_argument("-mmap", help="memory-map the ttyrecs",action="store_true")
+    global_args = parser.parse_args()
+
+    jobs = []
+    used = set()
+    for path, name in find_ttyrecs(global_args.paths):
+        out = os.path.join(global_args.o, name)
+        if global_args.store:
+            out += '.fs'
+        #Same file name from different arguments
+        base, n = out, 2
+        while out in used:
+            out = "{}-{}".format(base, n)
+            n += 1
+        used.add(out)
+        if global_args.store:
+            os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+        jobs.append((path, out, global_args.store, global_args.keyframe_interval,
+                     global_args.fps or None, global_args.max_idle, global_args.mmap))
+    if not jobs:
+        print("No ttyrecs found", file=sys.stderr)
+        sys.exit(1)
+    #Largest first, so a big file doesn't start last and keep one worker busy alone
+    jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+
+    frames = 0
+    payload = 0
+    failed = 0
+    start = time.perf_counter()
+    pool = Pool(global_args.p)
+    try:
+        for stats in pool.imap_unordered(convert_file, jobs):
+            if 'error' in stats:
+                failed += 1
+                print("FAILED {}: {}".format(stats['path'], stats['error']), file=sys.stderr)
+                continue
+            frames += stats['frames']
+            payload += stats['bytes']
+            print("{:>9} frames {:>8} saved {:>8.2f}s {:>9.0f} frames/s  {} -> {}".format(
+                stats['frames'], stats['saved'], stats['seconds'],
+                stats['frames'] / max(stats['seconds'], 1e-9), stats['path'], stats['out']))
+    except KeyboardInterrupt:
+        pool.terminate()
+        print("User has cancelled the batch", file=sys.stderr)
+        sys.exit(1)
+    pool.close()
+    pool.join()
+    elapsed = time.perf_counter() - start
+    print("{} files ({} failed), {} frames, {} bytes in {:.2f}s: {:.0f} frames/s, {:.2f} MB/s".format(
+        len(jobs), failed, frames, payload, elapsed, frames / elapsed, payload / elapsed / 1e6))
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,528 @@
+import argparse
+import os
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+from ttyplay import TtyPlay, Display, VTParser, Screen, ArrayScreen, Tile, Colors, convert, verbose_print
+from frame_maker import FrameConstructor, write_cells, render_cells, encode_frame
+
+# Throughput benchmarks for the ttyrec player.
+#
+#      python3 benchmark.py reader -path example.ttyrec -repeat 500
+#      python3 benchmark.py parser -path example.ttyrec -repeat 5
+#      python3 benchmark.py render -path example.ttyrec -frames 10
+#      python3 benchmark.py encode -path example.ttyrec -frames 10
+
+def bench_reader(path, use_mmap, repeat, touch_payload):
+    """
+    Walk the ttyrec repeat times with read_frame().
+
+    :param path: Path of the ttyrec.
+    :param use_mmap: Use the memory-mapped reader.
+    :param repeat: Number of passes over the file.
+    :param touch_payload: If True, checksum every payload so each byte is delivered.
+    :return: Tuple (frames, payload bytes, seconds).
+    """
+    frames = 0
+    payload = 0
+    with TtyPlay(path, use_mmap=use_mmap) as tp:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            while tp.read_frame(loop=True):
+                frames += 1
+                payload += tp.length
+                if touch_payload:
+                    zlib.crc32(tp.frame)
+        elapsed = time.perf_counter() - start
+    return frames, payload, elapsed
+
+def run_reader(args):
+    print("{:<8} {:<16} {:>14} {:>12}".format("reader", "mode", "frames/s", "MB/s"))
+    for use_mmap in (False, True):
+        for touch_payload in (False, True):
+            frames, payload, elapsed = bench_reader(args.path, use_mmap, args.repeat, touch_payload)
+            print("{:<8} {:<16} {:>14.0f} {:>12.1f}".format(
+                "mmap" if use_mmap else "file",
+                "payload-delivery" if touch_payload else "header-walk",
+                frames / elapsed, payload / elapsed / 1e6))
+
+def read_payloads(path):
+    """
+    :param path: Path of the ttyrec.
+    :return: List of the frame payloads as bytes.
+    """
+    payloads = []
+    with TtyPlay(path) as tp:
+        while tp.read_frame(loop=True):
+            payloads.append(bytes(tp.frame))
+    return payloads
+
+def bench_parser(payloads, repeat, screen_class=ArrayScreen):
+    """
+    Emulate the payloads repeat times on a fresh Display, without saving frames.
+
+    :param payloads: List of frame payloads.
+    :param repeat: Number of passes.
+    :param screen_class: Screen implementation of the Display.
+    :return: Seconds spent by the fastest pass.
+    """
+    best = None
+    for _ in range(repeat):
+        parser = VTParser(Display(screen_class))
+        start = time.perf_counter()
+        for payload in payloads:
+            parser.feed(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+#The escape sequence loop of TtyPlay.display_frame() before VTParser, kept as the
+#reference case of the parser benchmark. Unhandled sequences raise ValueError instead
+#of exiting, the list Screen is required as it writes Tile objects directly.
+def ifchain_feed(display, frame, buffer):
+    """
+    Emulate one frame payload with the old if-chain.
+
+    :param display: Display with a list Screen.
+    :param frame: Frame payload.
+    :param buffer: Bytes of the previous frame left for this one.
+    :return: Bytes left for the next frame.
+    """
+    frame = buffer + frame
+    buffer = b''
+    #exclude the encapsulating b' ___ '
+    chidx = 0
+    # while chidx < len(frame)-10:
+    while (chidx < len(frame) and len(frame) < 2048) or chidx < len(frame)-10:
+        if frame[chidx] == 0x08:
+        #BACKSPACE
+            chidx+=1
+            display.cursor.x -= 1
+            #TODO: SEE IF THIS NEEDS TO BE COMMENTED/UNCOMMENTED --v:
+            display.screen.tiles[display.cursor.y][display.cursor.x] = Tile(Colors.WHITE,Colors.BLACK,' ')
+
+        #Handle UNICODE                https://www.utf8-chartable.de/unicode-utf8-table.pl
+        elif frame[chidx] == 0xe2:
+            chidx+=1
+            if frame[chidx] == 0x80:
+                chidx+=1
+                if frame[chidx] == 0xa0:
+                    chidx+=1
+                    display.write_ch('†')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' †' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+            elif frame[chidx] == 0x88:
+                chidx+=1
+                if frame[chidx] == 0x86:
+                    chidx+=1
+                    display.write_ch('∆')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ∆' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+                elif frame[chidx] == 0x9e:
+                    chidx+=1
+                    display.write_ch('∞')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ∞' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+                elif frame[chidx] == 0xa9:
+                    chidx+=1
+                    display.write_ch('∩')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ∩' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+                else:
+                    raise ValueError("UNHANDLED UNICODE")
+            elif frame[chidx] == 0x89:
+                chidx+=1
+                if frame[chidx] == 0x88:
+                    chidx+=1
+                    display.write_ch('≈')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ≈' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+                else:
+                    raise ValueError("UNHANDLED UNICODE")
+            elif frame[chidx] == 0x8c:
+                chidx+=1
+                if frame[chidx] == 0xa0:
+                    chidx+=1
+                    display.write_ch('⌠')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ⌠' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+                else:
+                    raise ValueError("UNHANDLED UNICODE")
+            elif frame[chidx] == 0x96:
+                chidx+=1
+                if frame[chidx] == 0x93:
+                    chidx+=1
+                    display.write_ch('▓')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ▓' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+                else:
+                    raise ValueError("UNHANDLED UNICODE")
+            elif frame[chidx] == 0x97:
+                chidx+=1
+                if frame[chidx] == 0x8b:
+                    chidx+=1
+                    display.write_ch('○')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ○' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+                else:
+                    raise ValueError("UNHANDLED UNICODE")
+            elif frame[chidx] == 0x98:
+                chidx+=1
+                if frame[chidx] == 0xbc:
+                    chidx+=1
+                    display.write_ch('☼')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ☼' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+                else:
+                    raise ValueError("UNHANDLED UNICODE")
+            elif frame[chidx] == 0x99:
+                chidx+=1
+                if frame[chidx] == 0xa3:
+                    chidx+=1
+                    display.write_ch('♣')
+                    verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ♣' + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+                else:
+                    raise ValueError("UNHANDLED UNICODE")
+            else:
+                raise ValueError("UNHANDLED UNICODE")
+        #HANDLE ESCAPE
+        elif frame[chidx] == 27:
+            chidx+=1
+            if frame[chidx] == ord('7') or frame[chidx] == ord('8'):
+                chidx+=1
+                #NOOP
+                #7 Save Cursor
+                #8 Restore Cursor
+            #Keypad Numeric Mode
+            elif frame[chidx] == ord('>'):
+                chidx+=1
+                #NOOP?
+            #Control Sequence Introducer
+            elif frame[chidx] == ord('['):
+                chidx+=1
+
+                #Get number (break at non number sequence)
+                number = 0
+                power = 1
+                while (chidx < len(frame)-1) and (frame[chidx] >= ord('0') and frame[chidx] <= ord('9')):
+                    number*=10
+                    number+= (int)(chr(frame[chidx]))
+                    chidx+=1
+
+                #Handle ANSI Control Sequences
+                #Cursor Forware
+                if frame[chidx] == ord('C'):
+                    chidx+=1
+                    #NOTE: if number is 0 should it still move forward?
+                    display.CSI_C(number)
+                #Delete line
+                elif frame[chidx] == ord('M'):
+                    chidx+=1
+                    #NOTE: if number is 0 should it still delete a line? (does ^[M mean delete 1 line?)
+                    display.CSI_M(number)
+                #Scroll Down
+                elif frame[chidx] == ord('T'):
+                    chidx+=1
+                    display.CSI_S(number)
+                #Scroll UP
+                elif frame[chidx] == ord('S'):
+                    chidx+=1
+                    display.CSI_T(number)
+                #Insert Lines
+                elif frame[chidx] == ord('L'):
+                    chidx+=1
+                    display.CSI_L(number)
+                # Erase Characters (Delete arg1 characters after cursor)
+                elif frame[chidx] == ord('X'):
+                    chidx+=1
+                    display.CSI_X(number)
+                # Erase in Line
+                elif frame[chidx] == ord('K'):
+                    chidx+=1
+                    if number >= 0 and number <= 2:
+                        display.CSI_K(number)
+                    else:
+                        print("Unhandled clear line")
+                #VPA Move cursor to arg1 row
+                elif frame[chidx] == ord('d'):
+                    chidx+=1
+                    display.CSI_d(number)
+                #Reset Mode
+                elif frame[chidx] == ord('l'):
+                    chidx+=1
+                    if number == 4:
+                        verbose_print("Insertion Replacement Mode")
+                    else:
+                        raise ValueError("Unhandled reset")
+                #Private Modes DECSET DECRST
+                elif frame[chidx] == ord('?'):
+                    chidx+=1
+                    number = 0
+                    power = 1
+                    while frame[chidx] >= ord('0') and frame[chidx] <= ord('9'):
+                        number*=10
+                        number+= (int)(chr(frame[chidx]))
+                        chidx+=1
+                    if (number == 1 or number==7 or number == 12 or number == 25 or
+                        number == 1047 or number == 1048 or number == 1049 or
+                        number == 1051 or number == 1052 or number == 1060 or number==1061) and (frame[chidx] == ord('l') or frame[chidx] == ord('h')):
+                        verbose_print("[?"+str(number) + chr(frame[chidx]))
+                        chidx+=1
+                        #1 Application Cursor Keys
+                        #7 Wrap around
+                        #12 Start blinking cursor
+                        #25 Show Cursor
+
+                        #1047 Use Alternate Screen Buffer
+                        #1048 Save cursor as in DECSC
+                        #1049 Combine 1047 and 1048 modes and clear
+                        #1051 Set Sun function-key mode
+                        #1052 Set HP function-key mode
+                        #1060 Set legacy keyboard emulation (X11R6)
+                        #1061 Set VT220 keyboard emulation
+                        #NOOP JUST IGNORE
+                    elif (number==1 or number == 0)and frame[chidx] == ord('c'):
+                        verbose_print("[?"+str(number) + chr(frame[chidx]))
+                        chidx+=1
+                        # [?1c https://stackoverflow.com/questions/59847747/what-does-the-esc-1c-escape-sequence-do-on-the-linux-console
+                    else:
+                        raise ValueError("Unhandled [?_l or [?_h")
+                #Erase in Display
+                elif frame[chidx] == ord('J'):
+                    if number >= 0 and number <= 3:
+                        display.CSI_J(number)
+                        chidx+=1
+                    else:
+                        raise ValueError("Unhandled CSI ^[#J")
+                #(Select Graphic Rendition)
+                elif frame[chidx] == ord('m'):
+                    display.set_color(number)
+                    chidx+=1
+                #Delete arg1 characters before cursor
+                elif frame[chidx] == ord('P'):
+                    display.CSI_P(number)
+                    chidx+=1
+                #Cursor UP
+                elif frame[chidx] == ord('A'):
+                    display.CSI_A(number)
+                    chidx+=1
+                #Cursor Position
+                elif frame[chidx] == ord('H'):
+                    display.CSI_H(0,number)
+                    chidx+=1
+                elif frame[chidx] == ord('G'):
+                    display.CSI_G(number)
+                    chidx+=1
+                elif frame[chidx] == ord(';'):
+                    chidx+=1
+                    number2 = 0
+                    power2 = 1
+                    while frame[chidx] >= ord('0') and frame[chidx] <= ord('9'):
+                        number2*=10
+                        number2+= (int)(chr(frame[chidx]))
+                        chidx+=1
+                    #Cursor Position
+                    if frame[chidx] == ord('H'):
+                        #Moves the cursor to row n, column m
+                        display.CSI_H(number2,number)
+                        chidx+=1
+                    #Select Graphic Rendition
+                    elif frame[chidx] == ord('m'):
+                        display.set_color(number)
+                        display.set_color(number2)
+                        chidx+=1
+                    #Set Top and Bottom Margins
+                    elif frame[chidx] == ord('r'):
+                        display.CSI_r(number,number2)
+                        verbose_print("set_margins")
+                        chidx+=1
+                    else:
+                        chidx+=1
+                        number3 = 0
+                        while frame[chidx] >= ord('0') and frame[chidx] <= ord('9'):
+                            number3*=10
+                            number3+= (int)(chr(frame[chidx]))
+                            chidx+=1
+                        if frame[chidx] == ord('m'):
+                            display.set_color(number)
+                            display.set_color(number2)
+                            display.set_color(number3) #ex: \x1b[0;10;1m - 1 means BOLD BRIGHT so make the next stuff bright
+                            chidx+=1
+                        else:
+                            raise ValueError("UNHANDLED CSI ESCAPE ^[#;#*",(chr(frame[chidx])))
+                else:
+                    raise ValueError("UNHANDLED CSI ESCAPE Letter:" + chr(frame[chidx]))
+
+            elif frame[chidx] == ord(')'):
+                chidx+=1
+                #Set G1 character set to
+                # https://chromium.googlesource.com/apps/libapps/+/a5fb83c190aa9d74f4a9bca233dac6be2664e9e9/hterm/doc/ControlSequences.md#SCS
+                if frame[chidx] == ord('0'): #Graphics
+                    verbose_print("set_ascii 0)")
+                    chidx+=1
+                    #NOOP JUST IGNORE
+
+            elif frame[chidx] == ord('('):
+                #Set G0 character set (VT100) [Graphic Codesets for GL/GR (SCS)]
+                chidx+=1
+                if frame[chidx] == ord('B'):
+                    #United States (ASCII)
+                    verbose_print("set_ascii (B")
+                    chidx+=1
+                    #NOOP JUST IGNORE
+                else:
+                    print("UNHANDLED Graphic Codeset")
+            #Keypad Application Mode
+            elif frame[chidx] == ord('='):
+                chidx+=1
+                verbose_print("Keypad Application Mode")
+            # Reverse Line Feed? (Reverse Index?) (Move up one line keeping column position)
+            elif frame[chidx] == ord('M'):
+                chidx+=1
+                display.reverse_line_feed()
+                verbose_print("Reverse Line Feed")
+            else:
+                raise ValueError("UNHANDLED NON CSI ESCAPE")
+        else:
+            display.write_ch(chr(frame[chidx]))
+            if len(frame) > chidx:
+                verbose_print(str(chidx) + ' ' + str(frame[chidx]) + ' ' + chr(frame[chidx]) + " cursor(x,y):"+str(display.cursor.x) + "," + str(display.cursor.y))
+            chidx+=1
+
+        if len(frame) >= 2060 and int(str(chidx)) > 2050:
+            buffer = frame[chidx:]
+            chidx = len(frame)
+
+    if chidx < len(frame):
+        buffer = frame[chidx:]
+        chidx = len(frame)
+    return buffer
+
+def bench_ifchain(payloads, repeat):
+    """
+    Emulate the payloads repeat times with ifchain_feed() on a fresh Display.
+
+    :param payloads: List of frame payloads.
+    :param repeat: Number of passes.
+    :return: Seconds spent by the fastest pass.
+    """
+    best = None
+    for _ in range(repeat):
+        display = Display(Screen)
+        buffer = b''
+        start = time.perf_counter()
+        for payload in payloads:
+            buffer = ifchain_feed(display, payload, buffer)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run_parser(args):
+    payloads = read_payloads(args.path)
+    total = sum(len(payload) for payload in payloads)
+    reference = bench_ifchain(payloads, args.repeat)
+    print("if-chain (list screen): {} bytes in {:.3f}s (best of {}), {:.0f} bytes/s".format(
+        total, reference, args.repeat, total / reference))
+    for name, screen_class in (("list", Screen), ("array", ArrayScreen)):
+        elapsed = bench_parser(payloads, args.repeat, screen_class)
+        print("parser ({} screen): {} bytes in {:.3f}s (best of {}), {:.0f} bytes/s, {:.1f}x the if-chain".format(
+            name, total, elapsed, args.repeat, total / elapsed, reference / elapsed))
+
+class ScreenList(object):
+    """
+    Frame writer keeping the saved screens in memory.
+    """
+    def __init__(self):
+        self.screens = []
+
+    def write(self, frameno, timestamp, cells):
+        self.screens.append(cells.copy())
+
+    def write_ref(self, frameno, timestamp, source_frameno):
+        pass
+
+    def close(self):
+        pass
+
+def read_screens(path, count):
+    """
+    :param path: Path of the ttyrec.
+    :param count: Number of screens to keep.
+    :return: List of the first count saved screens as CELL_DTYPE arrays.
+    """
+    screen_list = ScreenList()
+    with TtyPlay(path, frame_writer=screen_list, headless=True) as tp:
+        convert(tp)
+    return screen_list.screens[:count]
+
+def bench_render(screens, render):
+    """
+    Render every screen with a fresh FrameConstructor.
+
+    :param screens: List of CELL_DTYPE arrays.
+    :param render: Function (fc, cells) composing fc.png_array, it is cleared before each pass only.
+    :return: Tuple (seconds of the first pass, seconds of the second pass, images of the last pass).
+    """
+    fc = FrameConstructor(TILESIZE=32, DISPLAY_Y_SIZE=screens[0].shape[0], DISPLAY_X_SIZE=screens[0].shape[1], DATASIZE=3)
+    passes = []
+    for _ in range(2):
+        images = []
+        fc.clear_png_array()
+        start = time.perf_counter()
+        for cells in screens:
+            render(fc, cells)
+            images.append(fc.png_array.copy())
+        passes.append(time.perf_counter() - start)
+    return passes[0], passes[1], images
+
+def run_render(args):
+    screens = read_screens(args.path, args.frames)
+    results = {}
+    incremental = lambda fc, cells: render_cells(fc, cells, incremental=True)
+    for name, render in (("write_tile", write_cells), ("atlas", render_cells), ("incremental", incremental)):
+        first, second, results[name] = bench_render(screens, render)
+        print("render ({}): {} frames, first pass {:.1f} frames/s, second pass {:.1f} frames/s".format(
+            name, len(screens), len(screens) / first, len(screens) / second))
+    same = all(np.array_equal(a, b) and np.array_equal(a, c)
+               for a, b, c in zip(results["write_tile"], results["atlas"], results["incremental"]))
+    print("images are identical" if same else "IMAGES DIFFER")
+
+def run_encode(args):
+    screens = read_screens(args.path, args.frames)
+    fc = FrameConstructor(TILESIZE=32, DISPLAY_Y_SIZE=screens[0].shape[0], DISPLAY_X_SIZE=screens[0].shape[1], DATASIZE=3)
+    encoders = [("pypng", 6)] + [("png", level) for level in args.levels] + [("raw", 6), ("stdout", 6)]
+    print("{:<8} {:>6} {:>14} {:>16}".format("encoder", "level", "ms/frame", "bytes/frame"))
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'wb') as devnull:
+        for encoder, level in encoders:
+            seconds = 0
+            size = 0
+            for i, cells in enumerate(screens):
+                render_cells(fc, cells)
+                encoded = encode_frame(fc, os.path.join(tmp, str(i)), encoder, level, devnull)
+                seconds += encoded[0]
+                size += encoded[1]
+            print("{:<8} {:>6} {:>14.1f} {:>16.0f}".format(
+                encoder, level if encoder == "png" else "", 1000 * seconds / len(screens), size / len(screens)))
+
+if __name__ ==  '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    reader_parser = subparsers.add_parser("reader", help="header walk and payload delivery of the ttyrec readers")
+    reader_parser.add_argument("-path", help="specify path of ttyrec",default="example.ttyrec")
+    reader_parser.add_argument("-repeat", help="number of passes over the file",type=int,default=200)
+    reader_parser.set_defaults(run=run_reader)
+
+    parser_parser = subparsers.add_parser("parser", help="escape sequence emulation bytes/s")
+    parser_parser.add_argument("-path", help="specify path of ttyrec",default="example.ttyrec")
+    parser_parser.add_argument("-repeat", help="number of passes over the file",type=int,default=5)
+    parser_parser.set_defaults(run=run_parser)
+
+    render_parser = subparsers.add_parser("render", help="frames/s of the per-cell, atlas and incremental frame composition")
+    render_parser.add_argument("-path", help="specify path of ttyrec",default="example.ttyrec")
+    render_parser.add_argument("-frames", help="number of saved screens to render",type=int,default=10)
+    render_parser.set_defaults(run=run_render)
+
+    encode_parser = subparsers.add_parser("encode", help="encode time and bytes per frame of the frame_maker encoders")
+    encode_parser.add_argument("-path", help="specify path of ttyrec",default="example.ttyrec")
+    encode_parser.add_argument("-frames", help="number of saved screens to encode",type=int,default=10)
+    encode_parser.add_argument("-levels", help="comma separated zlib levels of the png encoder",
+                               type=lambda levels: [int(level) for level in levels.split(',')],default=[1,6,9])
+    encode_parser.set_defaults(run=run_encode)
+
+    global_args = parser.parse_args()
+    global_args.run(global_args)
@@ -15,6 +15,11 @@ from os.path import isfile, join
 from threading import Thread
 from queue import Queue
 import tqdm
+import shutil
+import os
+import zlib
+from collections import OrderedDict
+from frame_store import CELL_DTYPE, open_store, read_manifest
 
 def get_rgb(c):
     if c == Colors.BLACK:
@@ -74,7 +79,6 @@ def get_image(image_path):
     """Get a numpy array of an image so that one can access values[x][y]."""
     image = Image.open(image_path, "r")
     width, height = image.size
-    pixel_values = list(image.getdata())
     if image.mode == "RGBA":
         channels = 4
     elif image.mode == "L":
@@ -82,435 +86,418 @@ def get_image(image_path):
     else:
         print("Unknown mode: %s" % image.mode)
         return None
-    pixel_values = np.array(pixel_values).reshape((height,width,  channels))
+    #Decoded straight to uint8, going through getdata() made an int64 array of tuples
+    pixel_values = np.asarray(image).reshape((height,width,  channels))
     return pixel_values
 
+FONT = "Menlo.ttc"
+FONT_SIZE = 28
+#Tried in order when the font given to FrameConstructor can't be loaded, then PIL's default font
+FALLBACK_FONTS = ("Menlo.ttc","DejaVuSansMono.ttf")
+
+def load_font(name,bold):
+    """
+    Load a font at FONT_SIZE.
+
+    :param name: Path or name of a .ttc, .ttf or .otf font.
+    :param bold: Load the bold face: index 1 of a collection, <name>-Bold of a single
+        font or the regular face if there is no -Bold file.
+    :return: FreeTypeFont, raises OSError if the font can't be found.
+    """
+    root, ext = os.path.splitext(name)
+    if bold and ext.lower() == '.ttc':
+        return ImageFont.truetype(name,FONT_SIZE,index=1)
+    if bold:
+        try:
+            return ImageFont.truetype(root + '-Bold' + ext,FONT_SIZE)
+        except OSError:
+            pass
+    return ImageFont.truetype(name,FONT_SIZE)
+
+#Declarative map tile table, see the header of the file
+TILE_MAPPING = "tiles.csv"
+
+def read_tile_mapping(path=TILE_MAPPING):
+    """
+    Read a map tile table.
+
+    :param path: Path of the csv.
+    :return: List of (char, fg, bg, sheet, y, x, height, width) tuples in file order,
+        fg and bg as Colors. char, fg and bg are None on the default row.
+    """
+    mapping = []
+    with open(path,newline='',encoding='utf-8') as mapping_file:
+        for row in csv.DictReader(line for line in mapping_file if not line.startswith('#')):
+            if row['char'] == '' and row['fg'] == '' and row['bg'] == '':
+                glyph = (None,None,None)
+            else:
+                glyph = (row['char'],Colors[row['fg']],Colors[row['bg']])
+            mapping.append(glyph + (row['sheet'],int(row['y']),int(row['x']),int(row['height']),int(row['width'])))
+    return mapping
+
 class FrameConstructor():
-    def __init__(self,TILESIZE,DISPLAY_Y_SIZE,DISPLAY_X_SIZE,DATASIZE):
+    def __init__(self,TILESIZE,DISPLAY_Y_SIZE,DISPLAY_X_SIZE,DATASIZE,tile_mapping=TILE_MAPPING,font=FONT,glyph_cache_size=4096):
         self.TILESIZE = 32
         self.DISPLAY_Y_SIZE = DISPLAY_Y_SIZE
         self.DISPLAY_X_SIZE = DISPLAY_X_SIZE
         self.DATASIZE = DATASIZE
         self.png_array = np.ndarray(shape=(TILESIZE*DISPLAY_Y_SIZE,TILESIZE*DISPLAY_X_SIZE,DATASIZE),dtype=np.uint8)
+        #Screen png_array shows, None while it isn't a rendered screen
+        self.previous_cells = None
         self.sprite_playerpng = get_image("player.png")
         self.sprite_wallpng = get_image("wall.png")
         self.sprite_floorpng = get_image("floor.png")
         self.sprite_featpng = get_image("feat.png")
         self.sprite_mainpng = get_image("main.png")
         self.sprite_iconspng = get_image("icons.png")
-
+        self.sheets = {"player.png":self.sprite_playerpng,"wall.png":self.sprite_wallpng,"floor.png":self.sprite_floorpng,
+                       "feat.png":self.sprite_featpng,"main.png":self.sprite_mainpng,"icons.png":self.sprite_iconspng}
+        self.compile_tiles(read_tile_mapping(tile_mapping))
+        #Text tiles by (fg, bg, char), least recently used first, at most glyph_cache_size of them
+        self.char_tile_cache = OrderedDict()
+        self.glyph_cache_size = glyph_cache_size
+        self.font = font
+        self.fonts = {}
+        #Map tiles are all prebuilt, so they are only counted, text tiles go through the glyph cache
+        self.map_lookups = 0
+        self.glyph_hits = 0
+        self.glyph_misses = 0
 
     def clear_png_array(self):
         self.png_array = np.ndarray(shape=(self.TILESIZE*self.DISPLAY_Y_SIZE,self.TILESIZE*self.DISPLAY_X_SIZE,self.DATASIZE),dtype=np.uint8)
+        self.previous_cells = None
+
+    def get_font(self,bold):
+        """Get the regular or bold face of self.font, loaded once, falling back to FALLBACK_FONTS."""
+        if bold not in self.fonts:
+            for name in (self.font,) + FALLBACK_FONTS:
+                try:
+                    self.fonts[bold] = load_font(name,bold)
+                    break
+                except OSError:
+                    continue
+            else:
+                name = "PIL's default font"
+                self.fonts[bold] = ImageFont.load_default(FONT_SIZE)
+            if name != self.font:
+                print("Font {} not found, drawing {} text with {}".format(self.font,"bold" if bold else "regular",name),file=sys.stderr)
+        return self.fonts[bold]
 
     def construct_char_tile(self,y,x,fg,bg,char):
-        fontname = "Menlo.ttc"
-        fontsize = 28
         colorText = (fg.name).replace('BRIGHT','')
         colorBackground = (bg.name).replace('BRIGHT','')
         
         bold = 1 if ("BRIGHT" in fg.name) else 0
         text = char
         img = Image.new('RGB', (32, 32), colorBackground)
-        font = ImageFont.truetype(fontname, fontsize,index=bold)
         d = ImageDraw.Draw(img)
-        d.text((0, -1), text, fill=colorText, font=font)
+        d.text((0, -1), text, fill=colorText, font=self.get_font(bold))
         return np.asarray(img)
 
-    def construct_tile(self,y,x,fg,bg,char):
-        # sprite_image = get_image("player.png")
-
-        # fg = self.display.screen.tiles[y][x].fgcolor
-        # bg = self.display.screen.tiles[y][x].bgcolor
-        # char = self.display.screen.tiles[y][x].char
-
-        #Default
-        source_png = self.sprite_floorpng
-        sprite_index_y = 0
-        sprite_index_x = 32 
-        sprite_size_x = 32
-        sprite_size_y = 32
-
-        #EMPTY
-        if fg == Colors.WHITE and bg == Colors.BLACK and char == ' ':
-            source_png = self.sprite_floorpng
-            sprite_index_y = 0
-            sprite_index_x = 0
-        #EMPTY 2
-        elif fg == Colors.BLUE and bg == Colors.BLACK and char == ' ':
-            source_png = self.sprite_floorpng
-            sprite_index_y = 0
-            sprite_index_x = 0 
-        #FLOOR SEEN
-        elif fg == Colors.WHITE and bg == Colors.BLACK and char == '.':
-            source_png = self.sprite_floorpng
-            sprite_index_y = 0
-            sprite_index_x = 64
-
-
-        #FLOOR UNSEEN
-        elif fg == Colors.BLUE and bg == Colors.BLACK and char == '.':
-            source_png = self.sprite_floorpng
-            sprite_index_y = 0
-            sprite_index_x = 544
-        #Water
-        elif fg == Colors.BLUE and bg == Colors.BLACK and char == '≈':
-            source_png = self.sprite_floorpng
-            sprite_index_y = 0
-            sprite_index_x = 576
-
-
-        #WALL SEEN
-        elif fg == Colors.YELLOW and bg == Colors.BLACK and char == '#':
-            source_png = self.sprite_wallpng
-            sprite_index_y = 0
-            sprite_index_x = 0
-        #WALL UNSEEN //opacity reduced
-        elif fg == Colors.BLUE and bg == Colors.BLACK and char == '#':
-            source_png = self.sprite_wallpng
-            sprite_index_y = 32
-            sprite_index_x = 352
-
-
-        #Downstairs trapdoor (untraveled)
-        elif fg == Colors.YELLOW and bg == Colors.BLACK and char == '>':
-            source_png = self.sprite_featpng
-            sprite_index_y = 224
-            sprite_index_x = 192
-            sprite_size_x = 30
-            sprite_size_y = 25
-        #Downstairs (untraveled)
-        elif fg == Colors.BRIGHTWHITE and bg == Colors.BRIGHTBLACK and char == '>':
-            source_png = self.sprite_featpng
-            sprite_index_y = 224
-            sprite_index_x = 128
-            sprite_size_x = 32
-            sprite_size_y = 32
-        #UPSTAIRS (traveled)
-        elif fg == Colors.GREEN and bg == Colors.BLACK and char == '<':
-            source_png = self.sprite_featpng
-            sprite_index_y = 224
-            sprite_index_x = 160
-            sprite_size_x = 32
-            sprite_size_y = 32
-        #UPSTAIRS
-        elif fg == Colors.BLACK and bg == Colors.GREEN and char == '<':
-            source_png = self.sprite_featpng
-            sprite_index_y = 224
-            sprite_index_x = 160
-            sprite_size_x = 32
-            sprite_size_y = 32
-
-        #EXIT
-        elif fg == Colors.BRIGHTBLUE and bg == Colors.BRIGHTBLACK and char == '<':
-            source_png = self.sprite_featpng
-            sprite_index_y = 224
-            sprite_index_x = 96
-
-
-        #AUTOTRAVEL FOOTSTEP OUT OF LOS
-        elif fg == Colors.BLACK and bg == Colors.BLUE and char == '.':
-            source_png = self.sprite_iconspng
-            sprite_index_y = 32
-            sprite_index_x = 160
-            sprite_size_x = 18
-            sprite_size_y = 16
-        #AUTOTRAVEL FOOTSTEP IN LOS
-        elif fg == Colors.BLACK and bg == Colors.WHITE and char == '.':
-            source_png = self.sprite_iconspng
-            sprite_index_y = 32
-            sprite_index_x = 160
-            sprite_size_x = 18
-            sprite_size_y = 16
-
- 
-        #GOLD
-        elif fg == Colors.BRIGHTYELLOW and bg == Colors.BRIGHTBLACK and char == '$':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 690
-            sprite_index_x = 0
-            sprite_size_x = 30
-            sprite_size_y = 30
-        #DEAD enemy bloodstain
-        elif fg == Colors.RED and bg == Colors.BLACK and char == '.':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 690
-            sprite_index_x = 190
-            sprite_size_x = 30
-            sprite_size_y = 25
-        #DEAD enemy bloodstain (inverted with items?)
-        elif fg == Colors.BLACK and bg == Colors.RED and char == '.':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 690
-            sprite_index_x = 190
-            sprite_size_x = 30
-            sprite_size_y = 25
-
-        #PLAYER CHARACTER
-        elif fg == Colors.BLACK and bg == Colors.WHITE and char == '@':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 1766
-            sprite_index_x = 299+32
-            sprite_size_x = 22
-            sprite_size_y = 30
-        #PLAYER CHARACTER INVERTED
-        elif fg == Colors.WHITE and bg == Colors.BLACK and char == '@':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 1766
-            sprite_index_x = 299+32
-            sprite_size_x = 22
-            sprite_size_y = 30
-        #BAT
-        elif fg == Colors.WHITE and bg == Colors.BLACK and char == 'b':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 694
-            sprite_index_x = 127
-            sprite_size_x = 32
-            sprite_size_y = 25
-        #BAT (sleeping)
-        elif fg == Colors.WHITE and bg == Colors.BLUE and char == 'b':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 694
-            sprite_index_x = 127
-            sprite_size_x = 32
-            sprite_size_y = 25
-        #frilled lizard
-        elif fg == Colors.GREEN and bg == Colors.BLACK and char == 'l':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 742
-            sprite_index_x = 249
-            sprite_size_x = 28
-            sprite_size_y = 21
-        #frilled lizard (sleeping)
-        elif fg == Colors.GREEN and bg == Colors.BLUE and char == 'l':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 742
-            sprite_index_x = 249
-            sprite_size_x = 28
-            sprite_size_y = 21
-        #dead frilled lizard corpse
-        elif fg == Colors.GREEN and bg == Colors.BLACK and char == '†':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 690
-            sprite_index_x = 696
-            sprite_size_x = 32
-            sprite_size_y = 20
-        #QUOKA
-        elif fg == Colors.BRIGHTWHITE and bg == Colors.BRIGHTBLACK and char == 'r':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 742
-            sprite_index_x = 523
-            sprite_size_x = 28
-            sprite_size_y = 25
-        #QUOKA (sleeping)
-        elif fg == Colors.BRIGHTWHITE and bg == Colors.BRIGHTBLUE and char == 'r':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 742
-            sprite_index_x = 523
-            sprite_size_x = 28
-            sprite_size_y = 25
-        #dead QUOKA corpse 
-        elif fg == Colors.BRIGHTWHITE and bg == Colors.BRIGHTBLACK and char == '†':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 690
-            sprite_index_x = 849
-            sprite_size_x = 32
-            sprite_size_y = 21
-        #Kobold (sleeping)
-        elif fg == Colors.YELLOW and bg == Colors.BLUE and char == 'K':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 1446
-            sprite_index_x = 876
-            sprite_size_x = 30
-            sprite_size_y = 31
-        #Kobold
-        elif fg == Colors.YELLOW and bg == Colors.BLACK and char == 'K':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 1446
-            sprite_index_x = 876
-            sprite_size_x = 30
-            sprite_size_y = 31
-        #rat
-        elif fg == Colors.YELLOW and bg == Colors.BLACK and char == 'r':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 742
-            sprite_index_x = 400
-            sprite_size_x = 31
-            sprite_size_y = 21
-        #giant cockroach
-        elif fg == Colors.YELLOW and bg == Colors.BLACK and char == 'B':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 694
-            sprite_index_x = 96
-            sprite_size_x = 31
-            sprite_size_y = 29
-        #giant cockroach unaware wandering
-        elif fg == Colors.BLACK and bg == Colors.YELLOW and char == 'B':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 694
-            sprite_index_x = 96
-            sprite_size_x = 31
-            sprite_size_y = 29
-        #goblin (sleeping)
-        elif fg == Colors.WHITE and bg == Colors.BLUE and char == 'g':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 1446
-            sprite_index_x = 851
-            sprite_size_x = 25
-            sprite_size_y = 26
-        #goblin
-        elif fg == Colors.WHITE and bg == Colors.BLACK and char == 'g':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 1446
-            sprite_index_x = 851
-            sprite_size_x = 25
-            sprite_size_y = 26
-        #ADDER
-        elif fg == Colors.GREEN and bg == Colors.BLACK and char == 'S':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 998
-            sprite_index_x = 406
-            sprite_size_x = 32
-            sprite_size_y = 24
-        #ADDER SLEEPING
-        elif fg == Colors.GREEN and bg == Colors.BLUE and char == 'S':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 998
-            sprite_index_x = 406
-            sprite_size_x = 32
-            sprite_size_y = 24
-        #BALL PYTHON?
-        #Colors.BRIGHTGREEN Colors.BRIGHTYELLOW S
-        #Colors.BRIGHTGREEN Colors.BRIGHTBLACK †
-        #moccasin?
-        #TELEPORT TRAP
-        elif fg == Colors.BRIGHTBLUE and bg == Colors.BRIGHTBLACK and char == '^':
-            source_png = self.sprite_featpng
-            sprite_index_y = 192
-            sprite_index_x = 304
-            sprite_size_x = 32
-            sprite_size_y = 22
-        #ECTOPLASM (sleeping)
-        elif fg == Colors.WHITE and bg == Colors.BLUE and char == 'J':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 1318
-            sprite_index_x = 528
-            sprite_size_x = 32
-            sprite_size_y = 24
-        #ECTOPLASM
-        elif fg == Colors.WHITE and bg == Colors.BLACK and char == 'J':
-            source_png = self.sprite_playerpng
-            sprite_index_y = 1318
-            sprite_index_x = 528
-            sprite_size_x = 32
-            sprite_size_y = 24
-        #Colors.YELLOW Colors.BLACK < upstairs oneway
-        # Colors.BRIGHTWHITE Colors.BRIGHTBLACK < upstairs normal? untraveled?
-        # Colors.YELLOW Colors.BLACK ( stone ?
-
-        #potion
-        elif fg == Colors.WHITE and bg == Colors.BLACK and char == '!':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 504
-            sprite_index_x = 910
-            sprite_size_x = 25
-            sprite_size_y = 27  
-        #hunting sling
-        elif fg == Colors.YELLOW and bg == Colors.BLACK and char == ')':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 192
-            sprite_index_x = 809
-            sprite_size_x = 32
-            sprite_size_y = 29
-        #ROBE
-        elif fg == Colors.RED and bg == Colors.BLACK and char == '[':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 288
-            sprite_index_x = 137
-            sprite_size_x = 29
-            sprite_size_y = 29
-        #Robe walked on or robe stash
-        elif fg == Colors.BLACK and bg == Colors.RED and char == '[':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 288
-            sprite_index_x = 137
-            sprite_size_x = 29
-            sprite_size_y = 29   
-        #long sword
-        elif fg == Colors.BRIGHTCYAN and bg == Colors.BRIGHTBLACK and char == ')':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 128
-            sprite_index_x = 851
-            sprite_size_x = 28
-            sprite_size_y = 28 
-        #sling bullet   
-        elif fg == Colors.CYAN and bg == Colors.BLACK and char == '(':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 224
-            sprite_index_x = 633
-            sprite_size_x = 15
-            sprite_size_y = 11
-        #unknown scroll 
-        elif fg == Colors.BRIGHTBLUE and bg == Colors.BRIGHTBLACK and char == '?':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 412
-            sprite_index_x = 433
-            sprite_size_x = 27
-            sprite_size_y = 28  
-        #whip/common weapon
-        elif fg == Colors.WHITE and bg == Colors.BLACK and char == ')':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 128
-            sprite_index_x = 32
-            sprite_size_x = 31
-            sprite_size_y = 29  
-        # Colors.CYAN Colors.BLACK ) => common dagger
-        elif fg == Colors.CYAN and bg == Colors.BLACK and char == ')':
-            source_png = self.sprite_mainpng
-            sprite_index_y = 128
-            sprite_index_x = 437
-            sprite_size_x = 17
-            sprite_size_y = 17  
-
-        # else:
-        #     print(Colors(fg),Colors(bg),char)
-
+    def sprite_tile(self,sheet,y,x,height,width):
+        """Centre the height x width sprite at row y, column x of a sprite sheet in a 32x32x3 uint8 tile."""
         #get individual character sprite image
-        image = source_png[sprite_index_y:sprite_size_y+sprite_index_y,sprite_index_x:sprite_size_x+sprite_index_x,:]
+        image = self.sheets[sheet][y:height+y,x:width+x,:]
         #apply sprite image to a 32x32 image (center the sprite)
-        tile_image = np.zeros(shape=(32,32,3))
-        offset_y = int((32-sprite_size_y)/2)
-        offset_x = int((32-sprite_size_x)/2)
+        tile_image = np.zeros(shape=(32,32,3),dtype=np.uint8)
+        offset_y = int((32-height)/2)
+        offset_x = int((32-width)/2)
         tile_image[offset_y:offset_y+image.shape[0],offset_x:offset_x+image.shape[1],:] = image[:,:,0:3]
         return tile_image
 
+    def compile_tiles(self,mapping):
+        """
+        Build every tile of a read_tile_mapping() list and the dense table from cells to tiles.
+
+        self.tiles[self.tile_table[self.char_buckets[char], fg-1, bg-1]] is the tile of a cell.
+        Chars without a mapping, including those past the end of char_buckets, are in
+        bucket 0 which only holds the default tile 0.
+        """
+        glyphs = [row for row in mapping if row[0] is not None]
+        default = [row for row in mapping if row[0] is None]
+        chars = sorted({ord(row[0]) for row in glyphs})
+        #One bucket per mapped char, plus a 0 at the end that chars past the end are clipped to
+        self.char_buckets = np.zeros(chars[-1]+2 if chars else 1,dtype=np.uint16)
+        self.char_buckets[chars] = np.arange(1,len(chars)+1)
+        self.tile_table = np.zeros((len(chars)+1,16,16),dtype=np.uint16)
+        self.tiles = np.zeros((len(glyphs)+1,32,32,3),dtype=np.uint8)
+        if default:
+            self.tiles[0] = self.sprite_tile(*default[0][3:])
+        for tile_id, (char,fg,bg,sheet,y,x,height,width) in enumerate(glyphs,1):
+            self.tiles[tile_id] = self.sprite_tile(sheet,y,x,height,width)
+            entry = (self.char_buckets[ord(char)],fg.value-1,bg.value-1)
+            #The first row for a cell wins
+            if self.tile_table[entry] == 0:
+                self.tile_table[entry] = tile_id
+
+    def tile_id(self,fg,bg,char):
+        """Id in self.tiles of the map tile of one cell."""
+        bucket = self.char_buckets[min(ord(char),len(self.char_buckets)-1)]
+        return self.tile_table[bucket,fg.value-1,bg.value-1]
+
+    def cell_tile_ids(self,cells):
+        """Ids in self.tiles of the map tiles of a CELL_DTYPE array, in one lookup."""
+        buckets = self.char_buckets[np.minimum(cells['char'],len(self.char_buckets)-1)]
+        return self.tile_table[buckets,cells['fg'].astype(np.intp)-1,cells['bg'].astype(np.intp)-1]
+
+    def construct_tile(self,y,x,fg,bg,char):
+        return self.tiles[self.tile_id(fg,bg,char)]
+
+    def get_char_tile(self,fg,bg,char):
+        """Get the 32x32x3 uint8 text tile of a cell, drawn by construct_char_tile() on first use."""
+        key = (fg,bg,char)
+        tile = self.char_tile_cache.get(key)
+        if tile is None:
+            self.glyph_misses += 1
+            tile = self.construct_char_tile(0,0,fg,bg,char).astype(np.uint8)
+            self.char_tile_cache[key] = tile
+            if len(self.char_tile_cache) > self.glyph_cache_size:
+                self.char_tile_cache.popitem(last=False)
+        else:
+            self.glyph_hits += 1
+            self.char_tile_cache.move_to_end(key)
+        return tile
+
+    def tile_counts(self):
+        """Tuple (map tile lookups, glyph cache hits, glyph cache misses) so far."""
+        return self.map_lookups, self.glyph_hits, self.glyph_misses
+
+    def text_cells(self,rows,cols):
+        """Boolean (rows, cols) array of the cells drawn as text, the rest are map tiles."""
+        text = np.ones((rows,cols),dtype=bool)
+        text[:18,:38] = False
+        return text
+
+    def gather_tiles(self,cells,text):
+        """
+        Get the tiles of a 1-D CELL_DTYPE array at once.
+
+        The map tiles and the distinct text tiles among the cells are stacked into one
+        atlas and gathered with the tile id of every cell.
+
+        :param cells: Cells to draw.
+        :param text: Boolean array marking the cells drawn as text.
+        :return: (len(cells), 32, 32, 3) uint8 array.
+        """
+        ids = self.cell_tile_ids(cells).astype(np.intp)
+        keys = (cells['char'].astype(np.uint64) << 16) | (cells['fg'].astype(np.uint64) << 8) | cells['bg']
+        distinct, inverse = np.unique(keys[text],return_inverse=True)
+        text_tiles = [self.get_char_tile(Colors(int(key >> 8 & 0xff)),Colors(int(key & 0xff)),chr(int(key >> 16)))
+                      for key in distinct]
+        #get_char_tile() counted one lookup per distinct text tile, its other cells are hits as in write_tile()
+        self.glyph_hits += len(inverse) - len(distinct)
+        self.map_lookups += len(cells) - len(inverse)
+        atlas = np.concatenate((self.tiles,np.stack(text_tiles))) if text_tiles else self.tiles
+        ids[text] = len(self.tiles) + inverse
+        return atlas[ids]
+
+    def render_frame(self,cells):
+        """Compose png_array from a (rows, cols) CELL_DTYPE screen without a loop over the cells."""
+        rows, cols = cells.shape
+        tiles = self.gather_tiles(cells.ravel(),self.text_cells(rows,cols).ravel())
+        self.png_array = tiles.reshape(rows,cols,self.TILESIZE,self.TILESIZE,self.DATASIZE).transpose(0,2,1,3,4).reshape(
+            rows*self.TILESIZE,cols*self.TILESIZE,self.DATASIZE)
+        self.previous_cells = cells.copy()
+
+    def render_changes(self,cells):
+        """
+        Bring png_array up to date with a screen, re-stamping only the cells that differ
+        from the screen of the previous render_frame() or render_changes().
+
+        :param cells: (rows, cols) CELL_DTYPE screen.
+        :return: Number of cells stamped.
+        """
+        if self.previous_cells is None or self.previous_cells.shape != cells.shape:
+            self.render_frame(cells)
+            return cells.size
+        rows, cols = cells.shape
+        ys, xs = np.nonzero(cells != self.previous_cells)
+        if len(ys):
+            tiles = self.gather_tiles(cells[ys,xs],self.text_cells(rows,cols)[ys,xs])
+            #Tile (y, x) of the image is view[y,:,x]
+            view = self.png_array.reshape(rows,self.TILESIZE,cols,self.TILESIZE,self.DATASIZE)
+            view[ys,:,xs] = tiles
+            self.previous_cells[ys,xs] = cells[ys,xs]
+        return len(ys)
+
     def write_tile(self,y,x,fg,bg,char):
         r = y*self.TILESIZE
         c = x*self.TILESIZE
         if(x<38 and y < 18):
-            image = self.construct_tile(y,x,fg,bg,char)
-            #Stamps the 32x32x3 tile to the final png_array
-            self.png_array[r:r+image.shape[0], c:c+image.shape[1],:] = image.astype(np.uint8)
+            self.map_lookups += 1
+            image = self.tiles[self.tile_id(fg,bg,char)]
         else:
-            image = self.construct_char_tile(y,x,fg,bg,char)
-            self.png_array[r:r+image.shape[0], c:c+image.shape[1],:] = image.astype(np.uint8)
-
-def process_frame(f):
-    fc = FrameConstructor(TILESIZE=32,DISPLAY_Y_SIZE=29,DISPLAY_X_SIZE=81,DATASIZE=3)
-    print(f)
-    fc.clear_png_array()
+            image = self.get_char_tile(fg,bg,char)
+        #Stamps the 32x32x3 tile to the final png_array
+        self.png_array[r:r+image.shape[0], c:c+image.shape[1],:] = image
+
+def render_cells(fc,cells,incremental=False):
+    """
+    Compose fc.png_array from a (rows, cols) CELL_DTYPE array.
+
+    :param incremental: Only re-stamp the cells changed since the previous screen of fc.
+    :return: Number of cells stamped.
+    """
+    if incremental:
+        return fc.render_changes(cells)
+    fc.render_frame(cells)
+    return cells.size
+
+def write_cells(fc,cells):
+    """Stamp every cell of a (rows, cols) CELL_DTYPE array onto fc.png_array one write_tile() at a time."""
+    chars = cells['char'].tolist()
+    fgs = cells['fg'].tolist()
+    bgs = cells['bg'].tolist()
+    for y in range(0,cells.shape[0]):
+        for x in range(0,cells.shape[1]):
+            fc.write_tile(y,x,Colors(fgs[y][x]),Colors(bgs[y][x]),chr(chars[y][x]))
+
+def save_png(fc,path):
+    img = png.from_array(fc.png_array.reshape(fc.TILESIZE*fc.DISPLAY_Y_SIZE,fc.TILESIZE*fc.DISPLAY_X_SIZE*fc.DATASIZE),"RGB")
+    img.save(path)
+
+def png_chunk(kind,data):
+    return struct.pack('>I',len(data)) + kind + data + struct.pack('>I',zlib.crc32(kind + data))
+
+def png_data(image,level=6):
+    """
+    Compress a (height, width, 3) uint8 array to png image data in one zlib call, every
+    row with filter type 0, which compresses tiles and flat colours well.
+    """
+    height, width, _ = image.shape
+    #Each row starts with its filter type byte
+    rows = np.zeros((height,width*3+1),dtype=np.uint8)
+    rows[:,1:] = image.reshape(height,width*3)
+    return zlib.compress(rows.data,level)
+
+def png_header(width,height):
+    """Signature and IHDR chunk of an 8 bit RGB png."""
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR',struct.pack('>IIBBBBB',width,height,8,2,0,0,0))
+
+def write_png(image,path,level=6):
+    """
+    Write a (height, width, 3) uint8 array as an RGB png compressed by png_data().
+
+    :return: Bytes written.
+    """
+    height, width, _ = image.shape
+    data = png_header(width,height) + png_chunk(b'IDAT',png_data(image,level)) + png_chunk(b'IEND',b'')
+    with open(path,'wb') as png_file:
+        png_file.write(data)
+    return len(data)
+
+#Output encoders and the extension of their files, stdout writes no files
+ENCODERS = {"pypng":".png","png":".png","raw":".rgb","stdout":None}
+
+def encode_frame(fc,path,encoder="pypng",level=6,stream=None):
+    """
+    Write fc.png_array with one of ENCODERS.
+
+    :param path: Output path without the extension.
+    :param encoder: pypng: png written by pure Python pypng, png: png compressed by one
+        zlib call at level, raw: headerless rows of RGB bytes, stdout: the raw bytes
+        appended to stream.
+    :param level: zlib compression level 0-9 of the png encoder.
+    :param stream: Binary file the stdout encoder writes to.
+    :return: Tuple (seconds, bytes written).
+    """
+    encode_start = time.perf_counter()
+    if encoder == "pypng":
+        save_png(fc,path + ".png")
+        size = os.path.getsize(path + ".png")
+    elif encoder == "png":
+        size = write_png(fc.png_array,path + ".png",level)
+    elif encoder == "raw":
+        with open(path + ".rgb","wb") as raw_file:
+            raw_file.write(np.ascontiguousarray(fc.png_array).data)
+        size = fc.png_array.nbytes
+    else:
+        stream.write(np.ascontiguousarray(fc.png_array).data)
+        size = fc.png_array.nbytes
+    return time.perf_counter() - encode_start, size
+
+#FrameConstructors of this process by screen size, decoding the sprite sheets takes seconds
+constructors = {}
+#Font of the text tiles and encoder of the frames, set by init_worker()
+font = FONT
+encoder = "pypng"
+level = 6
+#Binary stdout of the stdout encoder
+stream = None
+
+def get_constructor(rows=29,cols=81):
+    if (rows,cols) not in constructors:
+        constructors[(rows,cols)] = FrameConstructor(TILESIZE=32,DISPLAY_Y_SIZE=rows,DISPLAY_X_SIZE=cols,DATASIZE=3,font=font)
+    return constructors[(rows,cols)]
+
+def init_worker(rows=29,cols=81,font_name=FONT,encoder_name="pypng",compress_level=6):
+    """Pool initializer, builds the FrameConstructor of the worker once before its first frame."""
+    global font, encoder, level
+    font = font_name
+    encoder = encoder_name
+    level = compress_level
+    get_constructor(rows,cols)
+
+def frame_stats(fc,frame_start,counts,stamped,encoded):
+    """
+    Tuple (seconds, map tile lookups, glyph cache hits, glyph cache misses, cells stamped, encode seconds,
+    bytes written) of the frame begun at frame_start, counts is fc.tile_counts() at that point and
+    encoded is the result of encode_frame().
+    """
+    return ((time.perf_counter() - frame_start,) + tuple(now - then for now, then in zip(fc.tile_counts(),counts))
+            + (stamped,) + encoded)
+
+def read_csv_cells(f,rows=29,cols=81):
+    """Read a ./data/<frameno>.csv written by ttyplay.py into a (rows, cols) CELL_DTYPE array."""
+    #Cells missing from the csv stay blank
+    cells = np.zeros((rows,cols),dtype=CELL_DTYPE)
+    cells['char'] = ord(' ')
+    cells['fg'] = Colors.WHITE.value
+    cells['bg'] = Colors.BLACK.value
     with open(f,mode='r') as csvfile:
         spamreader = csv.reader(csvfile, delimiter=',', quotechar='"',quoting=csv.QUOTE_MINIMAL)
         for row in spamreader:
             y = int(row[0])
             x = int(row[1])
-            fg = Colors(int(row[2]))
-            bg = Colors(int(row[3]))
-            char = row[4]
-            fc.write_tile(y,x,fg,bg,char)
-        # if not np.array_equal(previous_frame,fc.png_array):
-        img = png.from_array(fc.png_array.reshape(fc.TILESIZE*fc.DISPLAY_Y_SIZE,fc.TILESIZE*fc.DISPLAY_X_SIZE*fc.DATASIZE),"RGB")
-        img.save(str(f).replace('.csv','') + '.png')
+            cells[y,x] = (ord(row[4]),int(row[2]),int(row[3]))
+    return cells
+
+def process_frame(f,incremental=False):
+    """Render ./data/<frameno>.csv to ./data/<frameno>.png (or the file of the encoder), return frame_stats()."""
+    frame_start = time.perf_counter()
+    fc = get_constructor()
+    counts = fc.tile_counts()
+    print(f)
+    stamped = render_cells(fc,read_csv_cells(f,fc.DISPLAY_Y_SIZE,fc.DISPLAY_X_SIZE),incremental)
+    # if not np.array_equal(previous_frame,fc.png_array):
+    encoded = encode_frame(fc,str(f).replace('.csv',''),encoder,level,stream)
+    return frame_stats(fc,frame_start,counts,stamped,encoded)
+
+#Frame stores opened by this process, memory-mapping is cheap but not free
+stores = {}
+
+def get_store(path):
+    if path not in stores:
+        stores[path] = open_store(path)
+    return stores[path]
+
+def process_store_frame(args,incremental=False):
+    """Render the frame at position i of a frame store to <out_dir>/<frameno>.png (or the file of the encoder), return frame_stats()."""
+    frame_start = time.perf_counter()
+    store_path, i, out_dir = args
+    store = get_store(store_path)
+    fc = get_constructor(store.rows,store.cols)
+    counts = fc.tile_counts()
+    frameno = int(store.framenos[i])
+    print(frameno)
+    stamped = render_cells(fc,store.cells(i),incremental)
+    encoded = encode_frame(fc,join(out_dir,str(frameno)),encoder,level,stream)
+    return frame_stats(fc,frame_start,counts,stamped,encoded)
+
+def process_run(args):
+    """Render a run of consecutive frames with work, re-stamping only the cells changed since the frame before, return their frame_stats()."""
+    work, run = args
+    return [work(f,True) for f in run]
 
 
 q = Queue()
@@ -525,50 +512,136 @@ if __name__ ==  '__main__':
     parser.add_argument("-rs", help="specify range frame to run",type=int,default=0)
     parser.add_argument("-re", help="specify range frame to run",type=int,default=0)
     parser.add_argument("-p", help="specify parallel run",action='store_true')
+    parser.add_argument("-store", help="read frames from a frame store written by ttyplay.py -store")
+    parser.add_argument("-o", help="output directory of -store frames",default='./data')
+    parser.add_argument("-font", help="font of the text tiles, a .ttc or .ttf path or name (default: Menlo.ttc, else DejaVuSansMono)",default=FONT)
+    parser.add_argument("-sequential", help="render runs of consecutive frames, re-stamping only the cells that changed",action='store_true')
+    parser.add_argument("-encoder", help="pypng/png: .png files written by pypng or by zlib at -level, raw: headerless RGB .rgb files, stdout: every frame in order as raw RGB on stdout",choices=list(ENCODERS),default="pypng")
+    parser.add_argument("-level", help="zlib compression level 0-9 of -encoder png",type=int,choices=range(10),default=6)
 
     global_args = parser.parse_args()
+    if global_args.encoder == "stdout" and global_args.p:
+        parser.error("-encoder stdout writes frames in order and can't be combined with -p")
+    extension = ENCODERS[global_args.encoder]
+    if global_args.encoder == "stdout":
+        #Frames own stdout, progress goes to stderr
+        stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
 
     q = Queue()
     start = time.time()
 
     mypath = './data'
+    copies = []
+    shape = (29,81)
+    frame_times = []
+
+    if global_args.store:
+        store = open_store(global_args.store)
+        shape = (store.rows,store.cols)
+        framenos = store.framenos
+        positions = np.arange(len(store))
+        #Run Single Frame
+        if global_args.f != 0:
+            positions = positions[framenos == global_args.f]
+        #Run Frame Range
+        elif global_args.rs !=0 and global_args.re !=0:
+            positions = positions[(framenos >= global_args.rs) & (framenos <= global_args.re)]
+        #Render each stored screen once, frames repeating it get a copy of the png.
+        #The stdout stream holds every frame in order, repeated screens are rendered again
+        if extension:
+            rendered = {}
+            for i in positions:
+                slot = int(store.slots[i])
+                if slot in rendered:
+                    copies.append((join(global_args.o,str(framenos[rendered[slot]]) + extension),join(global_args.o,str(framenos[i]) + extension)))
+                else:
+                    rendered[slot] = i
+            positions = rendered.values()
+        work = process_store_frame
+        func_args = [(global_args.store,int(i),global_args.o) for i in positions]
+    else:
+        #Frames repeating an earlier screen have no csv, only a manifest row
+        manifest = read_manifest(mypath)
+        refs = {frameno:source for frameno,_,source in manifest if source != frameno} if manifest else {}
+
+        #Default Run All Frames
+        onlyfiles = [join(mypath,f) for f in listdir(mypath) if isfile(join(mypath, f)) and f.endswith('.csv') and f[:-4].isdigit()]
+        selected = refs.keys()
+
+        #Run Single Frame
+        if global_args.f != 0:
+            onlyfiles = ['./data/'+str(refs.get(global_args.f,global_args.f))+'.csv']
+            selected = [global_args.f] if global_args.f in refs else []
+
+        #Run Frame Range
+        elif global_args.rs !=0 and global_args.re !=0:
+            templist = []
+            for file in onlyfiles:
+                fileno = int(file.replace('./data/','').replace('.csv',''))
+                if fileno >= int(global_args.rs) and fileno<= int(global_args.re):
+                    templist.append('./data/'+str(fileno)+'.csv')
+            selected = [frameno for frameno in refs if global_args.rs <= frameno <= global_args.re]
+            for frameno in selected:
+                if './data/'+str(refs[frameno])+'.csv' not in templist:
+                    templist.append('./data/'+str(refs[frameno])+'.csv')
+            onlyfiles = templist
+
+        if extension:
+            for frameno in selected:
+                copies.append(('./data/'+str(refs[frameno])+extension,'./data/'+str(frameno)+extension))
+        else:
+            #The stream holds every frame in order, repeated screens are rendered again
+            framenos = sorted([int(f.replace('./data/','').replace('.csv','')) for f in onlyfiles] + list(selected))
+            onlyfiles = ['./data/'+str(refs.get(frameno,frameno))+'.csv' for frameno in framenos]
 
-    #Default Run All Frames
-    onlyfiles = [join(mypath,f) for f in listdir(mypath) if isfile(join(mypath, f)) and f.endswith('.csv')]
-    
-    #Run Single Frame
-    if global_args.f != 0:
-        onlyfiles = ['./data/'+str(global_args.f)+'.csv']
-
-    #Run Frame Range
-    elif global_args.rs !=0 and global_args.re !=0:
-        templist = []
-        for file in onlyfiles:
-            fileno = int(file.replace('./data/','').replace('.csv',''))
-            if fileno >= int(global_args.rs) and fileno<= int(global_args.re):
-                templist.append('./data/'+str(fileno)+'.csv')
-        onlyfiles = templist
 
+        print(onlyfiles)
+        work = process_frame
+        func_args = []
 
-    print(onlyfiles)
-    func_args = []
+        #Generate Workload
+        for f in onlyfiles:
+            func_args.append((f))
 
-    #Generate Workload
-    for f in onlyfiles:
-        func_args.append((f))
+    if global_args.sequential:
+        #Consecutive screens differ in a few cells, every worker gets runs of them in frame order
+        if work == process_frame and extension:
+            func_args.sort(key=lambda f: int(f.replace('./data/','').replace('.csv','')))
+        runs = 4 * (os.cpu_count() or 1) if global_args.p else 1
+        size = max(1,-(-len(func_args) // runs))
+        func_args = [(work,func_args[i:i+size]) for i in range(0,len(func_args),size)]
+        work = process_run
 
     if not global_args.p:
         #Single Thread Run
+        init_worker(*shape,global_args.font,global_args.encoder,global_args.level)
         for f in func_args:
-            process_frame(f)
+            result = work(f)
+            frame_times.extend(result if global_args.sequential else [result])
     else:
-        #Multiprocessing Run
-        pool = Pool()
+        #Multiprocessing Run, every worker builds its FrameConstructor once
+        pool = Pool(initializer=init_worker,initargs=shape + (global_args.font,global_args.encoder,global_args.level))
         try:
-            for _ in tqdm.tqdm(pool.imap_unordered(process_frame, func_args), total=len(func_args)):
-                pass
+            for result in tqdm.tqdm(pool.imap_unordered(work, func_args), total=len(func_args)):
+                frame_times.extend(result if global_args.sequential else [result])
         except KeyboardInterrupt:
             # Allow ^C to interrupt from any thread.
             sys.stdout.write('\033[0m')
             sys.stdout.write('User Interupt\n')
         pool.close()
+
+    for src,dst in copies:
+        if isfile(src):
+            shutil.copyfile(src,dst)
+
+    if frame_times:
+        elapsed = time.time() - start
+        seconds, lookups, hits, misses, stamped, encode_seconds, size = (sum(column) for column in zip(*frame_times))
+        print("{} frames rendered in {:.2f}s: {:.1f} frames/s, {} cells stamped ({:.0f} cells/s), {:.1f} ms per frame".format(
+            len(frame_times), elapsed, len(frame_times) / elapsed, stamped, stamped / elapsed, 1000 * seconds / len(frame_times)))
+        print("{} map tile lookups, glyph cache {} hits {} misses ({:.1f}% hits)".format(
+            lookups, hits, misses, 100 * hits / max(hits + misses, 1)))
+        print("encoder {}{}: {:.1f} ms and {:.0f} bytes per frame".format(
+            global_args.encoder, " level {}".format(global_args.level) if global_args.encoder == "png" else "",
+            1000 * encode_seconds / len(frame_times), size / len(frame_times)))
@@ -0,0 +1,602 @@
+import argparse
+import csv
+import os
+import struct
+import sys
+import tempfile
+import time
+from os import listdir
+from os.path import isfile, join
+
+import numpy as np
+
+# Single-file binary store of emulated screens, written by ttyplay.py and read by
+# frame_maker.py instead of one CSV per frame.
+#
+# Layout: a 16 byte header (magic, rows, cols) followed by fixed-size records,
+# one per frame: frame number, timestamp and the screen as three columns of
+# rows x cols cells (codepoints, fg and bg Colors values). Records are
+# appended as frames are saved and the file can be memory-mapped as a numpy
+# array of records.
+#
+# The delta variant stores a full keyframe every N frames and only the changed
+# cells of the frames in between, see DeltaFrameStoreWriter.
+#
+# Screens are stored once: both formats keep a sidecar frame table
+# (<path>.frames) mapping every saved frame to the slot of the stored screen it
+# shows, so a frame repeating an earlier screen costs one table row.
+
+#One screen cell: unicode codepoint, Colors value of foreground and background
+CELL_DTYPE = np.dtype([('char','<u4'),('fg','u1'),('bg','u1')])
+
+def frame_dtype(rows, cols):
+    """
+    :return: numpy dtype of one stored frame of a rows x cols screen.
+    """
+    return np.dtype([('frameno','<u4'),('timestamp','<f8'),
+                     ('char','<u4',(rows,cols)),('fg','u1',(rows,cols)),('bg','u1',(rows,cols))])
+
+def to_cells(record):
+    """
+    :param record: A stored frame record.
+    :return: (rows, cols) array of CELL_DTYPE cells.
+    """
+    cells = np.empty(record['char'].shape, dtype=CELL_DTYPE)
+    cells['char'] = record['char']
+    cells['fg'] = record['fg']
+    cells['bg'] = record['bg']
+    return cells
+
+#One saved frame: frame number, timestamp and the slot of its screen in the store
+FRAME_TABLE_DTYPE = np.dtype([('frameno','<u4'),('timestamp','<f8'),('slot','<u4')])
+
+class FrameTable(object):
+    """
+    Appends FRAME_TABLE_DTYPE rows to the <path>.frames sidecar of a store.
+    """
+    def __init__(self, path, store=None):
+        """
+        :param path: Path of the store.
+        :param store: The store being appended to, None for a new store. Stores
+            written before frame tables existed get one with a row per screen.
+        """
+        self.slots = {}  # frameno -> slot of its screen
+        self.row = np.zeros(1, dtype=FRAME_TABLE_DTYPE)
+        if store is None:
+            self.file = open(path + '.frames', 'wb')
+        else:
+            backfill = not os.path.exists(path + '.frames')
+            self.file = open(path + '.frames', 'ab')
+            for frameno, timestamp, slot in zip(store.framenos.tolist(), store.timestamps.tolist(), store.slots.tolist()):
+                if backfill:
+                    self.append(frameno, timestamp, slot)
+                self.slots[frameno] = slot
+
+    def append(self, frameno, timestamp, slot):
+        row = self.row[0]
+        row['frameno'] = frameno
+        row['timestamp'] = timestamp
+        row['slot'] = slot
+        self.file.write(self.row.tobytes())
+        self.slots[frameno] = slot
+
+    def ref(self, frameno, timestamp, source_frameno):
+        self.append(frameno, timestamp, self.slots[source_frameno])
+
+    def close(self):
+        self.file.close()
+
+def load_frame_table(path, framenos, timestamps):
+    """
+    :param path: Path of the store.
+    :param framenos: Frame numbers of the stored screens, used when there is no table.
+    :param timestamps: Timestamps of the stored screens, used when there is no table.
+    :return: Array of FRAME_TABLE_DTYPE rows, one per saved frame.
+    """
+    table_path = path + '.frames'
+    if os.path.exists(table_path):
+        count = os.path.getsize(table_path) // FRAME_TABLE_DTYPE.itemsize
+        if count > 0:
+            return np.memmap(table_path, dtype=FRAME_TABLE_DTYPE, mode='r', shape=(count,))
+        return np.zeros(0, dtype=FRAME_TABLE_DTYPE)
+    frames = np.zeros(len(framenos), dtype=FRAME_TABLE_DTYPE)
+    frames['frameno'] = framenos
+    frames['timestamp'] = timestamps
+    frames['slot'] = np.arange(len(framenos))
+    return frames
+
+class FrameStoreWriter(object):
+    """
+    Append frames to a frame store file, creating it if needed.
+    """
+    MAGIC = b'DCSSFRM1'
+    HEADER = struct.Struct('<8sII')
+
+    def __init__(self, path, rows=29, cols=81):
+        """
+        :param path: Path of the store.
+        :param rows: Screen height.
+        :param cols: Screen width.
+        """
+        self.path = path
+        self.rows = rows
+        self.cols = cols
+        self.record = np.zeros(1, dtype=frame_dtype(rows, cols))
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            check_header(path, rows, cols)
+            store = FrameStore(path)
+            self.count = store.screen_count
+            self.table = FrameTable(path, store)
+            self.file = open(path, 'ab')
+        else:
+            self.count = 0
+            self.table = FrameTable(path)
+            self.file = open(path, 'wb')
+            self.file.write(self.HEADER.pack(self.MAGIC, rows, cols))
+
+    def write(self, frameno, timestamp, cells):
+        """
+        Append one frame.
+
+        :param frameno: Number of the ttyrec frame the screen was saved after.
+        :param timestamp: ttyrec timestamp of the frame in seconds.
+        :param cells: (rows, cols) array of CELL_DTYPE cells.
+        :return: None
+        """
+        record = self.record[0]
+        record['frameno'] = frameno
+        record['timestamp'] = timestamp
+        record['char'] = cells['char']
+        record['fg'] = cells['fg']
+        record['bg'] = cells['bg']
+        self.file.write(self.record.tobytes())
+        self.table.append(frameno, timestamp, self.count)
+        self.count += 1
+
+    def write_ref(self, frameno, timestamp, source_frameno):
+        """
+        Append a frame showing the same screen as an earlier one.
+
+        :param frameno: Number of the ttyrec frame the screen was saved after.
+        :param timestamp: ttyrec timestamp of the frame in seconds.
+        :param source_frameno: Frame number the screen was first written with.
+        :return: None
+        """
+        self.table.ref(frameno, timestamp, source_frameno)
+
+    def close(self):
+        self.file.close()
+        self.table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def check_header(path, rows=None, cols=None):
+    """
+    Read and validate the header of a frame store.
+
+    :return: Tuple (rows, cols).
+    """
+    with open(path, 'rb') as f:
+        magic, file_rows, file_cols = FrameStoreWriter.HEADER.unpack(f.read(FrameStoreWriter.HEADER.size))
+    if magic != FrameStoreWriter.MAGIC:
+        raise ValueError("{} is not a frame store".format(path))
+    if (rows is not None and rows != file_rows) or (cols is not None and cols != file_cols):
+        raise ValueError("{} holds {}x{} screens".format(path, file_rows, file_cols))
+    return file_rows, file_cols
+
+class FrameStore(object):
+    """
+    Memory-mapped read access to a frame store.
+
+    Frames are addressed by their position in the frame table, several
+    positions can share one stored screen (slot).
+    """
+    def __init__(self, path):
+        """
+        :param path: Path of the store.
+        """
+        self.path = path
+        self.rows, self.cols = check_header(path)
+        dtype = frame_dtype(self.rows, self.cols)
+        count = (os.path.getsize(path) - FrameStoreWriter.HEADER.size) // dtype.itemsize
+        if count > 0:
+            self.records = np.memmap(path, dtype=dtype, mode='r', offset=FrameStoreWriter.HEADER.size, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=dtype)
+        self.frames = load_frame_table(path, self.records['frameno'], self.records['timestamp'])
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def screen_count(self):
+        return len(self.records)
+
+    @property
+    def framenos(self):
+        return self.frames['frameno']
+
+    @property
+    def timestamps(self):
+        return self.frames['timestamp']
+
+    @property
+    def slots(self):
+        return self.frames['slot']
+
+    def screen(self, slot):
+        """
+        :param slot: Position of the screen in the store.
+        :return: (rows, cols) array of CELL_DTYPE cells.
+        """
+        return to_cells(self.records[slot])
+
+    def cells(self, i):
+        """
+        :param i: Position of the frame in the store (not its frame number).
+        :return: (rows, cols) array of CELL_DTYPE cells.
+        """
+        return self.screen(int(self.frames['slot'][i]))
+
+# One per stored frame, key is the position of the keyframe it is rebuilt from
+DELTA_INDEX_DTYPE = np.dtype([('frameno','<u4'),('timestamp','<f8'),('offset','<u8'),('count','<u4'),('key','<u4')])
+
+class DeltaFrameStoreWriter(object):
+    """
+    Append frames to a keyframe + delta frame store, creating it if needed.
+
+    The data file holds a header (magic, rows, cols, keyframe interval) and then
+    per frame either a keyframe (all cells) or a delta against the previous
+    frame (uint16 positions of the changed cells followed by those cells).
+    A sidecar <path>.idx holds one fixed-size DELTA_INDEX_DTYPE record per screen
+    with its offset, so any screen is found directly and rebuilt from its keyframe.
+    """
+    MAGIC = b'DCSSDLT1'
+    HEADER = struct.Struct('<8sIII')
+
+    def __init__(self, path, rows=29, cols=81, keyframe_interval=100):
+        """
+        :param path: Path of the store.
+        :param rows: Screen height.
+        :param cols: Screen width.
+        :param keyframe_interval: A keyframe is written at least every this many frames.
+        """
+        if rows * cols > 0xFFFF:
+            #Delta positions are stored as uint16
+            raise ValueError("delta frame stores hold at most 65535 cells per screen, not {}x{}".format(rows, cols))
+        self.path = path
+        self.rows = rows
+        self.cols = cols
+        self.keyframe_interval = keyframe_interval
+        self.previous = None
+        self.entry = np.zeros(1, dtype=DELTA_INDEX_DTYPE)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # Appending continues from the last frame of the existing store
+            store = DeltaFrameStore(path)
+            if (store.rows, store.cols) != (rows, cols):
+                raise ValueError("{} holds {}x{} screens".format(path, store.rows, store.cols))
+            self.keyframe_interval = store.keyframe_interval
+            self.count = store.screen_count
+            if self.count:
+                self.previous = store.screen(self.count - 1).ravel()
+                self.key = int(store.index['key'][-1])
+            self.table = FrameTable(path, store)
+            self.file = open(path, 'ab')
+            self.index_file = open(path + '.idx', 'ab')
+        else:
+            self.count = 0
+            self.table = FrameTable(path)
+            self.file = open(path, 'wb')
+            self.file.write(self.HEADER.pack(self.MAGIC, rows, cols, keyframe_interval))
+            self.index_file = open(path + '.idx', 'wb')
+
+    def write(self, frameno, timestamp, cells):
+        """
+        Append one frame.
+
+        :param frameno: Number of the ttyrec frame the screen was saved after.
+        :param timestamp: ttyrec timestamp of the frame in seconds.
+        :param cells: (rows, cols) array of CELL_DTYPE cells.
+        :return: None
+        """
+        flat = np.ascontiguousarray(cells).ravel()
+        entry = self.entry[0]
+        entry['frameno'] = frameno
+        entry['timestamp'] = timestamp
+        entry['offset'] = self.file.tell()
+        changed = None
+        if self.previous is not None and self.count - self.key < self.keyframe_interval:
+            changed = np.flatnonzero(flat != self.previous)
+            # A delta costs 2 more bytes per cell than a keyframe
+            if len(changed) * (2 + CELL_DTYPE.itemsize) >= flat.nbytes:
+                changed = None
+        if changed is None:
+            self.key = self.count
+            entry['count'] = len(flat)
+            self.file.write(flat.tobytes())
+        else:
+            entry['count'] = len(changed)
+            self.file.write(changed.astype('<u2').tobytes())
+            self.file.write(flat[changed].tobytes())
+        entry['key'] = self.key
+        self.index_file.write(self.entry.tobytes())
+        self.table.append(frameno, timestamp, self.count)
+        self.previous = flat.copy()
+        self.count += 1
+
+    def write_ref(self, frameno, timestamp, source_frameno):
+        """
+        Append a frame showing the same screen as an earlier one.
+
+        :param frameno: Number of the ttyrec frame the screen was saved after.
+        :param timestamp: ttyrec timestamp of the frame in seconds.
+        :param source_frameno: Frame number the screen was first written with.
+        :return: None
+        """
+        self.table.ref(frameno, timestamp, source_frameno)
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+        self.table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+class DeltaFrameStore(object):
+    """
+    Read access to a keyframe + delta frame store. Same interface as FrameStore.
+
+    Reading a screen applies the deltas from its keyframe up to it, at most
+    keyframe_interval - 1 of them. The last rebuilt screen is kept, so reading
+    frames in order costs one delta each.
+    """
+    def __init__(self, path):
+        """
+        :param path: Path of the store.
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, self.rows, self.cols, self.keyframe_interval = DeltaFrameStoreWriter.HEADER.unpack(
+                f.read(DeltaFrameStoreWriter.HEADER.size))
+        if magic != DeltaFrameStoreWriter.MAGIC:
+            raise ValueError("{} is not a delta frame store".format(path))
+        count = os.path.getsize(path + '.idx') // DELTA_INDEX_DTYPE.itemsize
+        if count > 0:
+            self.index = np.memmap(path + '.idx', dtype=DELTA_INDEX_DTYPE, mode='r', shape=(count,))
+            self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            self.index = np.zeros(0, dtype=DELTA_INDEX_DTYPE)
+        self.frames = load_frame_table(path, self.index['frameno'], self.index['timestamp'])
+        self.cached = None  # (slot, flat cells) of the last rebuilt screen
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def screen_count(self):
+        return len(self.index)
+
+    @property
+    def framenos(self):
+        return self.frames['frameno']
+
+    @property
+    def timestamps(self):
+        return self.frames['timestamp']
+
+    @property
+    def slots(self):
+        return self.frames['slot']
+
+    def apply(self, flat, i):
+        offset = int(self.index['offset'][i])
+        count = int(self.index['count'][i])
+        if i == self.index['key'][i]:
+            flat[:] = np.frombuffer(self.data, dtype=CELL_DTYPE, count=count, offset=offset)
+        else:
+            positions = np.frombuffer(self.data, dtype='<u2', count=count, offset=offset)
+            flat[positions] = np.frombuffer(self.data, dtype=CELL_DTYPE, count=count, offset=offset + 2 * count)
+
+    def screen(self, slot):
+        """
+        :param slot: Position of the screen in the store.
+        :return: (rows, cols) array of CELL_DTYPE cells.
+        """
+        key = int(self.index['key'][slot])
+        if self.cached is not None and key <= self.cached[0] <= slot:
+            start, flat = self.cached[0] + 1, self.cached[1]
+        else:
+            start, flat = key, np.empty(self.rows * self.cols, dtype=CELL_DTYPE)
+        for j in range(start, slot + 1):
+            self.apply(flat, j)
+        self.cached = (slot, flat)
+        return flat.reshape(self.rows, self.cols).copy()
+
+    def cells(self, i):
+        """
+        :param i: Position of the frame in the store (not its frame number).
+        :return: (rows, cols) array of CELL_DTYPE cells.
+        """
+        return self.screen(int(self.frames['slot'][i]))
+
+def open_store(path):
+    """
+    Open a frame store of either format.
+
+    :param path: Path of the store.
+    :return: FrameStore or DeltaFrameStore.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(8)
+    if magic == DeltaFrameStoreWriter.MAGIC:
+        return DeltaFrameStore(path)
+    return FrameStore(path)
+
+def store_size(path):
+    """
+    :return: Bytes on disk of a store, including its frame table and the sidecar index of delta stores.
+    """
+    size = os.path.getsize(path)
+    for sidecar in (path + '.idx', path + '.frames'):
+        if os.path.exists(sidecar):
+            size += os.path.getsize(sidecar)
+    return size
+
+def store_stats(store, samples=200):
+    """
+    Measure the size and read cost of a store.
+
+    :param store: FrameStore or DeltaFrameStore.
+    :param samples: Number of random frames to rebuild.
+    :return: Dict with bytes per frame, size relative to full frames and
+        milliseconds per frame for random and sequential reads.
+    """
+    full_size = len(store) * frame_dtype(store.rows, store.cols).itemsize
+    stats = {
+        'frames': len(store),
+        'screens': store.screen_count,
+        'bytes': store_size(store.path),
+        'bytes_per_frame': store_size(store.path) / max(len(store), 1),
+        'ratio': store_size(store.path) / max(full_size, 1),
+    }
+    if len(store) == 0:
+        return stats
+    positions = np.random.default_rng(0).integers(0, len(store), min(samples, len(store)))
+    start = time.perf_counter()
+    for i in positions:
+        store.cached = None
+        store.cells(int(i))
+    stats['random_ms'] = (time.perf_counter() - start) * 1000 / len(positions)
+    store.cached = None
+    start = time.perf_counter()
+    for i in range(len(store)):
+        store.cells(i)
+    stats['sequential_ms'] = (time.perf_counter() - start) * 1000 / len(store)
+    return stats
+
+def print_stats(name, stats):
+    line = "{:<12} {:>8} frames {:>8} screens {:>12} bytes {:>10.0f} B/frame {:>7.1%} of full".format(
+        name, stats['frames'], stats['screens'], stats['bytes'], stats['bytes_per_frame'], stats['ratio'])
+    if 'random_ms' in stats:
+        line += " {:>8.3f} ms random {:>8.3f} ms sequential".format(stats['random_ms'], stats['sequential_ms'])
+    print(line)
+
+def recode(store, writer):
+    """
+    Copy every frame of store into writer, keeping repeated screens as references.
+    """
+    first = {}  # slot -> frameno it was first written with
+    for i in range(len(store)):
+        frameno, timestamp, slot = int(store.framenos[i]), float(store.timestamps[i]), int(store.slots[i])
+        if slot in first:
+            writer.write_ref(frameno, timestamp, first[slot])
+        else:
+            first[slot] = frameno
+            writer.write(frameno, timestamp, store.screen(slot))
+    writer.close()
+
+#Written next to the <frameno>.csv files, one frameno,timestamp,source_frameno row per saved frame
+MANIFEST_NAME = 'frames.csv'
+
+def read_manifest(csv_dir):
+    """
+    :param csv_dir: Directory holding the CSVs.
+    :return: List of (frameno, timestamp, source_frameno) tuples, source_frameno
+        being the frame whose CSV holds the screen, or None without a manifest.
+    """
+    path = join(csv_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, mode='r') as csvfile:
+        return [(int(row[0]), float(row[1]), int(row[2])) for row in csv.reader(csvfile)]
+
+def convert_csv_dir(csv_dir, path):
+    """
+    Convert a directory of <frameno>.csv files written by ttyplay.py into a frame store.
+    Timestamps and repeated screens come from the manifest, without one the
+    timestamps are stored as NaN.
+
+    :param csv_dir: Directory holding the CSVs.
+    :param path: Path of the store to write.
+    :return: Number of frames converted.
+    """
+    manifest = read_manifest(csv_dir)
+    if manifest is None:
+        framenos = sorted(int(f[:-4]) for f in listdir(csv_dir) if isfile(join(csv_dir, f)) and f.endswith('.csv') and f[:-4].isdigit())
+        manifest = [(frameno, float('nan'), frameno) for frameno in framenos]
+    count = 0
+    writer = None
+    for frameno, timestamp, source_frameno in manifest:
+        if source_frameno != frameno:
+            writer.write_ref(frameno, timestamp, source_frameno)
+            count += 1
+            continue
+        with open(join(csv_dir, str(frameno) + '.csv'), mode='r') as csvfile:
+            rows = [row for row in csv.reader(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)]
+        y = np.array([int(row[0]) for row in rows])
+        x = np.array([int(row[1]) for row in rows])
+        cells = np.empty((y.max() + 1, x.max() + 1), dtype=CELL_DTYPE)
+        cells['char'][y, x] = [ord(row[4]) for row in rows]
+        cells['fg'][y, x] = [int(row[2]) for row in rows]
+        cells['bg'][y, x] = [int(row[3]) for row in rows]
+        if writer is None:
+            writer = FrameStoreWriter(path, cells.shape[0], cells.shape[1])
+        writer.write(frameno, timestamp, cells)
+        count += 1
+    if writer is not None:
+        writer.close()
+    return count
+
+if __name__ ==  '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert", help="convert a ttyplay.py CSV directory into a frame store")
+    convert_parser.add_argument("csv_dir", help="directory of <frameno>.csv files")
+    convert_parser.add_argument("store", help="frame store to write")
+
+    info_parser = subparsers.add_parser("info", help="print the contents of a frame store")
+    info_parser.add_argument("store", help="frame store to read")
+
+    stats_parser = subparsers.add_parser("stats", help="storage size and reconstruction cost of a frame store")
+    stats_parser.add_argument("store", help="frame store to read")
+
+    tune_parser = subparsers.add_parser("tune", help="compare keyframe intervals on the frames of a store")
+    tune_parser.add_argument("store", help="frame store to read")
+    tune_parser.add_argument("-intervals", help="comma separated keyframe intervals",default="1,10,30,100,300")
+
+    global_args = parser.parse_args()
+
+    if global_args.command == "convert":
+        if os.path.exists(global_args.store):
+            print("{} already exists".format(global_args.store), file=sys.stderr)
+            sys.exit(1)
+        print("Converted {} frames".format(convert_csv_dir(global_args.csv_dir, global_args.store)))
+    elif global_args.command == "info":
+        store = open_store(global_args.store)
+        print("{}x{} screens, {} frames, {} unique screens".format(store.rows, store.cols, len(store), store.screen_count))
+        if isinstance(store, DeltaFrameStore):
+            print("keyframe every {} frames, {} keyframes".format(
+                store.keyframe_interval, int((store.index['key'] == np.arange(store.screen_count)).sum())))
+        if len(store):
+            print("frames {}..{}".format(store.framenos[0], store.framenos[-1]))
+    elif global_args.command == "stats":
+        print_stats(os.path.basename(global_args.store), store_stats(open_store(global_args.store)))
+    elif global_args.command == "tune":
+        source = open_store(global_args.store)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = join(tmp, 'full')
+            recode(source, FrameStoreWriter(path, source.rows, source.cols))
+            print_stats("full", store_stats(FrameStore(path)))
+            for interval in global_args.intervals.split(','):
+                path = join(tmp, 'delta' + interval)
+                recode(source, DeltaFrameStoreWriter(path, source.rows, source.cols, int(interval)))
+                print_stats("N=" + interval, store_stats(DeltaFrameStore(path)))
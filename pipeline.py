@@ -0,0 +1,189 @@
+import argparse
+import os
+import queue
+import shutil
+import sys
+import time
+from multiprocessing import Process, Queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from frame_store import CELL_DTYPE
+from frame_maker import FONT, ENCODERS, FrameConstructor, render_cells, encode_frame
+from ttyplay import TtyPlay, convert, print_err
+
+# Renders a ttyrec to pngs in one command, without the ./data/*.csv round trip.
+#
+# The emulator runs in this process and copies every saved screen into a ring of
+# slots in shared memory. Worker processes each keep one FrameConstructor, take
+# slot numbers from a queue, render the screen and hand the slot back. The
+# emulator waits for a free slot, so at most -slots screens are in flight and
+# memory stays bounded however far ahead the emulator is. Frames repeating an
+# earlier screen get a copy of its png once all workers are done.
+#
+#      python3 pipeline.py -path example.ttyrec -o ./frames -p 4
+
+def render_worker(shm_name, slots, rows, cols, out_dir, work, free, font=FONT, encoder="pypng", level=6):
+    """
+    Render the screens named on the work queue until a None arrives.
+
+    :param shm_name: Name of the shared memory holding the slots.
+    :param slots: Number of slots.
+    :param rows: Screen height.
+    :param cols: Screen width.
+    :param out_dir: Directory of the pngs.
+    :param work: Queue of (slot, frameno) tuples.
+    :param free: Queue the slots are returned to once copied out.
+    :param font: Font of the text tiles.
+    :param encoder: File encoder of frame_maker.ENCODERS.
+    :param level: zlib level of the png encoder.
+    :return: None
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ring = np.ndarray((slots, rows, cols), dtype=CELL_DTYPE, buffer=shm.buf)
+    fc = FrameConstructor(TILESIZE=32,DISPLAY_Y_SIZE=rows,DISPLAY_X_SIZE=cols,DATASIZE=3,font=font)
+    try:
+        while True:
+            job = work.get()
+            if job is None:
+                break
+            slot, frameno = job
+            cells = ring[slot].copy()
+            free.put(slot)
+            fc.clear_png_array()
+            render_cells(fc,cells)
+            encode_frame(fc,os.path.join(out_dir,str(frameno)),encoder,level)
+    finally:
+        del ring
+        shm.close()
+
+class RenderWriter(object):
+    """
+    Frame writer rendering every saved screen to <out_dir>/<frameno>.png (or the file of the encoder) on worker processes.
+    """
+    def __init__(self, out_dir, workers=None, slots=None, rows=29, cols=81, font=FONT, encoder="pypng", level=6):
+        """
+        :param out_dir: Directory of the pngs, created if needed.
+        :param workers: Number of render processes, one per core by default.
+        :param slots: Screens in flight at most, four per worker by default.
+        :param rows: Screen height.
+        :param cols: Screen width.
+        :param font: Font of the text tiles.
+        :param encoder: File encoder of frame_maker.ENCODERS.
+        :param level: zlib level of the png encoder.
+        """
+        self.out_dir = out_dir
+        self.extension = ENCODERS[encoder]
+        self.workers = workers or os.cpu_count() or 1
+        self.slots = slots or 4 * self.workers
+        os.makedirs(out_dir, exist_ok=True)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * rows * cols * CELL_DTYPE.itemsize)
+        self.ring = np.ndarray((self.slots, rows, cols), dtype=CELL_DTYPE, buffer=self.shm.buf)
+        self.work = Queue()
+        self.free = Queue()
+        for slot in range(self.slots):
+            self.free.put(slot)
+        self.processes = [Process(target=render_worker, daemon=True,
+                                  args=(self.shm.name, self.slots, rows, cols, out_dir, self.work, self.free, font, encoder, level))
+                          for _ in range(self.workers)]
+        for process in self.processes:
+            process.start()
+        self.rendered = 0
+        self.copies = []
+        self.closed = False
+
+    def write(self, frameno, timestamp, cells):
+        """
+        Queue one screen for rendering, waiting for a free slot.
+
+        :param frameno: Number of the ttyrec frame the screen was saved after.
+        :param timestamp: ttyrec timestamp of the frame in seconds.
+        :param cells: (rows, cols) array of CELL_DTYPE cells.
+        :return: None
+        """
+        while True:
+            try:
+                slot = self.free.get(timeout=1)
+                break
+            except queue.Empty:
+                self.check_workers()
+        self.ring[slot] = cells
+        self.work.put((slot, frameno))
+        self.rendered += 1
+
+    def write_ref(self, frameno, timestamp, source_frameno):
+        """
+        Record a frame showing the same screen as an earlier one, its png is copied on close().
+
+        :param frameno: Number of the ttyrec frame the screen was saved after.
+        :param timestamp: ttyrec timestamp of the frame in seconds.
+        :param source_frameno: Frame number whose png shows the screen.
+        :return: None
+        """
+        self.copies.append((source_frameno, frameno))
+
+    def check_workers(self):
+        for process in self.processes:
+            if process.exitcode not in (None, 0):
+                self.close()
+                raise ChildProcessError("render worker exited with code {}".format(process.exitcode))
+
+    def close(self):
+        """
+        Wait for the workers to render every queued screen, then copy the pngs of repeated screens.
+
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.processes:
+            self.work.put(None)
+        for process in self.processes:
+            process.join()
+        failed = any(process.exitcode != 0 for process in self.processes)
+        del self.ring
+        self.shm.close()
+        self.shm.unlink()
+        if failed:
+            raise ChildProcessError("a render worker failed")
+        for source_frameno, frameno in self.copies:
+            shutil.copyfile(os.path.join(self.out_dir, str(source_frameno) + self.extension),
+                            os.path.join(self.out_dir, str(frameno) + self.extension))
+
+if __name__ ==  '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-path", help="specify path of ttyrec",required=True)
+    parser.add_argument("-o", help="output directory of the pngs",default='./frames')
+    parser.add_argument("-p", help="number of render processes (default: one per core)",type=int)
+    parser.add_argument("-slots", help="screens in flight at most (default: four per render process)",type=int)
+    parser.add_argument("-font", help="font of the text tiles, as in frame_maker.py",default=FONT)
+    parser.add_argument("-encoder", help="file encoder, as in frame_maker.py",choices=[name for name, extension in ENCODERS.items() if extension],default="pypng")
+    parser.add_argument("-level", help="zlib compression level 0-9 of -encoder png",type=int,choices=range(10),default=6)
+    parser.add_argument("-mmap", help="memory-map the ttyrec instead of reading it",action="store_true")
+    parser.add_argument("-fps", help="resample to this many output frames per second from the ttyrec timestamps",type=float,default=0)
+    parser.add_argument("-max-idle", help="with -fps, shorten pauses longer than this many seconds",type=float)
+    global_args = parser.parse_args()
+    if global_args.max_idle is not None and not global_args.fps:
+        parser.error("-max-idle needs -fps")
+
+    start = time.perf_counter()
+    frame_writer = RenderWriter(global_args.o, global_args.p, global_args.slots, font=global_args.font,
+                                encoder=global_args.encoder, level=global_args.level)
+    try:
+        with TtyPlay(global_args.path, use_mmap=global_args.mmap, frame_writer=frame_writer, headless=True) as tp:
+            stats = convert(tp, global_args.fps or None, global_args.max_idle)
+    except ChildProcessError as e:
+        print_err("Rendering failed:")
+        print_err("{0}: {1}".format(type(e).__name__, e))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print_err("User has cancelled rendering")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    #Emulation waits on the renderers, so only the end to end time is meaningful
+    print("{} frames ({} saved): {} images rendered, {} copied in {:.2f}s: {:.1f} saved frames/s".format(
+        stats['frames'], stats['saved'], frame_writer.rendered, len(frame_writer.copies), elapsed,
+        stats['saved'] / max(elapsed, 1e-9)))
@@ -0,0 +1,351 @@
+import argparse
+import copy
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from frame_store import FrameStore, FrameStoreWriter
+from ttyplay import TtyPlay, Cursor, convert, open_frame_writer, open_ttyrec, DecompressingReader
+
+# Emulates one ttyrec on several cores.
+#
+# DCSS redraws the whole screen after a clear (CSI 2J), so the screens after a
+# frame containing one don't depend on what was on the screen before. The file
+# is cut into segments at such frames, each segment is emulated from a fresh
+# display in its own process, and the saved screens are stitched back together.
+# A segment is only valid if everything a clear leaves alone (cursor, colours,
+# margins, half-parsed escape sequences) was also at its initial value in the
+# serial run, that is checked at every boundary and segments that fail it are
+# emulated again from the true state until their output agrees. To keep that
+# short, a segment starts from the state a DCSS redraw leaves: the scroll margins
+# of the last DECSTBM before it (DCSS sets them once per game) and the cursor home.
+#
+#      python3 segments.py -path game.ttyrec -jobs 8 -store game.fs
+#      python3 segments.py -path game.ttyrec -jobs 8 -verify
+
+CLEAR_SCREEN = b'\x1b[2J'
+SET_MARGINS = re.compile(rb'\x1b\[[0-9;]*r')
+#Fed to the fresh display of every segment but the first, after its margins
+SEGMENT_START = b'\x1b[H'
+
+def scan_frames(path):
+    """
+    Walk the headers of an uncompressed ttyrec and find the frames clearing the screen.
+
+    :param path: Path of the ttyrec.
+    :return: Tuple (headers, clears, margins): structured array of the offset,
+        seconds and useconds of every frame, the sorted 1-based numbers of the
+        frames containing CSI 2J, and a list of (file offset, sequence) of every
+        DECSTBM (CSI r) in file order.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return np.zeros(0, dtype=[('offset','<u8'),('seconds','<u4'),('useconds','<u4')]), np.zeros(0, dtype=int), []
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            headers = []
+            offset = 0
+            while offset + 12 <= len(data):
+                seconds, useconds, length = struct.unpack_from('<III', data, offset)
+                headers.append((offset, seconds, useconds))
+                offset += 12 + length
+            headers = np.array(headers, dtype=[('offset','<u8'),('seconds','<u4'),('useconds','<u4')])
+            positions = []
+            position = data.find(CLEAR_SCREEN)
+            while position != -1:
+                positions.append(position)
+                position = data.find(CLEAR_SCREEN, position + len(CLEAR_SCREEN))
+            margins = [(match.start(), match.group()) for match in SET_MARGINS.finditer(data)]
+            size = len(data)
+        finally:
+            data.close()
+    clears = in_payload(headers, size, positions, len(CLEAR_SCREEN))
+    clears = np.unique(clears[clears > 0])
+    margin_positions = [position for position, _ in margins]
+    frame_margins = in_payload(headers, size, margin_positions, [len(sequence) for _, sequence in margins])
+    return headers, clears, [margin for margin, frameno in zip(margins, frame_margins) if frameno]
+
+def in_payload(headers, size, positions, lengths):
+    """
+    :param headers: Frame headers of scan_frames().
+    :param size: File size.
+    :param positions: File offsets of byte string matches.
+    :param lengths: Length of each match, or one length for all.
+    :return: Array of the 1-based frame number of each match, 0 for a match
+        overlapping a header. Those are not sequences, and one spanning two
+        frames is missed.
+    """
+    positions = np.array(positions, dtype=np.int64)
+    framenos = np.searchsorted(headers['offset'], positions, side='right')
+    starts = headers['offset'].astype(np.int64)
+    ends = np.append(starts[1:], size)
+    inside = (positions >= starts[framenos - 1] + 12) & (positions + lengths <= ends[framenos - 1])
+    return np.where(inside, framenos, 0)
+
+def segment_setup(margins, offset):
+    """
+    :param margins: (file offset, sequence) list of scan_frames().
+    :param offset: File offset of the first frame of a segment.
+    :return: Bytes fed to the fresh display of the segment: the last DECSTBM
+        before it and SEGMENT_START.
+    """
+    before = [sequence for position, sequence in margins if position < offset]
+    return (before[-1] if before else b'') + SEGMENT_START
+
+def plan_segments(headers, clears, count):
+    """
+    Pick segment boundaries among the clearing frames, aiming for count segments
+    of about the same number of bytes.
+
+    :return: List of (first frame, last frame) tuples.
+    """
+    total = len(headers)
+    if total == 0:
+        return []
+    size = int(headers['offset'][-1]) + 1
+    starts = [1]
+    for k in range(1, count):
+        target = np.searchsorted(headers['offset'], size * k // count) + 1
+        i = np.searchsorted(clears, target)
+        if i < len(clears) and clears[i] > starts[-1]:
+            starts.append(int(clears[i]))
+    return [(first, (starts[k + 1] - 1) if k + 1 < len(starts) else total) for k, first in enumerate(starts)]
+
+def output_clock(headers, frameno, speed, max_idle):
+    """
+    :return: Output time of frame frameno on a Resampler timeline starting at frame 1.
+    """
+    delays = (np.diff(headers['seconds'][:frameno].astype(np.int64)) +
+              np.diff(headers['useconds'][:frameno].astype(np.int64)) / 1000000.0) / speed
+    if max_idle is not None:
+        delays = np.minimum(delays, max_idle)
+    return float(delays.sum())
+
+def carried_state(state):
+    """
+    :param state: TtyPlay.checkpoint_state() dict.
+    :return: The part of the state a full screen clear does not reset.
+    """
+    display = {}
+    for name, value in vars(state['display']).items():
+        if name == 'screen':
+            continue
+        display[name] = vars(value) if isinstance(value, Cursor) else value
+    parser = dict(state['parser'])
+    if parser['state'] not in ('CSI_PARAM', 'CSI_INTERMEDIATE'):
+        #Leftovers of the last sequence, the next one starts over
+        del parser['params'], parser['private'], parser['intermediates']
+    return display, parser
+
+#Per saved frame of a segment: ttyrec frame, fingerprint after it and saved frames so far
+FINGERPRINT_DTYPE = np.dtype([('frameno','<u4'),('digest','S16'),('saved','<u4')])
+
+def fingerprint(tp):
+    """
+    :return: Digest of the screen and the carried state of tp. Right after
+        save_frame() the last saved screen equals the screen, so equal
+        fingerprints mean equal output from then on.
+    """
+    digest = hashlib.blake2b(tp.display.screen.snapshot().tobytes(), digest_size=16)
+    digest.update(repr(carried_state(tp.checkpoint_state())).encode())
+    return digest.digest()
+
+def emulate_segment(job):
+    """
+    Emulate the frames of one segment into a frame store, run in a pool worker.
+
+    :param job: Tuple (path, first frame, last frame, store path, state, setup,
+        fps, max_idle, clock, offset of first, (seconds, useconds) of the frame
+        before first and of frame 1, reference). state is a TtyPlay.checkpoint_state()
+        of the frame before first, or None to start from a fresh display that
+        the bytes of setup are fed to.
+        reference is None or the fingerprints of an earlier run of the segment,
+        emulation then stops as soon as it converges with that run.
+    :return: Dict with the store path, the checkpoint_state() of the fresh start
+        and of the end of the segment, the fingerprints of every saved frame,
+        the reference position it converged at (or None) and the
+        ttyplay.convert() stats.
+    """
+    path, first, last, store_path, state, setup, fps, max_idle, clock, offset, previous_header, first_header, reference = job
+    for stale in (store_path, store_path + '.frames'):
+        if os.path.exists(stale):
+            os.remove(stale)
+    fingerprints = []
+    converged = []
+
+    def after_save(tp):
+        digest = fingerprint(tp)
+        if reference is not None:
+            i = np.searchsorted(reference['frameno'], tp.frameno)
+            if i < len(reference) and reference['frameno'][i] == tp.frameno and reference['digest'][i] == digest:
+                converged.append(i)
+                return True
+        fingerprints.append((tp.frameno, digest, tp.saved_frames))
+        return False
+
+    with TtyPlay(path, frame_writer=FrameStoreWriter(store_path), headless=True) as tp:
+        start_state = None
+        if state is None:
+            tp.parser.feed(setup)
+            start_state = dict(tp.checkpoint_state(), offset=offset, frameno=first - 1,
+                               first_header=first_header, seconds=previous_header[0],
+                               useconds=previous_header[1], length=0, duration=0.0)
+            state = copy.deepcopy(start_state)
+        tp.restore_checkpoint(state)
+        stats = convert(tp, fps, max_idle, last_frame=last, clock=clock, after_save=after_save)
+        end_state = tp.checkpoint_state()
+    return {'store': store_path, 'start_state': start_state, 'end_state': end_state,
+            'fingerprints': np.array(fingerprints, dtype=FINGERPRINT_DTYPE),
+            'converged': converged[0] if converged else None, 'stats': stats}
+
+def stitch(parts, frame_writer):
+    """
+    Copy the frames of the segment stores into one writer, dropping screens equal
+    to the previously saved one and referencing repeats of earlier ones, as
+    TtyPlay.save_frame() does in a serial run.
+
+    :param parts: List of (store path, first position, end position or None) in file order.
+    :param frame_writer: Writer of the final output.
+    :return: Number of frames written.
+    """
+    previous = None
+    screens = {}
+    saved = 0
+    for path, begin, end in parts:
+        store = FrameStore(path)
+        for i in range(begin, len(store) if end is None else end):
+            cells = store.cells(i)
+            if previous is not None and np.array_equal(previous, cells):
+                continue
+            frameno, timestamp = int(store.framenos[i]), float(store.timestamps[i])
+            digest = hashlib.blake2b(cells.tobytes(), digest_size=16).digest()
+            if digest in screens:
+                frame_writer.write_ref(frameno, timestamp, screens[digest])
+            else:
+                screens[digest] = frameno
+                frame_writer.write(frameno, timestamp, cells)
+            previous = cells
+            saved += 1
+    frame_writer.close()
+    return saved
+
+def convert_parallel(path, frame_writer, jobs, segments_per_job=4, fps=None, max_idle=None, tmp_dir=None):
+    """
+    Emulate a ttyrec in parallel segments and write its frames like a serial run.
+
+    :param path: Path of an uncompressed ttyrec.
+    :param frame_writer: Writer of the output.
+    :param jobs: Number of worker processes.
+    :param segments_per_job: Segments planned per worker, more balance the load better.
+    :param fps: Resample as ttyplay.convert() does.
+    :param max_idle: Longest pause kept when resampling.
+    :param tmp_dir: Directory for the segment stores, a temporary one by default.
+    :return: Dict with the segment count, repaired segments, frames emulated
+        again by repairs, frames read, frames saved, payload bytes and elapsed seconds.
+    """
+    start = time.perf_counter()
+    headers, clears, margins = scan_frames(path)
+    plan = plan_segments(headers, clears, jobs * segments_per_job)
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        segment_jobs = []
+        for k, (first, last) in enumerate(plan):
+            previous = headers[first - 2] if first > 1 else headers[0]
+            clock = output_clock(headers, first, 1.0, max_idle) if fps else 0.0
+            setup = segment_setup(margins, int(headers[first - 1]['offset'])) if k else b''
+            segment_jobs.append((path, first, last, os.path.join(tmp, 'segment{}'.format(k)), None, setup, fps, max_idle,
+                                 clock, int(headers[first - 1]['offset']),
+                                 (int(previous['seconds']), int(previous['useconds'])),
+                                 (int(headers[0]['seconds']), int(headers[0]['useconds'])), None))
+        with Pool(jobs) as pool:
+            results = pool.map(emulate_segment, segment_jobs)
+
+        #Serial repair: a segment that started from a state differing from the end
+        #of the one before is emulated again from that end until both runs agree
+        parts = [(results[0]['store'], 0, None)] if results else []
+        repaired = 0
+        repeated = 0
+        for k in range(1, len(results)):
+            true_state = results[k - 1]['end_state']
+            if carried_state(true_state) == carried_state(results[k]['start_state']):
+                parts.append((results[k]['store'], 0, None))
+                continue
+            job = segment_jobs[k]
+            repair = emulate_segment(job[:3] + (job[3] + 'r', true_state) + job[5:12] + (results[k]['fingerprints'],))
+            repaired += 1
+            repeated += repair['stats']['frames']
+            parts.append((repair['store'], 0, None))
+            if repair['converged'] is None:
+                results[k] = dict(repair, stats=results[k]['stats'])
+            else:
+                parts.append((results[k]['store'], int(results[k]['fingerprints']['saved'][repair['converged']]), None))
+        saved = stitch(parts, frame_writer)
+    return {'segments': len(results), 'repaired': repaired, 'repeated': repeated,
+            'frames': sum(result['stats']['frames'] for result in results),
+            'bytes': sum(result['stats']['bytes'] for result in results),
+            'saved': saved, 'seconds': time.perf_counter() - start}
+
+def compare_stores(expected_path, actual_path):
+    """
+    :return: List of positions at which two frame stores differ, in frame
+        number, timestamp or screen. A length difference counts from the end of
+        the shorter one.
+    """
+    expected = FrameStore(expected_path)
+    actual = FrameStore(actual_path)
+    mismatches = []
+    for i in range(min(len(expected), len(actual))):
+        if (expected.framenos[i] != actual.framenos[i] or expected.timestamps[i] != actual.timestamps[i]
+                or not np.array_equal(expected.cells(i), actual.cells(i))):
+            mismatches.append(i)
+    mismatches.extend(range(min(len(expected), len(actual)), max(len(expected), len(actual))))
+    return mismatches
+
+if __name__ ==  '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-path", help="specify path of an uncompressed ttyrec",required=True)
+    parser.add_argument("-jobs", help="number of worker processes (default: one per core)",type=int,default=os.cpu_count())
+    parser.add_argument("-store", help="write frames to this binary frame store instead of ./data/*.csv")
+    parser.add_argument("-keyframe-interval", help="write -store as keyframes every N frames + deltas",type=int,default=0)
+    parser.add_argument("-fps", help="resample to this many output frames per second",type=float,default=0)
+    parser.add_argument("-max-idle", help="with -fps, shorten pauses longer than this many seconds",type=float)
+    parser.add_argument("-verify", help="also run serially and compare every saved frame",action="store_true")
+    global_args = parser.parse_args()
+
+    reader = open_ttyrec(global_args.path)
+    reader.close()
+    if isinstance(reader, DecompressingReader):
+        parser.error("segments need random access, decompress the ttyrec first")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if global_args.verify:
+            parallel_path = os.path.join(tmp, 'parallel.fs')
+            frame_writer = FrameStoreWriter(parallel_path)
+        else:
+            frame_writer = open_frame_writer(global_args.store, global_args.keyframe_interval)
+        stats = convert_parallel(global_args.path, frame_writer, global_args.jobs,
+                                 fps=global_args.fps or None, max_idle=global_args.max_idle)
+        seconds = max(stats['seconds'], 1e-9)
+        print("{} segments ({} repaired, {} frames emulated again), {} frames ({} saved), {} bytes in {:.2f}s: {:.0f} frames/s, {:.2f} MB/s".format(
+            stats['segments'], stats['repaired'], stats['repeated'], stats['frames'], stats['saved'], stats['bytes'],
+            stats['seconds'], stats['frames'] / seconds, stats['bytes'] / seconds / 1e6))
+
+        if global_args.verify:
+            serial_path = os.path.join(tmp, 'serial.fs')
+            with TtyPlay(global_args.path, frame_writer=FrameStoreWriter(serial_path), headless=True) as tp:
+                serial = convert(tp, global_args.fps or None, global_args.max_idle)
+            print("serial: {} frames ({} saved) in {:.2f}s: {:.0f} frames/s, {:.1f}x speedup".format(
+                serial['frames'], serial['saved'], serial['seconds'], serial['frames'] / max(serial['seconds'], 1e-9),
+                serial['seconds'] / seconds))
+            mismatches = compare_stores(serial_path, parallel_path)
+            if mismatches:
+                print("MISMATCH at {} saved frames, first at position {}".format(len(mismatches), mismatches[0]))
+                sys.exit(1)
+            print("parallel output matches the serial run")
@@ -0,0 +1,84 @@
+import pytest
+
+from ttyplay import Display, VTParser, Screen, ArrayScreen, Colors
+
+# Feeds fixed byte strings through VTParser and checks the emulated screen.
+#
+#      python3 -m pytest test_vtparser.py
+
+def emulate(*chunks, screen_class=ArrayScreen):
+    """
+    :param chunks: Frame payloads fed one after the other.
+    :param screen_class: Screen implementation of the Display.
+    :return: The Display after the last chunk.
+    """
+    display = Display(screen_class)
+    parser = VTParser(display)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return display
+
+def row_text(display, y):
+    return ''.join(display.screen.tile(y, x).char for x in range(display.x_size)).rstrip()
+
+def screen_text(display):
+    return [row_text(display, y) for y in range(display.y_size)]
+
+@pytest.mark.parametrize("screen_class", [Screen, ArrayScreen])
+@pytest.mark.parametrize("split", range(1, len(b'\x1b[1;33mx\x1b[5;7Hy')))
+def test_split_csi(screen_class, split):
+    data = b'\x1b[1;33mx\x1b[5;7Hy'
+    whole = emulate(data, screen_class=screen_class)
+    parts = emulate(data[:split], data[split:], screen_class=screen_class)
+    assert screen_text(parts) == screen_text(whole)
+    assert parts.screen.tile(5, 7).char == 'y'
+    assert parts.screen.tile(0, 0).fgcolor == Colors.BRIGHTYELLOW
+    assert (parts.cursor.x, parts.cursor.y) == (whole.cursor.x, whole.cursor.y)
+
+@pytest.mark.parametrize("split", [1, 2])
+def test_split_utf8(split):
+    data = '\x1b[2;1H†≈♣ok'.encode()
+    cut = len(b'\x1b[2;1H') + split
+    display = emulate(data[:cut], data[cut:])
+    assert row_text(display, 2) == ' †≈♣ok'
+
+def test_utf8_cut_off_before_escape():
+    display = emulate(b'\x1b[2;1Ha\xe2\x80', b'\x1b[3;1Hb')
+    assert row_text(display, 2) == ' a�'
+    assert row_text(display, 3) == ' b'
+
+@pytest.mark.parametrize("reset", [b'\x1b[r', b'\x1b[0;0r', b'\x1b[;r'])
+def test_margin_reset(reset):
+    display = emulate(b'\x1b[5;10r' + reset)
+    fresh = Display()
+    assert (display.top_margin, display.bottom_margin) == (fresh.top_margin, fresh.bottom_margin) == (1, 28)
+
+def test_margin_reset_scrolls_at_bottom():
+    display = emulate(b'\x1b[1;24r\x1b[r\x1b[28;1Hline1\r\nline2\r\nline3')
+    assert screen_text(display)[26:] == [' line1', 'line2', 'line3']
+    assert row_text(display, 0) == ''
+
+def test_top_margin_only():
+    display = emulate(b'\x1b[5r')
+    assert (display.top_margin, display.bottom_margin) == (5, 28)
+
+@pytest.mark.parametrize("screen_class", [Screen, ArrayScreen])
+def test_out_of_range_cup(screen_class):
+    display = emulate(b'\x1b[40;1Hx\x1b[5;200Hy', screen_class=screen_class)
+    assert display.screen.tile(5, display.x_size - 1).char == 'y'
+    assert 'x' in ''.join(screen_text(display))
+    assert 0 <= display.cursor.y < display.y_size
+
+def test_out_of_range_vpa():
+    display = emulate(b'\x1b[50dz')
+    assert display.cursor.y == display.y_size - 1
+
+@pytest.mark.parametrize("screen_class", [Screen, ArrayScreen])
+def test_backspace_at_column_0(screen_class):
+    display = emulate(b'\x1b[3;1Habc\r\x08Z', screen_class=screen_class)
+    assert row_text(display, 3) == 'Zabc'
+    assert (display.cursor.x, display.cursor.y) == (1, 3)
+
+def test_backspace():
+    display = emulate(b'\x1b[3;1Habc\x08\x08Z')
+    assert row_text(display, 3) == ' aZ'
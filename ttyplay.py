@@ -10,14 +10,29 @@ import argparse
 from multiprocessing import Process, Pool, Array, Lock, Value
 from PIL import Image
 import csv
+import os
+import re
+import math
+import hashlib
+import pickle
+import codecs
+import mmap
+import bz2
+import gzip
+import lzma
+import queue
+import threading
+from frame_store import CELL_DTYPE, MANIFEST_NAME, FrameStoreWriter, DeltaFrameStoreWriter
 
 # https://www.utf8-chartable.de/unicode-utf8-table.pl
 # https://chromium.googlesource.com/apps/libapps/+/a5fb83c190aa9d74f4a9bca233dac6be2664e9e9/hterm/doc/ControlSequences.md#SCS
 # https://en.wikipedia.org/wiki/ASCII
 # https://en.wikipedia.org/wiki/ANSI_escape_code
 
+global_args = None
+
 def verbose_print(a):
-    if global_args.verbose:
+    if global_args is not None and global_args.verbose:
         print(a)
 
 def print_err(*args, **kwargs):
@@ -113,76 +128,192 @@ class Tile:
   def get_bg_color(self):
     return self.get_rgb(self.bgcolor)
 
-class Screen:
+class DamageTracking:
+  """
+  Per-cell dirty mask of a screen, set by every write and cleared by
+  reset_damage(), so consumers can restrict work to what changed.
+  """
+  def reset_damage(self):
+    self.dirty = np.zeros((self.y_size,self.x_size),dtype=bool)
+
+  def mark_cells(self,row,start,end):
+    if start < 0:
+      #Negative columns wrap around like list indices
+      self.dirty[row,np.arange(start,end)] = True
+    else:
+      self.dirty[row,start:end] = True
+
+  def mark_rows(self,start,end):
+    self.dirty[max(start,0):end] = True
+
+  def dirty_rows(self):
+    return np.flatnonzero(self.dirty.any(axis=1))
+
+class Screen(DamageTracking):
   def __init__(self,x_size,y_size):
     self.tiles = [x[:] for x in [[Tile(Colors.WHITE,Colors.BLACK,' ')] * x_size] * y_size] 
     self.x_size = x_size
     self.y_size = y_size
+    self.reset_damage()
     self.clear()
 
   def clear(self):
     for x in range(0,self.x_size):
       for y in range(0,self.y_size):
         self.tiles[y][x] = Tile(Colors.WHITE,Colors.BLACK,' ')
+    self.mark_rows(0,self.y_size)
 
   def clear_line(self,row,start,end):
     for x in range(start,end):
       self.tiles[row][x] = Tile(Colors.WHITE,Colors.BLACK,' ')
+    self.mark_cells(row,start,end)
+
+  def clear_rows(self,start,end):
+    for y in range(start,end):
+      self.clear_line(y,0,self.x_size)
+
+  def shift_rows_up(self,start_y,end_y):
+    #Rows start_y+1..end_y move one up, row end_y keeps its content
+    for y in range(start_y,end_y):
+      self.tiles[y] = self.tiles[y+1][:]
+    self.mark_rows(start_y,end_y)
+
+  def shift_rows_down(self,start_y,end_y):
+    #Rows start_y..end_y-1 move one down, row start_y keeps its content
+    for y in range(end_y,start_y,-1):
+      self.tiles[y] = self.tiles[y-1][:]
+    self.mark_rows(start_y+1,end_y+1)
 
   def type(self,x,y,ch,fg,bg):
     self.tiles[y][x] = Tile(fg,bg,ch)
+    self.dirty[y,x] = True
+
+  def type_run(self,x,y,text,fg,bg):
+    #text must fit in the row
+    self.tiles[y][x:x+len(text)] = [Tile(fg,bg,ch) for ch in text]
+    self.dirty[y,x:x+len(text)] = True
+
+  def tile(self,y,x):
+    return self.tiles[y][x]
+
+  def snapshot(self):
+    cells = np.empty((self.y_size,self.x_size),dtype=CELL_DTYPE)
+    for y in range(0,self.y_size):
+      cells[y] = [(ord(t.char),t.fgcolor.value,t.bgcolor.value) for t in self.tiles[y]]
+    return cells
+
+BLANK_CELL = (ord(' '),Colors.WHITE.value,Colors.BLACK.value)
+
+class ArrayScreen(DamageTracking):
+  """
+  Screen kept in one (y_size, x_size) array of CELL_DTYPE cells instead of
+  Tile objects, so clears and scrolls are slice assignments and a snapshot
+  is a single copy(). Same interface as Screen.
+  """
+  def __init__(self,x_size,y_size):
+    self.x_size = x_size
+    self.y_size = y_size
+    self.cells = np.empty((y_size,x_size),dtype=CELL_DTYPE)
+    self.reset_damage()
+    self.clear()
+
+  def clear(self):
+    self.cells[...] = BLANK_CELL
+    self.dirty[...] = True
+
+  def clear_line(self,row,start,end):
+    if start < 0:
+      #Negative columns wrap around like list indices
+      self.cells[row,np.arange(start,end)] = BLANK_CELL
+    else:
+      self.cells[row,start:end] = BLANK_CELL
+    self.mark_cells(row,start,end)
+
+  def clear_rows(self,start,end):
+    self.cells[start:end] = BLANK_CELL
+    self.mark_rows(start,end)
+
+  def shift_rows_up(self,start_y,end_y):
+    if end_y > start_y:
+      self.cells[start_y:end_y] = self.cells[start_y+1:end_y+1]
+      self.mark_rows(start_y,end_y)
+
+  def shift_rows_down(self,start_y,end_y):
+    if end_y > start_y:
+      self.cells[start_y+1:end_y+1] = self.cells[start_y:end_y]
+      self.mark_rows(start_y+1,end_y+1)
+
+  def type(self,x,y,ch,fg,bg):
+    self.cells[y,x] = (ord(ch),fg.value,bg.value)
+    self.dirty[y,x] = True
+
+  def type_run(self,x,y,text,fg,bg):
+    #text must fit in the row
+    end = x + len(text)
+    self.cells['char'][y,x:end] = np.frombuffer(text.encode('utf-32-le'),dtype='<u4')
+    self.cells['fg'][y,x:end] = fg.value
+    self.cells['bg'][y,x:end] = bg.value
+    self.dirty[y,x:end] = True
+
+  def tile(self,y,x):
+    char, fg, bg = self.cells[y,x].tolist()
+    return Tile(Colors(fg),Colors(bg),chr(char))
+
+  def snapshot(self):
+    return self.cells.copy()
 
 class Display(object):
-  def __init__(self):
+  def __init__(self,screen_class=ArrayScreen):
     x = 81
     y = 29
     self.cursor = Cursor(0,0,x,y) 
-    self.screen = Screen(x,y)
+    self.screen = screen_class(x,y)
     self.x_size = x
     self.y_size = y
     self.fg = Colors.WHITE
     self.bg = Colors.BLACK
     self.default_fg = Colors.WHITE
     self.default_bg = Colors.BLACK
+    #Rows are indexed by the terminal's 1-based row number as sent in CUP and DECSTBM,
+    #so row 0 of the screen is never addressed and the last row is y_size-1
     self.top_margin = 1
-    self.bottom_margin = 24
+    self.bottom_margin = y - 1
     self.BRIGHT_MODE = False
 
   def clear_screen(self):
     self.screen.clear()
 
+  def damage(self):
+    #Rows and (y_size, x_size) cell mask written since the last reset_damage()
+    return self.screen.dirty_rows(), self.screen.dirty
+
+  def reset_damage(self):
+    self.screen.reset_damage()
+
   def clear_line(self,row,start,end):
     self.screen.clear_line(row,start,end)
 
   def shift_all_one_row_up(self,start_y,end_y):
-    for x in range(0,self.x_size):
-        for y in range(start_y,end_y):
-            self.screen.tiles[y][x] = self.screen.tiles[y+1][x]
+    self.screen.shift_rows_up(start_y,end_y)
 
   def shift_all_one_row_down(self,start_y,end_y):
-    for x in range(0,self.x_size):
-        for y in range(end_y,start_y,-1):
-            self.screen.tiles[y][x] = self.screen.tiles[y-1][x]
-    for x in range(0,self.x_size):
-        self.screen.tiles[start_y][x] = Tile(Colors.WHITE,Colors.BLACK,' ')
+    self.screen.shift_rows_down(start_y,end_y)
+    self.screen.clear_line(start_y,0,self.x_size)
 
   def handle_scrolling(self):
         #Scrolling
     if self.cursor.y > self.bottom_margin:
         self.shift_all_one_row_up(self.top_margin,self.bottom_margin)
-        for x in range(0,self.x_size):
-            self.screen.tiles[self.bottom_margin][x] = Tile(Colors.WHITE,Colors.BLACK,' ')
+        self.screen.clear_line(self.bottom_margin,0,self.x_size)
         self.cursor.y -= 1
 
   def delete_line(self):
     self.shift_all_one_row_up(self.cursor.y,self.bottom_margin)
-    for x in range(0,self.x_size):
-        self.screen.tiles[self.bottom_margin][x] = Tile(Colors.WHITE,Colors.BLACK,' ')
+    self.screen.clear_line(self.bottom_margin,0,self.x_size)
 
   def CSI_P(self,n):
     #NOTE: SHOULD THIS SHIFT THE LINE OVER?
-    for x in range(self.cursor.x-n,self.cursor.x):
-        self.screen.tiles[self.cursor.y][x] = Tile(Colors.WHITE,Colors.BLACK,' ')
+    self.screen.clear_line(self.cursor.y,self.cursor.x-n,self.cursor.x)
 
   def reverse_line_feed(self):
     self.shift_all_one_row_down(self.top_margin-1,self.bottom_margin)
@@ -199,13 +330,11 @@ class Display(object):
     #Clears part of the screen. .   
     if n == 0:
         self.clear_line(self.cursor.y,self.cursor.x,self.x_size)
-        for y in range(self.cursor.y+1,self.y_size):
-            self.clear_line(y,0,self.x_size)
+        self.screen.clear_rows(self.cursor.y+1,self.y_size)
     # If n is 0 (or missing), clear from cursor to end of screen
     elif n == 1:
         self.clear_line(self.cursor.y,0,self.cursor.x)
-        for y in range(0,self.cursor.y):
-            self.clear_line(y,0,self.x_size)
+        self.screen.clear_rows(0,self.cursor.y)
     # If n is 1, clear from cursor to beginning of the screen.
     elif n == 2 or n == 3:
         self.clear_screen()
@@ -217,14 +346,15 @@ class Display(object):
     if y == 0:
         y = 1
     verbose_print("DOING H (x,y):" + str(x) +','+ str(y))
-    self.cursor.x = x
-    self.cursor.y = y
+    #Taller or wider terminals address cells past the screen, keep the cursor on it
+    self.cursor.x = min(x,self.x_size-1)
+    self.cursor.y = min(y,self.y_size-1)
     self.handle_scrolling()
 
   def CSI_G(self,x):
     # Cursor Position
     verbose_print("DOING G")
-    self.cursor.x = x
+    self.cursor.x = min(x,self.x_size-1)
 
   def CSI_T(self,n):
     # Scroll Down
@@ -248,7 +378,7 @@ class Display(object):
     verbose_print("DOING d" + str(y))
     if y == 0:
         y=1
-    self.cursor.y = y
+    self.cursor.y = min(y,self.y_size-1)
 
   def CSI_r(self,top,bottom):
     self.top_margin = top
@@ -285,6 +415,14 @@ class Display(object):
     # arg1 == 1: Clear start of line to cursor
     # arg1 == 2: Clear line
 
+  def backspace(self):
+    #At the left edge the cursor stays put
+    if self.cursor.x <= 0:
+        return
+    self.cursor.x -= 1
+    #TODO: SEE IF THIS NEEDS TO BE COMMENTED/UNCOMMENTED --v:
+    self.screen.clear_line(self.cursor.y,self.cursor.x,self.cursor.x+1)
+
   def write_ch(self,ch):
     if ch == '\r':
         self.cursor.x = 0
@@ -297,6 +435,25 @@ class Display(object):
 
     self.handle_scrolling()
 
+  def write_run(self,text):
+    #Same result as write_ch() for each printable character of text, but written
+    #into the screen row by row with one wrap/scroll check per row
+    i = 0
+    while i < len(text):
+        if not (0 <= self.cursor.y <= self.bottom_margin and 0 <= self.cursor.x < self.x_size):
+            #Odd cursor positions scroll on every character, go the slow way
+            self.write_ch(text[i])
+            i += 1
+            continue
+        count = min(len(text) - i, self.x_size - self.cursor.x)
+        self.screen.type_run(self.cursor.x,self.cursor.y,text[i:i+count],self.fg,self.bg)
+        self.cursor.x += count
+        i += count
+        if self.cursor.x == self.x_size:
+            self.cursor.x = 0
+            self.cursor.y += 1
+            self.handle_scrolling()
+
   def set_color(self,n):
     if self.BRIGHT_MODE and ((n>=30 and n<=37)or(n>=40 and n<=47)):
         n+=60
@@ -381,6 +538,334 @@ class Display(object):
     elif n == 107:
         self.bg = Colors.BRIGHTWHITE
 
+# Private modes (CSI ? n h / CSI ? n l) that don't change what is drawn
+#1 Application Cursor Keys
+#7 Wrap around
+#12 Start blinking cursor
+#25 Show Cursor
+#1047 Use Alternate Screen Buffer
+#1048 Save cursor as in DECSC
+#1049 Combine 1047 and 1048 modes and clear
+#1051 Set Sun function-key mode
+#1052 Set HP function-key mode
+#1060 Set legacy keyboard emulation (X11R6)
+#1061 Set VT220 keyboard emulation
+IGNORED_PRIVATE_MODES = {1, 7, 12, 25, 1047, 1048, 1049, 1051, 1052, 1060, 1061}
+
+class VTParser(object):
+    """
+    Table-driven VT/ANSI escape sequence parser feeding a Display.
+
+    Each state (ground, escape, charset, CSI parameter, CSI intermediate) is a
+    256 entry table of actions indexed by the input byte, so every byte costs one
+    lookup instead of a walk down a comparison ladder. An action gets the data
+    and the index of its byte and returns the index to continue at, which lets
+    an action consume a whole sequence at once. The parser state survives
+    between feed() calls, so sequences split across ttyrec frames are handled.
+    """
+    # A complete CSI sequence: ESC [ private-marker params intermediates final
+    CSI_SEQUENCE = re.compile(rb'\x1b\[(\??)([0-9;]*)([\x20-\x2f]*)([\x40-\x7e])')
+    PRINTABLE_RUN = re.compile(rb'[\x20-\x7e]+')
+    NON_ASCII_RUN = re.compile(rb'[\x80-\xff]+')
+
+    def __init__(self, display):
+        """
+        :param display: The Display the parsed output is drawn on.
+        """
+        self.display = display
+        self.params = [0]  # CSI parameters, the last one is being accumulated
+        self.private = False  # CSI had a '?' prefix
+        self.intermediates = b''
+        # Keeps an incomplete multibyte character until its next bytes arrive
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+        self.csi_handlers = {
+            ord('A'): lambda p: self.display.CSI_A(p[0]),
+            #Cursor Forward
+            ord('C'): lambda p: self.display.CSI_C(p[0]),
+            ord('G'): lambda p: self.display.CSI_G(p[0]),
+            #Cursor Position (row;column)
+            ord('H'): lambda p: self.display.CSI_H(p[1] if len(p) > 1 else 0, p[0]),
+            ord('J'): self.csi_J,
+            ord('K'): self.csi_K,
+            #Insert Lines
+            ord('L'): lambda p: self.display.CSI_L(p[0]),
+            #Delete Lines
+            ord('M'): lambda p: self.display.CSI_M(p[0]),
+            #Delete arg1 characters before cursor
+            ord('P'): lambda p: self.display.CSI_P(p[0]),
+            #NOTE: S and T are swapped on purpose, this is what matches DCSS
+            ord('S'): lambda p: self.display.CSI_T(p[0]),
+            ord('T'): lambda p: self.display.CSI_S(p[0]),
+            # Erase Characters (Delete arg1 characters after cursor)
+            ord('X'): lambda p: self.display.CSI_X(p[0]),
+            #VPA Move cursor to arg1 row
+            ord('d'): lambda p: self.display.CSI_d(p[0]),
+            #Reset Mode
+            ord('l'): self.csi_l,
+            #Select Graphic Rendition
+            ord('m'): self.csi_m,
+            #Set Top and Bottom Margins
+            ord('r'): self.csi_r,
+        }
+        self.private_handlers = {
+            ord('h'): self.private_mode,
+            ord('l'): self.private_mode,
+            # [?1c https://stackoverflow.com/questions/59847747/what-does-the-esc-1c-escape-sequence-do-on-the-linux-console
+            ord('c'): self.private_c,
+        }
+        self.escape_handlers = {
+            #7 Save Cursor, 8 Restore Cursor
+            ord('7'): None,
+            ord('8'): None,
+            #Keypad Numeric Mode
+            ord('>'): None,
+            #Keypad Application Mode
+            ord('='): None,
+            # Reverse Line Feed (Reverse Index) (Move up one line keeping column position)
+            ord('M'): lambda: self.display.reverse_line_feed(),
+        }
+
+        self.GROUND = [self.print_byte] * 256
+        for b in range(0x20, 0x7f):
+            self.GROUND[b] = self.print_run
+        self.GROUND[0x08] = self.backspace
+        self.GROUND[0x1b] = self.enter_escape
+        for b in range(0x80, 0x100):
+            self.GROUND[b] = self.decode_run
+
+        self.ESCAPE = [self.escape_dispatch] * 256
+        self.ESCAPE[ord('[')] = self.enter_csi
+        #Set G0/G1 character set (VT100) [Graphic Codesets for GL/GR (SCS)]
+        self.ESCAPE[ord('(')] = self.enter_charset
+        self.ESCAPE[ord(')')] = self.enter_charset
+
+        self.CHARSET = [self.charset_dispatch] * 256
+
+        self.CSI_PARAM = [self.csi_unhandled] * 256
+        for b in range(ord('0'), ord('9') + 1):
+            self.CSI_PARAM[b] = self.csi_digit
+        self.CSI_PARAM[ord(';')] = self.csi_separator
+        self.CSI_PARAM[ord('?')] = self.csi_private
+        for b in range(0x20, 0x30):
+            self.CSI_PARAM[b] = self.csi_intermediate
+        for b in range(0x40, 0x7f):
+            self.CSI_PARAM[b] = self.csi_final
+        self.CSI_PARAM[0x1b] = self.enter_escape
+
+        self.CSI_INTERMEDIATE = [self.csi_unhandled] * 256
+        for b in range(0x20, 0x30):
+            self.CSI_INTERMEDIATE[b] = self.csi_intermediate
+        for b in range(0x40, 0x7f):
+            self.CSI_INTERMEDIATE[b] = self.csi_final
+        self.CSI_INTERMEDIATE[0x1b] = self.enter_escape
+
+        # A multibyte character was cut off at the end of the previous chunk
+        self.UTF8 = [self.utf8_abort] * 256
+        for b in range(0x80, 0x100):
+            self.UTF8[b] = self.decode_run
+
+        self.state = self.GROUND
+
+    STATES = ('GROUND', 'ESCAPE', 'CHARSET', 'CSI_PARAM', 'CSI_INTERMEDIATE', 'UTF8')
+
+    def get_state(self):
+        """
+        :return: Picklable dict of everything carried from one feed() to the next.
+        """
+        return {'state': next(name for name in self.STATES if getattr(self, name) is self.state),
+                'params': list(self.params), 'private': self.private,
+                'intermediates': self.intermediates, 'decoder': self.decoder.getstate()}
+
+    def set_state(self, state):
+        """
+        :param state: Dict returned by get_state().
+        :return: None
+        """
+        self.state = getattr(self, state['state'])
+        self.params = list(state['params'])
+        self.private = state['private']
+        self.intermediates = state['intermediates']
+        self.decoder.setstate(state['decoder'])
+
+    def feed(self, data):
+        """
+        Parse and draw a chunk of terminal output.
+
+        :param data: bytes-like chunk.
+        :return: None
+        """
+        end = len(data)
+        i = 0
+        while i < end:
+            i = self.state[data[i]](data, i)
+
+    # GROUND
+
+    def print_byte(self, data, i):
+        self.display.write_ch(chr(data[i]))
+        return i + 1
+
+    def print_run(self, data, i):
+        # Plain text is written as one run up to the next control byte
+        run_end = self.PRINTABLE_RUN.match(data, i).end()
+        self.display.write_run(str(data[i:run_end], 'latin-1'))
+        return run_end
+
+    def backspace(self, data, i):
+        self.display.backspace()
+        return i + 1
+
+    def decode_run(self, data, i):
+        # UTF-8 encoded characters (†, ≈, ♣ ...). A sequence cut off by the end
+        # of the chunk stays in the decoder and is finished by the next chunk.
+        run_end = self.NON_ASCII_RUN.match(data, i).end()
+        text = self.decoder.decode(data[i:run_end])
+        if run_end < len(data):
+            text += self.decoder.decode(b'', True)
+            self.decoder.reset()
+            self.state = self.GROUND
+        else:
+            self.state = self.UTF8 if self.decoder.getstate()[0] else self.GROUND
+        if text:
+            self.display.write_run(text)
+        return run_end
+
+    def utf8_abort(self, data, i):
+        # The cut off character never got finished, draw a replacement for it
+        # and handle this byte normally
+        self.display.write_run(self.decoder.decode(b'', True))
+        self.decoder.reset()
+        self.state = self.GROUND
+        return i
+
+    # ESCAPE
+
+    def enter_escape(self, data, i):
+        # Whole CSI sequences are dispatched in one go, a sequence split over
+        # two frames goes through the CSI states byte by byte
+        match = self.CSI_SEQUENCE.match(data, i)
+        if match is None:
+            self.state = self.ESCAPE
+            return i + 1
+        private, params, intermediates, final = match.groups()
+        self.params = [int(n) if n else 0 for n in params.split(b';')]
+        self.private = bool(private)
+        self.intermediates = intermediates
+        self.csi_dispatch(final[0])
+        return match.end()
+
+    def escape_dispatch(self, data, i):
+        self.state = self.GROUND
+        b = data[i]
+        if b not in self.escape_handlers:
+            print("UNHANDLED NON CSI ESCAPE", chr(b))
+            return i + 1
+        handler = self.escape_handlers[b]
+        if handler is not None:
+            handler()
+        return i + 1
+
+    def enter_charset(self, data, i):
+        self.state = self.CHARSET
+        return i + 1
+
+    def charset_dispatch(self, data, i):
+        # (B United States (ASCII), )0 Graphics: NOOP JUST IGNORE
+        verbose_print("set charset " + chr(data[i]))
+        self.state = self.GROUND
+        return i + 1
+
+    # CSI
+
+    def enter_csi(self, data, i):
+        self.params = [0]
+        self.private = False
+        self.intermediates = b''
+        self.state = self.CSI_PARAM
+        return i + 1
+
+    def csi_digit(self, data, i):
+        self.params[-1] = self.params[-1] * 10 + (data[i] - 0x30)
+        return i + 1
+
+    def csi_separator(self, data, i):
+        self.params.append(0)
+        return i + 1
+
+    def csi_private(self, data, i):
+        self.private = True
+        return i + 1
+
+    def csi_intermediate(self, data, i):
+        self.intermediates += bytes((data[i],))
+        self.state = self.CSI_INTERMEDIATE
+        return i + 1
+
+    def csi_unhandled(self, data, i):
+        print("UNHANDLED CSI BYTE", data[i])
+        self.state = self.GROUND
+        return i + 1
+
+    def csi_final(self, data, i):
+        self.state = self.GROUND
+        self.csi_dispatch(data[i])
+        return i + 1
+
+    def csi_dispatch(self, final):
+        if self.intermediates:
+            handler = None
+        elif self.private:
+            handler = self.private_handlers.get(final)
+        else:
+            handler = self.csi_handlers.get(final)
+        if handler is None:
+            print("UNHANDLED CSI ESCAPE", self.params, self.intermediates, chr(final))
+            return
+        handler(self.params)
+
+    def csi_J(self, params):
+        #Erase in Display
+        if 0 <= params[0] <= 3:
+            self.display.CSI_J(params[0])
+        else:
+            print("Unhandled CSI ^[#J")
+
+    def csi_K(self, params):
+        # Erase in Line
+        if 0 <= params[0] <= 2:
+            self.display.CSI_K(params[0])
+        else:
+            print("Unhandled clear line")
+
+    def csi_r(self, params):
+        #A missing or zero margin is the edge of the screen, so ^[r restores the
+        #power-on region of Display (1-based rows, see Display.__init__)
+        top = params[0] or 1
+        bottom = (params[1] if len(params) > 1 else 0) or self.display.y_size - 1
+        self.display.CSI_r(top, bottom)
+
+    def csi_l(self, params):
+        if params[0] == 4:
+            verbose_print("Insertion Replacement Mode")
+        else:
+            print("Unhandled reset")
+
+    def csi_m(self, params):
+        #ex: \x1b[0;10;1m - 1 means BOLD BRIGHT so make the next stuff bright
+        for n in params:
+            self.display.set_color(n)
+
+    def private_mode(self, params):
+        if params[0] in IGNORED_PRIVATE_MODES:
+            verbose_print("[?" + str(params[0]) + " mode")
+        else:
+            print("Unhandled [?_l or [?_h")
+
+    def private_c(self, params):
+        if params[0] not in (0, 1):
+            print("Unhandled [?_c")
+
 def get_image(image_path):
     """Get a numpy array of an image so that one can access values[x][y]."""
     image = Image.open(image_path, "r")
@@ -396,60 +881,524 @@ def get_image(image_path):
     pixel_values = np.array(pixel_values).reshape((height,width,  channels))
     return pixel_values
 
+class DecompressingReader(io.RawIOBase):
+    """
+    Read-only stream over a compressed ttyrec.
+
+    A background thread decompresses ahead into a bounded queue of chunks, so
+    decoding overlaps with escape-sequence emulation instead of needing a
+    decompressed copy on disk. Seeking is emulated by decompressing and
+    skipping (from the start when seeking backwards).
+    """
+    CHUNK_SIZE = 1 << 18
+    QUEUE_CHUNKS = 16
+
+    def __init__(self, path, opener):
+        """
+        :param path: Path of the compressed ttyrec.
+        :param opener: bz2.open, gzip.open or lzma.open.
+        """
+        super().__init__()
+        self.name = path
+        self.opener = opener
+        self.thread = None
+        self.start(0)
+
+    def start(self, position):
+        self.source = self.opener(self.name, 'rb')
+        self.chunks = queue.Queue(maxsize=self.QUEUE_CHUNKS)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.decompress, args=(self.source, self.chunks, self.stopping), daemon=True)
+        self.thread.start()
+        self.buffer = b''
+        self.bufpos = 0
+        self.position = 0
+        self.eof = False
+        self.error = None  # Decompression error, raised again by every later read
+        self.skip(position)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        while self.thread.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.thread.join()
+        self.thread = None
+        self.source.close()
+
+    def decompress(self, source, chunks, stopping):
+        try:
+            while True:
+                chunk = source.read(self.CHUNK_SIZE)
+                while True:
+                    try:
+                        chunks.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        if stopping.is_set():
+                            return
+                if not chunk:
+                    return
+        except Exception as e:
+            chunks.put(e)
+
+    def next_chunk(self):
+        if self.error is not None:
+            raise self.error
+        chunk = self.chunks.get()
+        if isinstance(chunk, Exception):
+            # The thread has exited, later reads would wait for it forever
+            self.error = chunk
+            raise chunk
+        if not chunk:
+            self.eof = True
+        return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self.buffer[self.bufpos:]]
+            while not self.eof:
+                parts.append(self.next_chunk())
+            data = b''.join(parts)
+            self.buffer = b''
+            self.bufpos = 0
+        elif len(self.buffer) - self.bufpos >= size:
+            data = self.buffer[self.bufpos:self.bufpos + size]
+            self.bufpos += size
+        else:
+            parts = [self.buffer[self.bufpos:]]
+            missing = size - len(parts[0])
+            chunk = b''
+            while missing > 0 and not self.eof:
+                chunk = self.next_chunk()
+                parts.append(chunk[:missing])
+                missing -= len(chunk)
+            # Keep the unread rest of the last chunk
+            self.buffer = chunk
+            self.bufpos = len(chunk) + missing if missing < 0 else len(chunk)
+            data = b''.join(parts)
+        self.position += len(data)
+        return data
+
+    def skip(self, n):
+        while n > 0:
+            data = self.read(min(n, self.CHUNK_SIZE))
+            if not data:
+                return
+            n -= len(data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Compressed ttyrecs only support absolute seeks")
+        if offset >= self.position:
+            self.skip(offset - self.position)
+        else:
+            self.stop()
+            self.start(offset)
+        return self.position
+
+    def close(self):
+        self.stop()
+        super().close()
+
+COMPRESSION_MAGIC = (
+    (b'BZh', bz2.open),
+    (b'\x1f\x8b', gzip.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+)
+
+def open_ttyrec(path):
+    """
+    Open a ttyrec, decompressing bz2, gzip and xz files on the fly.
+
+    :param path: Path of the ttyrec.
+    :return: A binary file object.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    for prefix, opener in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return DecompressingReader(path, opener)
+    return open(path, 'rb')
+
+class FrameIndex(object):
+    """
+    Persistent frame number -> (byte offset, timestamp, payload length) table of a ttyrec.
+
+    The index is stored next to the ttyrec as a small binary sidecar file, so later
+    runs can get frame delays or seek to any frame without rescanning the headers.
+    Frame numbers are 1-based, like TtyPlay.frameno.
+    """
+    MAGIC = b'TTYIDX01'
+    HEADER = struct.Struct('<8sQQ')  # magic, size and mtime_ns of the indexed ttyrec
+    RECORD = struct.Struct('<QIII')
+    DTYPE = np.dtype([('offset', '<u8'), ('seconds', '<u4'), ('useconds', '<u4'), ('length', '<u4')])
+
+    def __init__(self, entries):
+        """
+        :param entries: Structured numpy array with FrameIndex.DTYPE records.
+        """
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def entry(self, frameno):
+        """
+        :param frameno: 1-based frame number.
+        :return: Tuple (offset, seconds, useconds, length) of the frame.
+        """
+        offset, seconds, useconds, length = self.entries[frameno - 1]
+        return int(offset), int(seconds), int(useconds), int(length)
+
+    def timestamps(self):
+        """
+        :return: Float array of the header timestamps of every frame in seconds.
+        """
+        return self.entries['seconds'].astype(np.float64) + self.entries['useconds'] / 1000000.0
+
+    def durations(self):
+        """
+        :return: Float array of the delays between consecutive frames in seconds.
+        """
+        seconds = self.entries['seconds'].astype(np.int64)
+        useconds = self.entries['useconds'].astype(np.int64)
+        return np.diff(seconds) + np.diff(useconds) / 1000000.0
+
+    @staticmethod
+    def source_stamp(ttyrec_path):
+        st = os.stat(ttyrec_path)
+        return st.st_size, st.st_mtime_ns
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        :param records: Bytes of packed FrameIndex.RECORD structs.
+        :return: FrameIndex
+        """
+        return cls(np.frombuffer(bytes(records), dtype=cls.DTYPE))
+
+    @classmethod
+    def load(cls, path, ttyrec_path):
+        """
+        Load a sidecar index.
+
+        :param path: Path of the index file.
+        :param ttyrec_path: Path of the ttyrec it should describe.
+        :return: FrameIndex, or None if missing or stale (ttyrec changed since indexing).
+        """
+        try:
+            with open(path, 'rb') as index_file:
+                header = index_file.read(cls.HEADER.size)
+                if len(header) < cls.HEADER.size:
+                    return None
+                magic, size, mtime_ns = cls.HEADER.unpack(header)
+                if magic != cls.MAGIC or (size, mtime_ns) != cls.source_stamp(ttyrec_path):
+                    return None
+                return cls(np.fromfile(index_file, dtype=cls.DTYPE))
+        except FileNotFoundError:
+            return None
+
+    def save(self, path, ttyrec_path):
+        """
+        Write the index to a sidecar file.
+
+        :param path: Path of the index file.
+        :param ttyrec_path: Path of the indexed ttyrec.
+        :return: None
+        """
+        size, mtime_ns = self.source_stamp(ttyrec_path)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(self.HEADER.pack(self.MAGIC, size, mtime_ns))
+            self.entries.tofile(index_file)
+        os.replace(tmp_path, path)
+
+class Checkpoints(object):
+    """
+    Sidecar file of emulator states saved every N frames of a ttyrec, so a run can
+    start late in a long ttyrec without emulating everything before.
+
+    A header (magic, size and mtime_ns of the ttyrec, timestamp of its first frame)
+    is followed by one record per checkpoint: a RECORD struct (frame number, header
+    timestamp, pickle length) and a pickled TtyPlay.checkpoint_state(). Opening
+    the file only walks the record headers, restoring unpickles a single state.
+    """
+    MAGIC = b'TTYCKP01'
+    HEADER = struct.Struct('<8sQQII')
+    RECORD = struct.Struct('<QIIQ')
+
+    def __init__(self, path, ttyrec_path):
+        """
+        :param path: Path of the checkpoint file. Missing or stale files are
+            started over by the first add().
+        :param ttyrec_path: Path of the ttyrec.
+        """
+        self.path = path
+        self.ttyrec_path = ttyrec_path
+        self.entries = []  # (frameno, seconds, useconds, position of the pickle)
+        self.first = None  # (seconds, useconds) of frame 1
+        self.end = 0  # End of the last complete record
+        self.file = None
+        try:
+            with open(path, 'rb') as checkpoint_file:
+                header = checkpoint_file.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    return
+                magic, size, mtime_ns, seconds, useconds = self.HEADER.unpack(header)
+                if magic != self.MAGIC or (size, mtime_ns) != FrameIndex.source_stamp(ttyrec_path):
+                    return
+                self.first = (seconds, useconds)
+                self.end = self.HEADER.size
+                file_size = os.fstat(checkpoint_file.fileno()).st_size
+                while True:
+                    record = checkpoint_file.read(self.RECORD.size)
+                    if len(record) < self.RECORD.size:
+                        break
+                    frameno, seconds, useconds, length = self.RECORD.unpack(record)
+                    position = checkpoint_file.tell()
+                    if position + length > file_size:
+                        break  # Cut off by an interrupted run
+                    self.entries.append((frameno, seconds, useconds, position))
+                    self.end = position + length
+                    checkpoint_file.seek(length, io.SEEK_CUR)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, tp):
+        """
+        Save the state of tp, unless a checkpoint at or after its frame exists.
+
+        :param tp: TtyPlay that has just emulated a frame.
+        :return: None
+        """
+        if self.entries and tp.frameno <= self.entries[-1][0]:
+            return
+        if self.file is None:
+            if self.first is None:
+                self.file = open(self.path, 'wb')
+                size, mtime_ns = FrameIndex.source_stamp(self.ttyrec_path)
+                self.first = tp.first_header
+                self.file.write(self.HEADER.pack(self.MAGIC, size, mtime_ns, *self.first))
+            else:
+                self.file = open(self.path, 'r+b')
+                self.file.truncate(self.end)
+                self.file.seek(self.end)
+        data = pickle.dumps(tp.checkpoint_state(), pickle.HIGHEST_PROTOCOL)
+        self.file.write(self.RECORD.pack(tp.frameno, tp.seconds, tp.useconds, len(data)))
+        self.entries.append((tp.frameno, tp.seconds, tp.useconds, self.file.tell()))
+        self.file.write(data)
+        self.end = self.file.tell()
+
+    def find(self, frameno=None, seconds=None):
+        """
+        Find the newest checkpoint from which a start point can be reached.
+
+        :param frameno: Start frame, the checkpoint is taken before it.
+        :param seconds: Start time in seconds after the first frame, the
+            checkpoint is taken before it.
+        :return: Entry (frameno, seconds, useconds, position), or None.
+        """
+        found = None
+        for entry in self.entries:
+            if frameno is not None and entry[0] >= frameno:
+                break
+            if seconds is not None and (entry[1] - self.first[0]) + (entry[2] - self.first[1]) / 1000000.0 >= seconds:
+                break
+            found = entry
+        return found
+
+    def state(self, entry):
+        """
+        :param entry: Entry returned by find().
+        :return: The saved TtyPlay.checkpoint_state() dict.
+        """
+        if self.file is not None:
+            self.file.flush()
+        with open(self.path, 'rb') as checkpoint_file:
+            checkpoint_file.seek(entry[3])
+            return pickle.load(checkpoint_file)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class CsvFrameWriter(object):
+    """
+    Writes every saved screen to <directory>/<frameno>.csv, one y,x,fg,bg,char row per cell,
+    and every saved frame to the <directory>/frames.csv manifest as frameno,timestamp,source_frameno.
+    """
+    def __init__(self, directory='./data'):
+        self.directory = directory
+        self.manifest = None
+
+    def add_to_manifest(self, frameno, timestamp, source_frameno):
+        if self.manifest is None:
+            self.manifest_file = open(os.path.join(self.directory, MANIFEST_NAME), mode='w')
+            self.manifest = csv.writer(self.manifest_file)
+        self.manifest.writerow((frameno, repr(timestamp), source_frameno))
+
+    def write(self, frameno, timestamp, cells):
+        """
+        :param frameno: Number of the ttyrec frame the screen was saved after.
+        :param timestamp: ttyrec timestamp of the frame in seconds.
+        :param cells: (rows, cols) array of CELL_DTYPE cells.
+        :return: None
+        """
+        with open(os.path.join(self.directory, str(frameno) + '.csv'), mode='w') as frame_file:
+            frame_info_writer = csv.writer(frame_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            ys, xs = np.indices(cells.shape)
+            frame_info_writer.writerows(zip(ys.ravel().tolist(), xs.ravel().tolist(),
+                                            cells['fg'].ravel().tolist(), cells['bg'].ravel().tolist(),
+                                            map(chr, cells['char'].ravel().tolist())))
+        self.add_to_manifest(frameno, timestamp, frameno)
+
+    def write_ref(self, frameno, timestamp, source_frameno):
+        """
+        Record a frame showing the same screen as an earlier one, no CSV is written.
+
+        :param frameno: Number of the ttyrec frame the screen was saved after.
+        :param timestamp: ttyrec timestamp of the frame in seconds.
+        :param source_frameno: Frame number whose CSV holds the screen.
+        :return: None
+        """
+        self.add_to_manifest(frameno, timestamp, source_frameno)
+
+    def close(self):
+        if self.manifest is not None:
+            self.manifest_file.close()
+            self.manifest = None
+
 class TtyPlay(object):
     """
     A class to read, analyze and play ttyrecs
     """
-    def __init__(self, f, speed=1.0):
+    def __init__(self, f, speed=1.0, index_path=None, use_mmap=False, screen_class=ArrayScreen, frame_writer=None,
+                 headless=False, checkpoint_path=None, checkpoint_interval=10000):
         """
         Create a new ttyrec player.
 
-        :param f: An open file object or a path to file.
+        :param f: An open file object or a path to file. Paths to bz2, gzip and xz
+            compressed ttyrecs are decompressed as a stream in a background thread.
         :param speed: Speed multipier, used to divide delays.
+        :param index_path: Optional path of a sidecar FrameIndex. It is loaded if it
+            exists and is up to date, otherwise it is written during the first full pass.
+        :param use_mmap: Memory-map the file. Frames are then memoryview slices of
+            the mapping instead of freshly read bytes objects. Ignored for
+            compressed ttyrecs.
+        :param screen_class: ArrayScreen (numpy cells) or Screen (Tile objects).
+        :param frame_writer: Where save_frame() puts changed screens, a CsvFrameWriter
+            writing to ./data by default, a frame_store.FrameStoreWriter or a
+            frame_store.DeltaFrameStoreWriter.
+        :param headless: Don't print a FRAME:n line per displayed frame.
+        :param checkpoint_path: Optional path of a Checkpoints file, used by start_at()
+            and extended with a checkpoint every checkpoint_interval frames.
+        :param checkpoint_interval: Frames between checkpoints.
         """
         if isinstance(f, io.IOBase):
             self.file = f
+            self.path = getattr(f, 'name', None)
         else:
-            self.file = open(f, 'rb')
+            self.file = open_ttyrec(f)
+            self.path = f
+        self.mmap = None
+        self.view = None  # memoryview of self.mmap, frames are slices of it
+        if use_mmap and not isinstance(self.file, DecompressingReader) and os.fstat(self.file.fileno()).st_size > 0:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mmap)
         self.speed = speed  # Multiplier of speed
         self.seconds = 0  # sec field of header
         self.useconds = 0  # usec field of header
         self.length = 0  # len field of header
         self.frameno = 0  # Number of current frame in file
+        self.first_header = None  # (seconds, useconds) of frame 1
         self.duration = 0.0  # Computed duration of previous frame
         self.frame = bytes()  # Payload of the frame
-        self.display = Display()
+        self.display = Display(screen_class)
+        self.parser = VTParser(self.display)
         self.stop_count = 0
-        self.display_buffer = b''
+        self.headless = headless
+        self.saved_frames = 0  # Frames handed to frame_writer
         self.TILESIZE = 32
         self.DATASIZE = 3
         self.FORGROUND_SIZE = 16
+        self.offset = 0  # Byte offset of the next header in file
+        self.next_header = None  # Header read ahead by next_delay()
+        self.index = None
+        self.index_path = index_path
+        self.index_records = None  # Packed FrameIndex records while indexing
+        if index_path is not None:
+            if self.path is None:
+                raise ValueError("A frame index needs a ttyrec path")
+            self.index = FrameIndex.load(index_path, self.path)
+            if self.index is None:
+                self.index_records = bytearray()
+
+        self.previous_frame = None  # Cells of the last saved screen
+        self.screens = {}  # blake2b digest of saved screens -> frame number first saved with
+        self.frame_writer = frame_writer if frame_writer is not None else CsvFrameWriter()
+        self.checkpoints = None
+        self.checkpoint_interval = checkpoint_interval
+        if checkpoint_path is not None:
+            if self.path is None:
+                raise ValueError("Checkpoints need a ttyrec path")
+            self.checkpoints = Checkpoints(checkpoint_path, self.path)
+
+    def save_frame(self, frameno=None, timestamp=None):
+        """
+        Hand the screen to frame_writer if it changed since the last saved one.
 
-
-        self.previous_frame = np.ndarray(shape=(self.TILESIZE*self.display.y_size,self.TILESIZE*self.display.x_size*self.DATASIZE),dtype=np.uint8)
-
-    def save_frame(self):
-        frame_data = []
-        # image = image[0+32*sprite_index_y:32+32*sprite_index_y,0+32*sprite_index_x:32+32*sprite_index_x,:]
-        for y in range(0,self.display.y_size):
-            for x in range(0,self.display.x_size):
-                fg = self.display.screen.tiles[y][x].fgcolor
-                bg = self.display.screen.tiles[y][x].bgcolor
-                char = self.display.screen.tiles[y][x].char
-                frame_data.append([y,x,fg.value,bg.value,char])
-
-        if not np.array_equal(self.previous_frame,frame_data):
-            with open('./data/' + str(self.frameno) + '.csv', mode='w') as frame_file:
-                frame_info_writer = csv.writer(frame_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                for y in range(0,self.display.y_size):
-                    for x in range(0,self.display.x_size):
-                        fg = self.display.screen.tiles[y][x].fgcolor
-                        bg = self.display.screen.tiles[y][x].bgcolor
-                        char = self.display.screen.tiles[y][x].char
-                        frame_info_writer.writerow([y,x,fg.value,bg.value,char])
+        :param frameno: Number to save it as, the current ttyrec frame by default.
+        :param timestamp: Time to save it with, the current header timestamp by default.
+        :return: None
+        """
+        if frameno is None:
+            frameno = self.frameno
+        if timestamp is None:
+            timestamp = self.timestamp
+        # The screen equals previous_frame after every save, so only cells
+        # written since then can differ
+        dirty_rows, dirty = self.display.damage()
+        if self.previous_frame is not None and len(dirty_rows) == 0:
+            return
+        frame_data = self.display.screen.snapshot()
+        self.display.reset_damage()
+
+        if self.previous_frame is None or not np.array_equal(self.previous_frame[dirty],frame_data[dirty]):
+            # Any earlier screen is stored once, repeats only reference it
+            digest = hashlib.blake2b(frame_data.tobytes(), digest_size=16).digest()
+            source_frameno = self.screens.get(digest)
+            if source_frameno is None:
+                self.screens[digest] = frameno
+                self.frame_writer.write(frameno, timestamp, frame_data)
+            else:
+                self.frame_writer.write_ref(frameno, timestamp, source_frameno)
             self.previous_frame = frame_data
+            self.saved_frames += 1
 
-        # exit(0)
+    @property
+    def timestamp(self):
+        """
+        :return: Header timestamp of the current frame in seconds.
+        """
+        return self.seconds + self.useconds / 1000000.0
 
     def compute_framelen(self, sec, usec):
         """
@@ -472,13 +1421,82 @@ class TtyPlay(object):
 
         :return: List, containing delays for each frame.
         """
-        self.file.seek(0)
+        if self.index is not None:
+            delays = self.index.durations() / self.speed
+            if (delays < 0).any():
+                raise ValueError("ttyrec frame is in past")
+            return delays.tolist()
+        self.rewind()
         delays = []
         while self.read_frame(loop=True):
             if self.frameno > 1:
                 delays.append(self.duration)
         return delays
 
+    def rewind(self):
+        """
+        Go back to the start of the ttyrec.
+
+        :return: None
+        """
+        self.file.seek(0)
+        self.frameno = 0
+        self.offset = 0
+        self.next_header = None
+        if self.index is None and self.index_path is not None:
+            self.index_records = bytearray()
+
+    def seek_frame(self, frameno):
+        """
+        Position the reader so the next read_frame() returns frame frameno.
+
+        Needs a loaded FrameIndex. Only the file position and timing are restored,
+        the display still holds whatever was emulated before.
+
+        :param frameno: 1-based frame number.
+        :return: None
+        """
+        if self.index is None:
+            raise ValueError("Seeking needs a complete frame index")
+        if not 1 <= frameno <= len(self.index) + 1:
+            raise IndexError("Frame {} is not in the ttyrec".format(frameno))
+        if frameno > len(self.index) > 0:
+            offset, _, _, length = self.index.entry(len(self.index))
+            self.offset = offset + 12 + length
+        elif frameno > len(self.index):
+            self.offset = 0
+        else:
+            self.offset = self.index.entry(frameno)[0]
+        if frameno > 1:
+            _, self.seconds, self.useconds, self.length = self.index.entry(frameno - 1)
+        self.file.seek(self.offset)
+        self.frameno = frameno - 1
+        self.next_header = None
+
+    def next_delay(self):
+        """
+        Compute the delay between the current frame and the next one without
+        consuming the next frame, so delays are known in the same pass that
+        displays the frames.
+
+        :return: Float delay in seconds, or None if there is no next frame.
+        """
+        if self.index is not None:
+            if self.frameno >= len(self.index):
+                return None
+            _, seconds, useconds, _ = self.index.entry(self.frameno + 1)
+        elif self.view is not None:
+            if self.offset + 12 > len(self.view):
+                return None
+            seconds, useconds, _ = struct.unpack_from('<III', self.view, self.offset)
+        else:
+            if self.next_header is None:
+                self.next_header = self.file.read(12)
+            if len(self.next_header) < 12:
+                return None
+            seconds, useconds, _ = struct.unpack('<III', self.next_header)
+        return self.compute_framelen(seconds, useconds)
+
     def read_frame(self, loop=False):
         """
         Read a ttyrec frame (header and payload).
@@ -486,355 +1504,145 @@ class TtyPlay(object):
         :param loop: If True, rewind ttyrec after reaching EOF (don't close).
         :return: True, if there's more to read, False if reached EOF.
         """
-        header = self.file.read(12)
+        if self.view is not None:
+            header = self.view[self.offset:self.offset + 12]
+        elif self.next_header is not None:
+            header = self.next_header
+            self.next_header = None
+        else:
+            header = self.file.read(12)
         if len(header) == 0:
+            self.finish_index()
             if loop:
-                self.file.seek(0)
-                self.frameno = 0
+                self.rewind()
             else:
                 self.file.close()
             return False
         elif len(header) < 12:
             raise ValueError("Short read: Couldn't read a whole ttyrec header!")
         seconds, useconds, length = struct.unpack('<III', header)
-        self.frame = self.file.read(length)
+        if self.view is not None:
+            self.frame = self.view[self.offset + 12:self.offset + 12 + length]
+        else:
+            self.frame = self.file.read(length)
         if len(self.frame) < length:
             raise ValueError("Short read: Couldn't read a whole ttyrec frame!")
+        if self.index_records is not None:
+            self.index_records += FrameIndex.RECORD.pack(self.offset, seconds, useconds, length)
+        self.offset += 12 + length
         self.frameno += 1
         if self.frameno > 1:
             self.duration = self.compute_framelen(seconds, useconds)
         self.seconds = seconds
         self.useconds = useconds
         self.length = length
+        if self.frameno == 1:
+            self.first_header = (seconds, useconds)
         return True
 
-    def display_frame(self):
+    def finish_index(self):
+        """
+        Save the index built during a full sequential pass.
+
+        :return: None
+        """
+        if self.index_records is None:
+            return
+        self.index = FrameIndex.from_records(self.index_records)
+        self.index_records = None
+        self.index.save(self.index_path, self.path)
+
+    def emulate_frame(self):
         """
-        Print the frame to stdout.
+        Feed the frame to the emulated display.
 
         :return: None
         """
         verbose_print(self.frame)
 
-        self.frame = self.display_buffer + self.frame            
-        self.display_buffer = b''
-        #exclude the encapsulating b' ___ '
-        chidx = 0
-        # while chidx < len(self.frame)-10:
-        while (chidx < len(self.frame) and len(self.frame) < 2048) or chidx < len(self.frame)-10:
-            if self.frame[chidx] == 0x08:
-            #BACKSPACE
-                chidx+=1
-                self.display.cursor.x -= 1
-                #TODO: SEE IF THIS NEEDS TO BE COMMENTED/UNCOMMENTED --v:
-                self.display.screen.tiles[self.display.cursor.y][self.display.cursor.x] = Tile(Colors.WHITE,Colors.BLACK,' ')
-
-            #Handle UNICODE                https://www.utf8-chartable.de/unicode-utf8-table.pl
-            elif self.frame[chidx] == 0xe2:
-                chidx+=1
-                if self.frame[chidx] == 0x80:
-                    chidx+=1
-                    if self.frame[chidx] == 0xa0:
-                        chidx+=1
-                        self.display.write_ch('†')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' †' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                elif self.frame[chidx] == 0x88:
-                    chidx+=1
-                    if self.frame[chidx] == 0x86:
-                        chidx+=1
-                        self.display.write_ch('∆')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ∆' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                    elif self.frame[chidx] == 0x9e:
-                        chidx+=1
-                        self.display.write_ch('∞')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ∞' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                    elif self.frame[chidx] == 0xa9:
-                        chidx+=1
-                        self.display.write_ch('∩')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ∩' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                    else:
-                        print("UNHANDLED UNICODE")
-                        exit(0)                
-                elif self.frame[chidx] == 0x89:
-                    chidx+=1
-                    if self.frame[chidx] == 0x88:
-                        chidx+=1
-                        self.display.write_ch('≈')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ≈' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                    else:
-                        print("UNHANDLED UNICODE")
-                        exit(0)
-                elif self.frame[chidx] == 0x8c:
-                    chidx+=1
-                    if self.frame[chidx] == 0xa0:
-                        chidx+=1
-                        self.display.write_ch('⌠')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ⌠' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                    else:
-                        print("UNHANDLED UNICODE")
-                        exit(0)    
-                elif self.frame[chidx] == 0x96:
-                    chidx+=1
-                    if self.frame[chidx] == 0x93:
-                        chidx+=1
-                        self.display.write_ch('▓')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ▓' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                    else:
-                        print("UNHANDLED UNICODE")
-                        exit(0)
-                elif self.frame[chidx] == 0x97:
-                    chidx+=1
-                    if self.frame[chidx] == 0x8b:
-                        chidx+=1
-                        self.display.write_ch('○')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ○' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                    else:
-                        print("UNHANDLED UNICODE")
-                        exit(0)
-                elif self.frame[chidx] == 0x98:
-                    chidx+=1
-                    if self.frame[chidx] == 0xbc:
-                        chidx+=1
-                        self.display.write_ch('☼')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ☼' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                    else:
-                        print("UNHANDLED UNICODE")
-                        exit(0)
-                elif self.frame[chidx] == 0x99:
-                    chidx+=1
-                    if self.frame[chidx] == 0xa3:
-                        chidx+=1
-                        self.display.write_ch('♣')
-                        verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ♣' + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                    else:
-                        print("UNHANDLED UNICODE")
-                        exit(0)
-                else:
-                    print("UNHANDLED UNICODE")
-                    exit(0)
-            #HANDLE ESCAPE
-            elif self.frame[chidx] == 27:
-                chidx+=1
-                if self.frame[chidx] == ord('7') or self.frame[chidx] == ord('8'):
-                    chidx+=1
-                    #NOOP
-                    #7 Save Cursor
-                    #8 Restore Cursor
-                #Keypad Numeric Mode
-                elif self.frame[chidx] == ord('>'):
-                    chidx+=1
-                    #NOOP?
-                #Control Sequence Introducer
-                elif self.frame[chidx] == ord('['):
-                    chidx+=1
-
-                    #Get number (break at non number sequence)
-                    number = 0
-                    power = 1
-                    while (chidx < len(self.frame)-1) and (self.frame[chidx] >= ord('0') and self.frame[chidx] <= ord('9')):
-                        number*=10
-                        number+= (int)(chr(self.frame[chidx]))
-                        chidx+=1
-
-                    #Handle ANSI Control Sequences
-                    #Cursor Forware
-                    if self.frame[chidx] == ord('C'):
-                        chidx+=1
-                        #NOTE: if number is 0 should it still move forward?
-                        self.display.CSI_C(number)
-                    #Delete line
-                    elif self.frame[chidx] == ord('M'):
-                        chidx+=1
-                        #NOTE: if number is 0 should it still delete a line? (does ^[M mean delete 1 line?)
-                        self.display.CSI_M(number)
-                    #Scroll Down
-                    elif self.frame[chidx] == ord('T'):
-                        chidx+=1
-                        self.display.CSI_S(number)
-                    #Scroll UP
-                    elif self.frame[chidx] == ord('S'):
-                        chidx+=1
-                        self.display.CSI_T(number)
-                    #Insert Lines
-                    elif self.frame[chidx] == ord('L'):
-                        chidx+=1
-                        self.display.CSI_L(number)
-                    # Erase Characters (Delete arg1 characters after cursor)
-                    elif self.frame[chidx] == ord('X'):
-                        chidx+=1
-                        self.display.CSI_X(number)
-                    # Erase in Line
-                    elif self.frame[chidx] == ord('K'):
-                        chidx+=1
-                        if number >= 0 and number <= 2:
-                            self.display.CSI_K(number)
-                        else:
-                            print("Unhandled clear line")
-                    #VPA Move cursor to arg1 row
-                    elif self.frame[chidx] == ord('d'):
-                        chidx+=1
-                        self.display.CSI_d(number)
-                    #Reset Mode
-                    elif self.frame[chidx] == ord('l'):
-                        chidx+=1
-                        if number == 4:
-                            verbose_print("Insertion Replacement Mode")
-                        else:
-                            print("Unhandled reset")
-                            exit(0)
-                    #Private Modes DECSET DECRST 
-                    elif self.frame[chidx] == ord('?'):
-                        chidx+=1
-                        number = 0
-                        power = 1
-                        while self.frame[chidx] >= ord('0') and self.frame[chidx] <= ord('9'):
-                            number*=10
-                            number+= (int)(chr(self.frame[chidx]))
-                            chidx+=1
-                        if (number == 1 or number==7 or number == 12 or number == 25 or
-                            number == 1047 or number == 1048 or number == 1049 or
-                            number == 1051 or number == 1052 or number == 1060 or number==1061) and (self.frame[chidx] == ord('l') or self.frame[chidx] == ord('h')):
-                            verbose_print("[?"+str(number) + chr(self.frame[chidx]))
-                            chidx+=1
-                            #1 Application Cursor Keys
-                            #7 Wrap around
-                            #12 Start blinking cursor
-                            #25 Show Cursor
-
-                            #1047 Use Alternate Screen Buffer
-                            #1048 Save cursor as in DECSC
-                            #1049 Combine 1047 and 1048 modes and clear
-                            #1051 Set Sun function-key mode
-                            #1052 Set HP function-key mode
-                            #1060 Set legacy keyboard emulation (X11R6)
-                            #1061 Set VT220 keyboard emulation
-                            #NOOP JUST IGNORE
-                        elif (number==1 or number == 0)and self.frame[chidx] == ord('c'):
-                            verbose_print("[?"+str(number) + chr(self.frame[chidx]))
-                            chidx+=1
-                            # [?1c https://stackoverflow.com/questions/59847747/what-does-the-esc-1c-escape-sequence-do-on-the-linux-console
-                        else:
-                            print("Unhandled [?_l or [?_h")
-                            exit(0)
-                    #Erase in Display
-                    elif self.frame[chidx] == ord('J'):
-                        if number >= 0 and number <= 3:
-                            self.display.CSI_J(number)
-                            chidx+=1
-                        else:
-                            print("Unhandled CSI ^[#J")
-                            exit(0)
-                    #(Select Graphic Rendition)
-                    elif self.frame[chidx] == ord('m'):
-                        self.display.set_color(number)
-                        chidx+=1
-                    #Delete arg1 characters before cursor
-                    elif self.frame[chidx] == ord('P'):
-                        self.display.CSI_P(number)
-                        chidx+=1
-                    #Cursor UP
-                    elif self.frame[chidx] == ord('A'):
-                        self.display.CSI_A(number)
-                        chidx+=1
-                    #Cursor Position
-                    elif self.frame[chidx] == ord('H'):
-                        self.display.CSI_H(0,number)
-                        chidx+=1
-                    elif self.frame[chidx] == ord('G'):
-                        self.display.CSI_G(number)
-                        chidx+=1
-                    elif self.frame[chidx] == ord(';'):
-                        chidx+=1
-                        number2 = 0
-                        power2 = 1
-                        while self.frame[chidx] >= ord('0') and self.frame[chidx] <= ord('9'):
-                            number2*=10
-                            number2+= (int)(chr(self.frame[chidx]))
-                            chidx+=1
-                        #Cursor Position
-                        if self.frame[chidx] == ord('H'):
-                            #Moves the cursor to row n, column m
-                            self.display.CSI_H(number2,number)
-                            chidx+=1
-                        #Select Graphic Rendition
-                        elif self.frame[chidx] == ord('m'):
-                            self.display.set_color(number)
-                            self.display.set_color(number2)
-                            chidx+=1
-                        #Set Top and Bottom Margins
-                        elif self.frame[chidx] == ord('r'):
-                            self.display.CSI_r(number,number2)
-                            verbose_print("set_margins")
-                            chidx+=1
-                        else:
-                            chidx+=1
-                            number3 = 0
-                            while self.frame[chidx] >= ord('0') and self.frame[chidx] <= ord('9'):
-                                number3*=10
-                                number3+= (int)(chr(self.frame[chidx]))
-                                chidx+=1
-                            if self.frame[chidx] == ord('m'):
-                                self.display.set_color(number)
-                                self.display.set_color(number2)
-                                self.display.set_color(number3) #ex: \x1b[0;10;1m - 1 means BOLD BRIGHT so make the next stuff bright
-                                chidx+=1
-                            else:
-                                print("UNHANDLED CSI ESCAPE ^[#;#*",(chr(self.frame[chidx])))
-                                exit(0)
-                    else:
-                        print("UNHANDLED CSI ESCAPE Letter:" + chr(self.frame[chidx]))
-                        exit(0)
-
-                elif self.frame[chidx] == ord(')'):
-                    chidx+=1
-                    #Set G1 character set to 
-                    # https://chromium.googlesource.com/apps/libapps/+/a5fb83c190aa9d74f4a9bca233dac6be2664e9e9/hterm/doc/ControlSequences.md#SCS
-                    if self.frame[chidx] == ord('0'): #Graphics
-                        verbose_print("set_ascii 0)")
-                        chidx+=1
-                        #NOOP JUST IGNORE
-
-                elif self.frame[chidx] == ord('('):
-                    #Set G0 character set (VT100) [Graphic Codesets for GL/GR (SCS)]
-                    chidx+=1
-                    if self.frame[chidx] == ord('B'):
-                        #United States (ASCII)
-                        verbose_print("set_ascii (B")
-                        chidx+=1
-                        #NOOP JUST IGNORE
-                    else:
-                        print("UNHANDLED Graphic Codeset")
-                #Keypad Application Mode
-                elif self.frame[chidx] == ord('='):
-                    chidx+=1
-                    verbose_print("Keypad Application Mode")
-                # Reverse Line Feed? (Reverse Index?) (Move up one line keeping column position)
-                elif self.frame[chidx] == ord('M'):
-                    chidx+=1
-                    self.display.reverse_line_feed()
-                    verbose_print("Reverse Line Feed")
-                else:
-                    print("UNHANDLED NON CSI ESCAPE")
-                    exit(0)
-            else:
-                self.display.write_ch(chr(self.frame[chidx]))
-                if len(self.frame) > chidx:
-                    verbose_print(str(chidx) + ' ' + str(self.frame[chidx]) + ' ' + chr(self.frame[chidx]) + " cursor(x,y):"+str(self.display.cursor.x) + "," + str(self.display.cursor.y))
-                chidx+=1        
-
-            if len(self.frame) >= 2060 and int(str(chidx)) > 2050:
-                self.display_buffer = self.frame[chidx:]
-                chidx = len(self.frame)
-
-        if chidx < len(self.frame):
-            self.display_buffer = self.frame[chidx:]
-            chidx = len(self.frame)
+        self.parser.feed(self.frame)
         #sys.stdout.write(str(self.frame, errors='ignore'))
         sys.stdout.flush()
         self.stop_count += 1
 
-        print("FRAME:" + str(self.frameno))
+        if not self.headless:
+            print("FRAME:" + str(self.frameno))
+
+        if self.checkpoints is not None and self.frameno % self.checkpoint_interval == 0:
+            self.checkpoints.add(self)
+
+    def checkpoint_state(self):
+        """
+        :return: Picklable dict of the emulator state after the current frame.
+        """
+        return {'display': self.display, 'parser': self.parser.get_state(),
+                'offset': self.offset, 'frameno': self.frameno, 'first_header': self.first_header,
+                'seconds': self.seconds, 'useconds': self.useconds, 'length': self.length,
+                'duration': self.duration}
+
+    def restore_checkpoint(self, state):
+        """
+        Continue from a checkpoint_state(): the next read_frame() returns the frame
+        after it. The first screen saved afterwards is saved in full.
+
+        :param state: Dict returned by checkpoint_state().
+        :return: None
+        """
+        self.display = state['display']
+        self.parser.display = self.display
+        self.parser.set_state(state['parser'])
+        self.offset = state['offset']
+        self.frameno = state['frameno']
+        self.first_header = state['first_header']
+        self.seconds = state['seconds']
+        self.useconds = state['useconds']
+        self.length = state['length']
+        self.duration = state['duration']
+        if self.view is None:
+            self.file.seek(self.offset)
+        self.next_header = None
+        self.index_records = None  # Not a full pass any more
+        self.previous_frame = None
+        self.screens = {}
+
+    def start_at(self, frameno=None, seconds=None):
+        """
+        Skip ahead so the next read_frame() returns the start frame: restore the
+        newest checkpoint before it, then emulate the remaining frames in between
+        without saving them.
+
+        :param frameno: 1-based start frame.
+        :param seconds: Start at the first frame this many seconds after frame 1.
+        :return: None
+        """
+        if self.checkpoints is not None:
+            entry = self.checkpoints.find(frameno, seconds)
+            if entry is not None and entry[0] > self.frameno:
+                self.restore_checkpoint(self.checkpoints.state(entry))
+        while True:
+            if frameno is not None and self.frameno >= frameno - 1:
+                break
+            if seconds is not None:
+                if seconds <= 0 and self.frameno == 0:
+                    break
+                if self.frameno > 0:
+                    delay = self.next_delay()
+                    if delay is None:
+                        break
+                    elapsed = (self.seconds - self.first_header[0]) + (self.useconds - self.first_header[1]) / 1000000.0
+                    if elapsed + delay * self.speed >= seconds:
+                        break
+            if not self.read_frame():
+                break
+            self.emulate_frame()
+
+    def display_frame(self):
+        """
+        Emulate the frame and save the screen if it changed.
 
+        :return: None
+        """
+        self.emulate_frame()
         self.save_frame()
 
     def close(self):
@@ -843,8 +1651,34 @@ class TtyPlay(object):
 
         :return: None
         """
+        try:
+            self.frame_writer.close()
+        finally:
+            self.file.close()
+            if self.checkpoints is not None:
+                self.checkpoints.close()
+            self.release_mmap()
+
+    def release_mmap(self):
+        """
+        Unmap the file. Frames handed out before become invalid. While a slice
+        of the file is still referenced elsewhere (e.g. by a traceback) the
+        mapping is left to the garbage collector.
+
+        :return: None
+        """
+        if isinstance(self.frame, memoryview):
+            self.frame.release()
         self.frame = None
-        self.file.close()
+        if self.mmap is None:
+            return
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+        self.view = None
+        self.mmap = None
 
     def __enter__(self):
         """
@@ -863,48 +1697,171 @@ class TtyPlay(object):
         :param exc_tb: Exception backtrace (if any).
         :return: None
         """
-        self.file.close()
+        self.close()
+
+#Pause after each saved frame of interactive runs to let the terminal draw
+DRAW_DELAY = 1.0 / 30
+
+class Resampler(object):
+    """
+    Places ttyrec frames on an output timeline of fixed frame rate.
+
+    The screen after a ttyrec frame is visible from the frame's time until the
+    next frame's. It is emitted as output frame k (at k / fps seconds) if k is
+    the first tick in that interval, screens replaced before the next tick are
+    dropped. Pauses longer than max_idle are shortened to max_idle.
+    """
+    def __init__(self, fps, max_idle=None, clock=0.0):
+        """
+        :param fps: Output frames per second.
+        :param max_idle: Longest pause kept in seconds, None keeps all pauses.
+        :param clock: Output time of the first frame, for runs starting mid-file.
+        """
+        self.fps = fps
+        self.max_idle = max_idle
+        self.clock = clock  # Output time of the current ttyrec frame
+
+    def tick(self, delay):
+        """
+        Advance past the current ttyrec frame.
+
+        :param delay: Seconds until the next ttyrec frame, None for the last frame.
+        :return: Output frame number of the current screen, or None if no tick shows it.
+        """
+        first_tick = math.ceil(self.clock * self.fps - 1e-6)
+        if delay is None:
+            return first_tick
+        if self.max_idle is not None:
+            delay = min(delay, self.max_idle)
+        self.clock += delay
+        if first_tick < self.clock * self.fps - 1e-6:
+            return first_tick
+        return None
+
+def convert(tp, fps=None, max_idle=None, last_frame=None, clock=0.0, after_save=None):
+    """
+    Emulate every frame of a ttyrec and save the changed screens. Unless tp is
+    headless, sleeps DRAW_DELAY after each saved frame.
+
+    :param tp: TtyPlay to read from.
+    :param fps: Resample to this many output frames per second, numbered from 1
+        with timestamps on the output timeline. None saves the screen after every
+        ttyrec frame with its frame number and header timestamp.
+    :param max_idle: Longest pause kept when resampling, in seconds.
+    :param last_frame: Stop after this frame instead of at the end of the file.
+    :param clock: Output time of the next frame when resampling.
+    :param after_save: Called with tp after every save_frame(), a true result
+        stops the conversion.
+    :return: Dict with the number of frames read, frames saved, payload bytes
+        and elapsed seconds.
+    """
+    resampler = Resampler(fps, max_idle, clock) if fps else None
+    frames = 0
+    payload = 0
+    start = time.perf_counter()
+    while (last_frame is None or tp.frameno < last_frame) and tp.read_frame():
+        saved = tp.saved_frames
+        tp.emulate_frame()
+        frames += 1
+        payload += tp.length
+        if resampler is None:
+            tp.save_frame()
+        else:
+            tick = resampler.tick(tp.next_delay())
+            if tick is None:
+                continue
+            tp.save_frame(tick + 1, tick / float(fps))
+        if after_save is not None and after_save(tp):
+            break
+        if tp.headless or tp.saved_frames == saved:
+            continue
+        # Let the terminal emulator draw the frame. Without this it's possible
+        # to capture partial draws. It's not a strict guarantee, but seems to
+        # work reasonably well.
+        time.sleep(DRAW_DELAY)
+    return {'frames': frames, 'saved': tp.saved_frames, 'bytes': payload,
+            'seconds': time.perf_counter() - start}
+
+def open_frame_writer(store=None, keyframe_interval=0, directory='./data', append=False):
+    """
+    :param store: Path of a frame store to write, None for CSVs.
+    :param keyframe_interval: Write the store as keyframes + deltas with this interval, 0 for full frames.
+    :param directory: Directory of the CSVs.
+    :param append: Add the frames to an existing store instead of replacing it.
+    :return: DeltaFrameStoreWriter, FrameStoreWriter or CsvFrameWriter.
+    """
+    if store and not append:
+        for stale in (store, store + '.idx', store + '.frames'):
+            if os.path.exists(stale):
+                os.remove(stale)
+    if store and keyframe_interval > 0:
+        return DeltaFrameStoreWriter(store, keyframe_interval=keyframe_interval)
+    elif store:
+        return FrameStoreWriter(store)
+    return CsvFrameWriter(directory)
+
+def print_summary(stats):
+    seconds = max(stats['seconds'], 1e-9)
+    print("{} frames ({} saved), {} bytes in {:.2f}s: {:.0f} frames/s, {:.2f} MB/s".format(
+        stats['frames'], stats['saved'], stats['bytes'], stats['seconds'],
+        stats['frames'] / seconds, stats['bytes'] / seconds / 1e6))
 
 if __name__ ==  '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-verbose", help="increase output verbosity",action="store_true")
     parser.add_argument("-path", help="specify path of ttyrec",required=True)
+    parser.add_argument("-index", help="load/save a sidecar frame index (PATH.idx)",action="store_true")
+    parser.add_argument("-mmap", help="memory-map the ttyrec instead of reading it",action="store_true")
+    parser.add_argument("-screen", help="screen representation",choices=["array","list"],default="array")
+    parser.add_argument("-store", help="write frames to this binary frame store instead of ./data/*.csv")
+    parser.add_argument("-keyframe-interval", help="write -store as keyframes every N frames + deltas",type=int,default=0)
+    parser.add_argument("-append", help="add the frames to an existing -store instead of replacing it",action="store_true")
+    parser.add_argument("-headless", help="convert at full speed: no sleeps, no per-frame output, no terminal reset",action="store_true")
+    parser.add_argument("-fps", help="resample to this many output frames per second from the ttyrec timestamps",type=float,default=0)
+    parser.add_argument("-max-idle", help="with -fps, shorten pauses longer than this many seconds",type=float)
+    parser.add_argument("-checkpoints", help="load/extend emulator checkpoints (PATH.ckpt) for -start-frame/-start-time",action="store_true")
+    parser.add_argument("-checkpoint-interval", help="frames between checkpoints",type=int,default=10000)
+    parser.add_argument("-start-frame", help="save frames from this frame number on",type=int)
+    parser.add_argument("-start-time", help="save frames from this many seconds after the first frame on",type=float)
     global_args = parser.parse_args()
-
-    tp = TtyPlay(global_args.path, 1.0)
-    vislength = 0.0
-    delays = tp.compute_framedelays()
-    fps = 30
+    if global_args.max_idle is not None and not global_args.fps:
+        parser.error("-max-idle needs -fps")
+    if global_args.append and not global_args.store:
+        parser.error("-append needs -store")
+
+    frame_writer = open_frame_writer(global_args.store, global_args.keyframe_interval, append=global_args.append)
+    tp = TtyPlay(global_args.path, 1.0, index_path=global_args.path + '.idx' if global_args.index else None,
+                 use_mmap=global_args.mmap, screen_class=ArrayScreen if global_args.screen == "array" else Screen,
+                 frame_writer=frame_writer, headless=global_args.headless,
+                 checkpoint_path=global_args.path + '.ckpt' if global_args.checkpoints else None,
+                 checkpoint_interval=global_args.checkpoint_interval)
     try:
-        while tp.read_frame():
-            # if tp.frameno > 291800:
-            if tp.frameno > -1:
-                tp.display_frame()
-
-                if tp.frameno <= len(delays):
-                    vislength += delays[tp.frameno - 1]
-                    if vislength <= 0.1:  # GIF counts delays in hundredths of seconds
-                        continue  # We discard frames that are less than this.
-                    else:
-                        vislength = 0.0
-                # Let the terminal emulator draw the frame. Without this it's possible
-                # to capture partial draws. It's not a strict guarantee, but seems to
-                # work reasonably well.
-                time.sleep(1.0 / fps)
-                #GET DATA
-
+        if global_args.start_frame is not None or global_args.start_time is not None:
+            tp.start_at(global_args.start_frame, global_args.start_time)
+        stats = convert(tp, global_args.fps or None, global_args.max_idle)
     except ChildProcessError as e:
-        clear_screen()
+        if not global_args.headless:
+            clear_screen()
         print_err("Main processing loop failed:")
         print_err("{0}: {1}".format(type(e).__name__, e))
         sys.exit(1)
     except KeyboardInterrupt:
-        time.sleep(0.1)
-        clear_screen()
+        try:
+            tp.close()
+        finally:
+            #Finish the manifest or store even if closing the ttyrec failed
+            frame_writer.close()
+        if not global_args.headless:
+            time.sleep(0.1)
+            clear_screen()
         print_err("User has cancelled rendering")
         sys.exit(1)
 
-    clear_screen()
-    print("DONE")
+    tp.close()
+    if global_args.headless:
+        print_summary(stats)
+    else:
+        clear_screen()
+        print("DONE")
 
 
@@ -0,0 +1,352 @@
+import argparse
+import io
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from frame_store import FrameStoreWriter, open_store, read_manifest
+from frame_maker import FONT, FrameConstructor, png_chunk, png_data, png_header, read_csv_cells
+from ttyplay import TtyPlay, convert
+
+# Renders a ttyrec, frame store or ./data csv directory into one video or animated
+# image, every frame shown for the time between its ttyrec timestamp and the next.
+#
+# Frames are rendered in order, re-stamping only the cells that changed, and
+# streamed to the writer. ffmpeg gets raw RGB frames at a fixed rate, repeated
+# to fill each duration. Without ffmpeg an APNG or GIF is written directly, with
+# the real durations and only the changed region of each frame.
+#
+#      python3 video.py -path game.ttyrec -o game.mp4
+#      python3 video.py -store frames.bin -o game.apng -max-idle 2
+#      python3 video.py -o game.gif -rs 100 -re 400
+
+#Extensions of the writers used without ffmpeg
+FALLBACK_WRITERS = {'.png':'apng','.apng':'apng','.gif':'gif'}
+
+class TimedWriter(object):
+    """
+    Base of the video writers. Frame durations are added up on a clock and each frame is
+    written with the whole number of UNITS the clock moved on since the last written one.
+    A frame that would get fewer than MIN_UNITS is merged into the next one.
+
+    Subclasses write the file with write_frame(image, box, units), which writes the
+    box region of image shown for units, and finish(), which completes the file and
+    returns its size in bytes.
+    """
+    UNITS = 1000
+    MIN_UNITS = 1
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.clock = 0.0
+        self.units = 0
+        self.frames = 0
+        self.image = None
+        self.box = None
+
+    def add(self, image, box, duration):
+        """
+        Show an image for a time.
+
+        :param image: (height, width, 3) uint8 array.
+        :param box: Tuple (top, left, bottom, right) of the pixels changed since the
+            previous image, every pixel for the first.
+        :param duration: Seconds.
+        :return: None
+        """
+        self.image = image
+        if self.box is None:
+            self.box = box
+        else:
+            self.box = (min(self.box[0], box[0]), min(self.box[1], box[1]),
+                        max(self.box[2], box[2]), max(self.box[3], box[3]))
+        self.clock += duration
+        units = int(round(self.clock * self.UNITS)) - self.units
+        if units >= self.MIN_UNITS:
+            self.flush(units)
+
+    def flush(self, units):
+        if self.box[2] <= self.box[0] or self.box[3] <= self.box[1]:
+            #Regions can't be empty, redraw one pixel
+            self.box = (0, 0, 1, 1)
+        self.write_frame(self.image, self.box, units)
+        self.units += units
+        self.frames += 1
+        self.box = None
+
+    def close(self):
+        """
+        Write the frame still merged into a next one, if any, and finish the file.
+
+        :return: Bytes written.
+        """
+        if self.box is not None:
+            self.flush(self.MIN_UNITS)
+        return self.finish()
+
+class FfmpegWriter(TimedWriter):
+    """
+    Pipes raw RGB frames at fps into ffmpeg, which picks the format from the file extension.
+    """
+    def __init__(self, path, width, height, fps=30):
+        super().__init__(width, height)
+        self.UNITS = fps
+        self.path = path
+        command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', '{}x{}'.format(width, height), '-r', str(fps), '-i', '-']
+        #Most players only decode 4:2:0 h264
+        if os.path.splitext(path)[1].lower() in ('.mp4', '.mov', '.mkv'):
+            command += ['-pix_fmt', 'yuv420p']
+        self.process = subprocess.Popen(command + [path], stdin=subprocess.PIPE)
+
+    def write_frame(self, image, box, units):
+        data = np.ascontiguousarray(image).data
+        try:
+            for _ in range(units):
+                self.process.stdin.write(data)
+        except BrokenPipeError:
+            raise ChildProcessError("ffmpeg exited with code {}".format(self.process.wait()))
+
+    def finish(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise ChildProcessError("ffmpeg exited with code {}".format(self.process.returncode))
+        return os.path.getsize(self.path)
+
+class ApngWriter(TimedWriter):
+    """
+    Writes an animated png, every frame after the first only holding its changed region.
+    Delays are whole milliseconds, or centiseconds past the 65.5s a millisecond delay holds.
+    """
+    def __init__(self, path, width, height, level=6):
+        super().__init__(width, height)
+        self.level = level
+        self.sequence = 0
+        self.file = open(path, 'wb')
+        self.file.write(png_header(width, height))
+        #Frame count, patched on close
+        self.actl = self.file.tell()
+        self.file.write(png_chunk(b'acTL', struct.pack('>II', 0, 0)))
+
+    def write_frame(self, image, box, units):
+        top, left, bottom, right = box if self.frames else (0, 0, self.height, self.width)
+        delay, denominator = (units, 1000) if units <= 0xffff else (min((units + 5) // 10, 0xffff), 100)
+        #Regions are copied over the frame before, dispose and blend are none and source
+        self.file.write(png_chunk(b'fcTL', struct.pack('>IIIIIHHBB', self.sequence, right - left, bottom - top,
+                                                       left, top, delay, denominator, 0, 0)))
+        self.sequence += 1
+        data = png_data(image[top:bottom, left:right], self.level)
+        if self.frames == 0:
+            self.file.write(png_chunk(b'IDAT', data))
+        else:
+            self.file.write(png_chunk(b'fdAT', struct.pack('>I', self.sequence) + data))
+            self.sequence += 1
+
+    def finish(self):
+        self.file.write(png_chunk(b'IEND', b''))
+        self.file.seek(self.actl)
+        self.file.write(png_chunk(b'acTL', struct.pack('>II', self.frames, 0)))
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        self.file.close()
+        return size
+
+class GifWriter(TimedWriter):
+    """
+    Writes an animated gif, every frame after the first only holding its changed region.
+    Each region is reduced to its own 256 colour palette and LZW-compressed by PIL one at
+    a time, so memory doesn't grow with the clip. Delays are centiseconds, at least 2
+    since most viewers slow shorter delays down to 10.
+    """
+    UNITS = 100
+    MIN_UNITS = 2
+
+    def __init__(self, path, width, height):
+        super().__init__(width, height)
+        self.file = open(path, 'wb')
+        #No global colour table, every frame brings its own
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0))
+        #Loop forever
+        self.file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def write_frame(self, image, box, units):
+        top, left, bottom, right = box if self.frames else (0, 0, self.height, self.width)
+        region = Image.fromarray(np.ascontiguousarray(image[top:bottom, left:right]))
+        region = region.quantize(256, dither=Image.Dither.NONE)
+        encoded = io.BytesIO()
+        region.save(encoded, 'GIF', interlace=False)
+        data = encoded.getvalue()
+        #Take the colour table and image of the single frame gif PIL wrote
+        flags = data[10]
+        table_end = 13 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+        table = data[13:table_end]
+        i = table_end
+        while data[i] == 0x21:
+            i += 2
+            while data[i]:
+                i += data[i] + 1
+            i += 1
+        descriptor_flags = data[i + 9]
+        image_start = i + 10
+        if descriptor_flags & 0x80:
+            table_end = image_start + (3 << ((descriptor_flags & 7) + 1))
+            table = data[image_start:table_end]
+            image_start = table_end
+        size_bits = (len(table) // 3).bit_length() - 2
+        #Graphic control: keep the frame when the next is drawn, delay in centiseconds
+        self.file.write(b'\x21\xf9\x04' + struct.pack('<BHBB', 1 << 2, min(units, 0xffff), 0, 0))
+        self.file.write(struct.pack('<BHHHHB', 0x2c, left, top, right - left, bottom - top, 0x80 | size_bits))
+        self.file.write(table)
+        #Up to the trailer
+        self.file.write(data[image_start:-1])
+
+    def finish(self):
+        self.file.write(b'\x3b')
+        size = self.file.tell()
+        self.file.close()
+        return size
+
+def open_writer(path, width, height, writer='auto', fps=30, level=6):
+    """
+    :param path: Output file.
+    :param writer: ffmpeg, apng, gif or auto: ffmpeg if it is installed, else by the extension of path.
+    :param fps: Frame rate of the ffmpeg writer.
+    :param level: zlib level of the apng writer.
+    :return: TimedWriter, raises ValueError if there is none for path.
+    """
+    if writer == 'auto':
+        extension = os.path.splitext(path)[1].lower()
+        if shutil.which('ffmpeg'):
+            writer = 'ffmpeg'
+        elif extension in FALLBACK_WRITERS:
+            writer = FALLBACK_WRITERS[extension]
+        else:
+            raise ValueError("ffmpeg was not found, write a .apng or .gif instead of {}".format(path))
+    if writer == 'ffmpeg':
+        return FfmpegWriter(path, width, height, fps)
+    if writer == 'apng':
+        return ApngWriter(path, width, height, level)
+    return GifWriter(path, width, height)
+
+def durations(timestamps, speed=1.0, max_idle=None, hold=1.0):
+    """
+    :param timestamps: Timestamps of the frames in seconds.
+    :param speed: Speed multiplier, divides the durations.
+    :param max_idle: Longest duration kept, None for no limit.
+    :param hold: Seconds the last frame is shown.
+    :return: Array of the seconds every frame is shown.
+    """
+    shown = np.append(np.maximum(np.diff(np.asarray(timestamps, dtype=np.float64)), 0.0) / speed, hold)
+    if max_idle is not None:
+        shown = np.minimum(shown, max_idle)
+    return shown
+
+def make_video(screens, timestamps, writer, fc, speed=1.0, max_idle=None, hold=1.0):
+    """
+    Render screens in order and show each for its duration.
+
+    :param screens: Iterable of (rows, cols) CELL_DTYPE arrays.
+    :param timestamps: Timestamps of the screens in seconds.
+    :param writer: TimedWriter.
+    :param fc: FrameConstructor of the screen size.
+    :return: Dict with the frames rendered, frames written, seconds of video and bytes written.
+    """
+    rendered = 0
+    tile = fc.TILESIZE
+    fc.clear_png_array()
+    for cells, duration in zip(screens, durations(timestamps, speed, max_idle, hold)):
+        if fc.previous_cells is None:
+            box = (0, 0, cells.shape[0], cells.shape[1])
+        else:
+            ys, xs = np.nonzero(cells != fc.previous_cells)
+            box = (ys.min(), xs.min(), ys.max() + 1, xs.max() + 1) if len(ys) else (0, 0, 0, 0)
+        fc.render_changes(cells)
+        rendered += 1
+        if box[2] > box[0]:
+            box = tuple(int(edge) * tile for edge in box)
+        else:
+            #Nothing changed, the writer grows an empty box into the next one
+            box = (fc.png_array.shape[0], fc.png_array.shape[1], 0, 0)
+        writer.add(fc.png_array, box, duration)
+    size = writer.close()
+    return {'rendered': rendered, 'written': writer.frames, 'seconds': writer.units / float(writer.UNITS), 'bytes': size}
+
+def store_frames(store, first=0, last=0):
+    """
+    :param store: FrameStore or DeltaFrameStore.
+    :param first: First frame number, 0 for the start.
+    :param last: Last frame number, 0 for the end.
+    :return: Tuple (positions of the frames in the store, timestamps).
+    """
+    positions = np.arange(len(store))
+    if first:
+        positions = positions[store.framenos >= first]
+    if last:
+        positions = positions[store.framenos[positions] <= last]
+    return positions, store.timestamps[positions]
+
+if __name__ ==  '__main__':
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("-path", help="emulate this ttyrec (default: read ./data/*.csv and frames.csv)")
+    source.add_argument("-store", help="read frames from a frame store written by ttyplay.py -store")
+    parser.add_argument("-o", help="output file, .mp4/.webm/... need ffmpeg, .apng/.png and .gif are written without it",required=True)
+    parser.add_argument("-writer", help="auto: ffmpeg if installed, else apng or gif by extension",choices=['auto','ffmpeg','apng','gif'],default='auto')
+    parser.add_argument("-fps", help="frame rate of ffmpeg output",type=int,default=30)
+    parser.add_argument("-speed", help="speed multiplier",type=float,default=1.0)
+    parser.add_argument("-max-idle", help="show no frame longer than this many seconds",type=float)
+    parser.add_argument("-hold", help="seconds the last frame is shown",type=float,default=1.0)
+    parser.add_argument("-rs", help="first frame number of the clip",type=int,default=0)
+    parser.add_argument("-re", help="last frame number of the clip",type=int,default=0)
+    parser.add_argument("-level", help="zlib compression level 0-9 of apng output",type=int,choices=range(10),default=6)
+    parser.add_argument("-font", help="font of the text tiles, as in frame_maker.py",default=FONT)
+    global_args = parser.parse_args()
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        if global_args.path:
+            store_path = os.path.join(tmp, 'frames.bin')
+            with TtyPlay(global_args.path, frame_writer=FrameStoreWriter(store_path), headless=True) as tp:
+                convert(tp)
+        else:
+            store_path = global_args.store
+        if store_path:
+            store = open_store(store_path)
+            rows, cols = store.rows, store.cols
+            positions, timestamps = store_frames(store, global_args.rs, global_args.re)
+            screens = (store.cells(i) for i in positions)
+        else:
+            manifest = read_manifest('./data')
+            if not manifest:
+                parser.error("./data has no frames.csv with the frame timestamps, run ttyplay.py again")
+            manifest = [row for row in manifest if (not global_args.rs or row[0] >= global_args.rs)
+                        and (not global_args.re or row[0] <= global_args.re)]
+            rows, cols = 29, 81
+            timestamps = [timestamp for _, timestamp, _ in manifest]
+            screens = (read_csv_cells('./data/' + str(source) + '.csv', rows, cols) for _, _, source in manifest)
+        if len(timestamps) == 0:
+            parser.error("no frames to write")
+
+        fc = FrameConstructor(TILESIZE=32, DISPLAY_Y_SIZE=rows, DISPLAY_X_SIZE=cols, DATASIZE=3, font=global_args.font)
+        try:
+            writer = open_writer(global_args.o, cols * fc.TILESIZE, rows * fc.TILESIZE, global_args.writer,
+                                 global_args.fps, global_args.level)
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            stats = make_video(screens, timestamps, writer, fc, global_args.speed, global_args.max_idle, global_args.hold)
+        except ChildProcessError as e:
+            print("Writing {} failed: {}".format(global_args.o, e), file=sys.stderr)
+            sys.exit(1)
+    elapsed = time.perf_counter() - start
+    print("{} frames rendered, {} written to {} ({:.1f}s of video, {} bytes) in {:.2f}s: {:.1f} frames/s".format(
+        stats['rendered'], stats['written'], global_args.o, stats['seconds'], stats['bytes'], elapsed,
+        stats['rendered'] / max(elapsed, 1e-9)))